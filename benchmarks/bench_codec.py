@@ -0,0 +1,93 @@
+"""
+This compares the stdlib json module with the FractalServer codec on
+representative /result and /queue_manager payloads
+
+"""
+
+import json
+from time import time
+
+import numpy as np
+
+from qcfractal.interface import codec
+
+n_atoms = 30
+n_results = 50
+n_repeat = 5
+
+
+def build_result(i, use_numpy):
+    rng = np.random.RandomState(i)
+    geometry = rng.rand(n_atoms, 3)
+    hessian = rng.rand(3 * n_atoms, 3 * n_atoms)
+
+    if not use_numpy:
+        geometry = geometry.ravel().tolist()
+        hessian = hessian.ravel().tolist()
+
+    return {
+        "molecule": {
+            "symbols": ["C"] * n_atoms,
+            "geometry": geometry,
+        },
+        "driver": "hessian",
+        "method": "b3lyp",
+        "basis": "6-31g",
+        "program": "psi4",
+        "return_result": hessian,
+        "properties": {
+            "scf_total_energy": -100.0 - i,
+            "nuclear_repulsion_energy": 50.0 + i
+        },
+        "provenance": {
+            "creator": "Psi4",
+            "version": "1.2",
+        },
+        "success": True,
+        "id": "{:024x}".format(i),
+    }
+
+
+def result_payload(use_numpy):
+    """A /result GET response"""
+    data = [build_result(i, use_numpy) for i in range(n_results)]
+    return {"meta": {"n_found": len(data), "success": True, "errors": [], "missing": []}, "data": data}
+
+
+def queue_manager_payload(use_numpy):
+    """A /queue_manager POST from a QueueManager"""
+    data = {"{:024x}".format(i): (build_result(i, use_numpy), "single", []) for i in range(n_results)}
+    return {"meta": {"name": "bench_manager", "tag": None}, "data": data}
+
+
+def bench(name, dumps, loads, payload):
+    tstart = time()
+    for i in range(n_repeat):
+        blob = dumps(payload)
+    encode = (time() - tstart) / n_repeat
+
+    tstart = time()
+    for i in range(n_repeat):
+        loads(blob)
+    decode = (time() - tstart) / n_repeat
+
+    print("{:32s} encode {:8.2f} ms  decode {:8.2f} ms  size {:6.2f} MB".format(name, encode * 1000, decode * 1000,
+                                                                               len(blob) / 1.e6))
+
+
+if __name__ == '__main__':
+
+    print("Codec backend: {}".format(codec.get_json_backend()))
+
+    for name, builder in [("/result", result_payload), ("/queue_manager", queue_manager_payload)]:
+        print('==================')
+        print(name)
+        print('==================')
+
+        lists = builder(False)
+        arrays = builder(True)
+
+        bench("stdlib json (lists)", json.dumps, json.loads, lists)
+        bench("codec (lists)", codec.json_dumps, codec.json_loads, lists)
+
+        bench("codec (arrays)", codec.json_dumps, codec.json_loads, arrays)
@@ -187,6 +187,21 @@ def query_results_pymongo(n_query, mol):
         # db.connection.get_connection()[db_name]['result'].find_one(query)
         pymongo_client.results.find(query)
 
+def read_results_to_json(mol):
+    """The mongoengine Document.to_json -> json.loads read path"""
+    data = []
+    for d in Result.objects(molecule=mol, basis="b1").limit(mongoengine_socket._max_limit):
+        d = mongoengine_socket._doc_to_json(d)
+        d["molecule"] = d["molecule"]["$oid"]
+        data.append(d)
+    return data
+
+
+def read_results_raw(mol):
+    """The raw document read path of get_results"""
+    return mongoengine_socket.get_results(molecule=[str(mol.id)], basis="B1", status=None)["data"]
+
+
 def bench():
 
     option = Options(program='Psi4', name='default').save()
@@ -249,6 +264,18 @@ def bench():
     dtime = (time() - tstart) * 1000  # msec
     print('{} Results queries PYMONGO in an avg {:0.3f} ms / doc'.format(n_query, dtime/n_query))
 
+    print('--------------------------')
+
+    tstart = time()
+    n_read = len(read_results_to_json(mol))
+    dtime = (time() - tstart) * 1000  # msec
+    print('{} Results read with to_json in an avg {:0.3f} ms / doc'.format(n_read, dtime/n_read))
+
+    tstart = time()
+    n_read = len(read_results_raw(mol))
+    dtime = (time() - tstart) * 1000  # msec
+    print('{} Results read with get_results in an avg {:0.3f} ms / doc'.format(n_read, dtime/n_read))
+
 
 if __name__ == "__main__":
     bench()
@@ -0,0 +1,138 @@
+"""
+This compares the SQLite socket with the Mongoengine and in-memory sockets
+for molecule and result insertion, result reads, and task queue throughput
+
+"""
+
+import os
+import tempfile
+from time import time
+
+import pymongo
+
+import qcfractal.interface as portal
+from qcfractal.storage_sockets import storage_socket_factory
+
+db_name = 'bench_qc_sqlite'
+
+n_mol = 1000
+n_results = 1000
+n_tasks = 1000
+batch_size = 100
+
+
+def build_sockets(tmpdir):
+    sockets = {
+        "sqlite": storage_socket_factory("sqlite:///" + os.path.join(tmpdir, db_name + ".sqlite"), db_name,
+                                         db_type="sqlite"),
+        "memory": storage_socket_factory(None, db_name, db_type="memory"),
+    }
+
+    try:
+        pymongo.MongoClient("mongodb://localhost", serverSelectionTimeoutMS=100).server_info()
+    except pymongo.errors.ServerSelectionTimeoutError:
+        print("MongoDB is not available, skipping the mongoengine socket")
+    else:
+        sockets["mongoengine"] = storage_socket_factory("mongodb://localhost", db_name, db_type="mongoengine")
+
+    for socket in sockets.values():
+        socket._clear_db(db_name)
+
+    return sockets
+
+
+def insert_molecules(socket, n_mol):
+    water = portal.data.get_molecule("water_dimer_minima.psimol").to_json()
+
+    mol_data = {}
+    for i in range(n_mol):
+        tmp = water.copy()
+        tmp['charge'] = i
+        mol_data['water' + str(i)] = tmp
+
+    return socket.add_molecules(mol_data)["data"]
+
+
+def insert_results(socket, n_results, mol_id):
+
+    results = []
+    for i in range(n_results):
+        results.append({
+            "molecule": mol_id,
+            "method": str(i),
+            "basis": "B1",
+            "options": None,
+            "program": "P1",
+            "driver": "energy",
+            "other_data": 5,
+        })
+
+    return socket.add_results(results)["data"]
+
+
+def queue_throughput(socket, result_ids):
+
+    tasks = []
+    for i, result_id in enumerate(result_ids):
+        tasks.append({
+            "hash_index": "bench" + str(i),
+            "spec": {
+                "function": "qcengine.compute",
+                "args": [{}, "P1"],
+                "kwargs": {}
+            },
+            "tag": None,
+            "base_result": ("results", result_id)
+        })
+
+    tstart = time()
+    socket.queue_submit(tasks)
+    submit = time() - tstart
+
+    tstart = time()
+    claimed = []
+    while True:
+        found = socket.queue_get_next(manager="bench_manager", limit=batch_size)
+        if len(found) == 0:
+            break
+        claimed.extend(x["id"] for x in found)
+    get_next = time() - tstart
+
+    tstart = time()
+    for i in range(0, len(claimed), batch_size):
+        socket.queue_mark_complete(claimed[i:i + batch_size])
+    complete = time() - tstart
+
+    return submit, get_next, complete
+
+
+if __name__ == '__main__':
+
+    # The SQLite database is removed with its directory
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sockets = build_sockets(tmpdir)
+
+        for name, socket in sockets.items():
+            print('==================')
+            print(name)
+            print('==================')
+
+            tstart = time()
+            mol_ids = insert_molecules(socket, n_mol)
+            print('Inserted {} molecules in {:.3f} s'.format(n_mol, time() - tstart))
+
+            tstart = time()
+            result_ids = insert_results(socket, n_results, mol_ids['water0'])
+            print('Inserted {} results in {:.3f} s'.format(n_results, time() - tstart))
+
+            tstart = time()
+            n_read = len(socket.get_results(status=None, limit=n_results)["data"])
+            print('Read {} results in {:.3f} s'.format(n_read, time() - tstart))
+
+            submit, get_next, complete = queue_throughput(socket, result_ids[:n_tasks])
+            print('Submitted {} tasks in {:.3f} s'.format(n_tasks, submit))
+            print('Claimed {} tasks in batches of {} in {:.3f} s'.format(n_tasks, batch_size, get_next))
+            print('Completed {} tasks in {:.3f} s'.format(n_tasks, complete))
+            print('Queue throughput {:.1f} tasks/s'.format(n_tasks / (submit + get_next + complete)))
+
+            socket._clear_db(db_name)
@@ -0,0 +1,125 @@
+"""
+This times the submission of single and optimization tasks, parsing the request,
+inserting the result or procedure stubs, and queueing the tasks, against the
+number of submitted molecules
+
+"""
+
+import os
+import sys
+import tempfile
+from time import time
+
+import pymongo
+
+import qcfractal.interface as portal
+from qcfractal import procedures
+from qcfractal.storage_sockets import storage_socket_factory
+
+db_name = 'bench_qc_submission'
+
+n_molecules = [10, 100, 1000, 10000, 100000]
+
+single_meta = {
+    "procedure": "single",
+    "driver": "energy",
+    "method": "HF",
+    "basis": "sto-3g",
+    "options": None,
+    "program": "psi4"
+}
+
+optimization_meta = {
+    "procedure": "optimization",
+    "keywords": {
+        "coordsys": "tric"
+    },
+    "program": "geometric",
+    "qc_meta": {
+        "driver": "gradient",
+        "method": "HF",
+        "basis": "sto-3g",
+        "options": None,
+        "program": "psi4"
+    }
+}
+
+
+def build_sockets(tmpdir):
+    sockets = {
+        "sqlite": storage_socket_factory("sqlite:///" + os.path.join(tmpdir, db_name + ".sqlite"), db_name,
+                                         db_type="sqlite"),
+        "memory": storage_socket_factory(None, db_name, db_type="memory"),
+    }
+
+    try:
+        pymongo.MongoClient("mongodb://localhost", serverSelectionTimeoutMS=100).server_info()
+    except pymongo.errors.ServerSelectionTimeoutError:
+        print("MongoDB is not available, skipping the mongoengine socket")
+    else:
+        sockets["mongoengine"] = storage_socket_factory("mongodb://localhost", db_name, db_type="mongoengine")
+
+    for socket in sockets.values():
+        socket._clear_db(db_name)
+
+    return sockets
+
+
+def build_molecules(n_mol, offset):
+    water = portal.data.get_molecule("water_dimer_minima.psimol").to_json()
+
+    molecules = []
+    for i in range(n_mol):
+        tmp = water.copy()
+        tmp['charge'] = offset + i
+        molecules.append(tmp)
+
+    return molecules
+
+
+def submit(socket, meta, molecules):
+    """Submits the molecules as the TaskQueueHandler does, returns the number of queued tasks"""
+
+    packet = {"meta": dict(meta), "data": molecules}
+    tasks, complete, errors = procedures.get_procedure_input_parser(meta["procedure"])(socket, packet)
+
+    return socket.queue_submit(tasks)["meta"]["n_inserted"]
+
+
+if __name__ == '__main__':
+
+    # The largest molecule count may be passed on the command line
+    if len(sys.argv) > 1:
+        n_molecules = [x for x in n_molecules if x <= int(sys.argv[1])]
+
+    # The SQLite database is removed with its directory
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sockets = build_sockets(tmpdir)
+
+        for name, socket in sockets.items():
+            print('==================')
+            print(name)
+            print('==================')
+            print('{:>10s} {:>12s} {:>18s} {:>18s}'.format("molecules", "single (s)", "optimization (s)",
+                                                          "molecules/s (opt)"))
+
+            offset = 0
+            for n_mol in n_molecules:
+
+                # Fresh molecules for each submission so that nothing is a duplicate
+                molecules = build_molecules(n_mol, offset)
+                offset += n_mol
+                tstart = time()
+                n_single = submit(socket, single_meta, molecules)
+                single_time = time() - tstart
+
+                molecules = build_molecules(n_mol, offset)
+                offset += n_mol
+                tstart = time()
+                n_opt = submit(socket, optimization_meta, molecules)
+                opt_time = time() - tstart
+
+                assert n_single == n_opt == n_mol
+                print('{:10d} {:12.3f} {:18.3f} {:18.1f}'.format(n_mol, single_time, opt_time, n_mol / opt_time))
+
+            socket._clear_db(db_name)
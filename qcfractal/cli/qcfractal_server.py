@@ -3,6 +3,7 @@ A command line interface to the qcfractal server.
 """
 
 import argparse
+import sys
 
 import qcfractal
 from . import cli_utils
@@ -28,12 +29,42 @@ def parse_args():
     server.add_argument("name", type=str, help="The name of the FractalServer and its associated database")
     server.add_argument("--log-prefix", type=str, default=None, help="The logfile prefix to use")
     server.add_argument("--port", type=int, default=7777, help="The server port")
+    server.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="The number of server processes sharing the port, 0 starts one process per CPU")
     server.add_argument(
         "--security", type=str, default=None, choices=[None, "local"], help="The security protocol to use")
     server.add_argument("--database-uri", type=str, default="mongodb://localhost", help="The database URI to use")
+    server.add_argument(
+        "--database-type",
+        type=str,
+        default="mongoengine",
+        choices=["mongoengine", "sqlite", "memory"],
+        help="The database type to use, 'memory' does not persist data")
+    server.add_argument(
+        "--storage-threads",
+        type=int,
+        default=4,
+        help="The number of threads which run database operations for incoming requests")
+    server.add_argument(
+        "--max-active-services", type=int, default=10, help="The maximum number of services which run at once")
+    server.add_argument(
+        "--service-workers", type=int, default=4, help="The number of workers which iterate services in parallel")
+    server.add_argument(
+        "--service-executor",
+        type=str,
+        default="thread",
+        choices=["thread", "process"],
+        help="Iterate services on a thread or a process pool")
     server.add_argument("--tls-cert", type=str, default=None, help="Certificate file for TLS (in PEM format)")
     server.add_argument("--tls-key", type=str, default=None, help="Private key file for TLS (in PEM format)")
     server.add_argument("--config-file", type=str, default=None, help="A configuration file to use")
+    server.add_argument(
+        "--check-indexes",
+        action="store_true",
+        help="Lists missing and unused database indexes, explains the hot queries, and exits")
 
     parser._action_groups.reverse()
 
@@ -46,12 +77,49 @@ def parse_args():
     return args
 
 
+def check_indexes(args):
+    """Prints the index audit of the server database"""
+
+    if args["database_type"] != "mongoengine":
+        print("Index checks are only available for the 'mongoengine' database type.")
+        return False
+
+    # Report the indexes as they are, the audit does not build missing indexes
+    storage = qcfractal.storage_socket_factory(
+        args["database_uri"], args["name"], db_type=args["database_type"], build_indexes=False)
+    report = storage.check_indexes()
+
+    print("Missing indexes:")
+    for table, fields in report["missing"]:
+        print("    {}: {}".format(table, ", ".join(fields)))
+
+    print("Unused indexes:")
+    if report["unused"] is None:
+        print("    Index statistics are not available")
+    else:
+        for table, name in report["unused"]:
+            print("    {}: {}".format(table, name))
+
+    print("Hot queries:")
+    for query in report["queries"]:
+        status = "COLLSCAN" if query["collscan"] else "ok"
+        print("    {:24s} {:20s} {:8s} {}".format(query["name"], query["table"], status,
+                                                ", ".join(query["indexes"]) or "-"))
+
+    return len(report["missing"]) == 0 and not any(x["collscan"] for x in report["queries"])
+
+
 def main(args=None):
 
     # Grab CLI args if not present
     if args is None:
         args = parse_args()
 
+    if args["check_indexes"]:
+        if not check_indexes(args):
+            sys.exit(1)
+        return
+
     # Handle SSL
     ssl_certs = sum(args[x] is not None for x in ["tls_key", "tls_cert"])
     if ssl_certs == 0:
@@ -64,6 +132,11 @@ def main(args=None):
     # Handle Adapters/QueueManagers
     exit_callbacks = []
 
+    # Adapters hold their own event loops and connections which cannot be shared with forked workers
+    managers = [args[x] for x in ["dask_manager", "dask_manager_single", "fireworks_manager"]]
+    if (args["workers"] != 1) and any(managers):
+        raise ValueError("QueueManagers cannot be built on a FractalServer with multiple workers.")
+
     # Build an optional adapter
     if args["dask_manager"] or args["dask_manager_single"]:
         dd = cli_utils.import_module("distributed")
@@ -98,10 +171,16 @@ def main(args=None):
     # Build the server itself
     server = qcfractal.FractalServer(
         port=args["port"],
+        workers=args["workers"],
         security=args["security"],
         ssl_options=ssl_options,
         storage_uri=args["database_uri"],
         storage_project_name=args["name"],
+        storage_type=args["database_type"],
+        storage_threads=args["storage_threads"],
+        max_active_services=args["max_active_services"],
+        service_workers=args["service_workers"],
+        service_executor=args["service_executor"],
         logfile_prefix=args["log_prefix"],
         queue_socket=adapter)
 
@@ -2,11 +2,13 @@
 Tests for QCFractals CLI
 """
 import os
+import sys
 import time
 
 import pytest
 
 from qcfractal import testing
+from qcfractal.cli import qcfractal_server
 
 #def _run_tests()
 _options = {"coverage": True, "dump_stdout": True}
@@ -60,3 +62,19 @@ def test_manager_fireworks_config_boot(active_server):
     config_path = os.path.join(_pwd, "fw_config_boot.yaml")
     args = ["qcfractal-manager", active_server.test_uri_cli, "--rapidfire", "--config-file=" + config_path, "fireworks"]
     assert testing.run_process(args, **_options)
+
+@testing.mark_slow
+def test_cli_server_workers_boot():
+    port = "--port=" + str(testing.find_open_port())
+    assert testing.run_process(["qcfractal-server", "mydb", "--workers=2", port], interupt_after=10, **_options)
+
+
+def test_cli_server_workers_manager(monkeypatch):
+
+    # Managers hold event loops which cannot be shared with forked workers
+    monkeypatch.setattr(sys, "argv", ["qcfractal-server", "mydb", "--workers=2", "--dask-manager"])
+    args = qcfractal_server.parse_args()
+    assert args["workers"] == 2
+
+    with pytest.raises(ValueError):
+        qcfractal_server.main(args)
@@ -2,6 +2,7 @@
 DQM Client base folder
 """
 
+from . import codec
 from . import collections
 from . import data
 from . import dict_utils
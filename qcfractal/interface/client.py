@@ -7,6 +7,7 @@ from collections import defaultdict
 import requests
 import yaml
 
+from . import codec
 from . import molecule
 from . import orm
 from .collections import collection_factory
@@ -45,6 +46,11 @@ class FractalClient(object):
         self._verify = verify
         self._headers = {}
 
+        # Requests are sent as JSON until the server answers with MessagePack
+        self._content_type = codec.JSON_CONTENT_TYPE
+        if codec.has_msgpack():
+            self._headers["Accept"] = codec.MSGPACK_CONTENT_TYPE + ", " + codec.JSON_CONTENT_TYPE
+
         # If no 3rd party verification, quiet urllib
         if self._verify is False:
             from urllib3.exceptions import InsecureRequestWarning
@@ -66,23 +72,60 @@ class FractalClient(object):
         ret += "username='{}')".format(self.username)
         return ret
 
-    def _request(self, method, service, payload, noraise=False):
+    def _request(self, method, service, payload, noraise=False, stream=False):
 
         addr = self.address + service
+        data = codec.encode(payload, self._content_type)
+        headers = {"Content-Type": self._content_type, **self._headers}
         if method == "get":
-            r = requests.get(addr, json=payload, headers=self._headers, verify=self._verify)
+            r = requests.get(addr, data=data, headers=headers, verify=self._verify, stream=stream)
         elif method == "post":
-            r = requests.post(addr, json=payload, headers=self._headers, verify=self._verify)
+            r = requests.post(addr, data=data, headers=headers, verify=self._verify, stream=stream)
         elif method == "put":
-            r = requests.put(addr, json=payload, headers=self._headers, verify=self._verify)
+            r = requests.put(addr, data=data, headers=headers, verify=self._verify, stream=stream)
         else:
             raise KeyError("Method not understood: {}".format(method))
 
         if (r.status_code != 200) and (not noraise):
             raise requests.exceptions.HTTPError("Server communication failure. Reason: {}".format(r.reason))
 
+        # A server which answers with MessagePack also accepts it
+        if codec.is_msgpack(r.headers.get("Content-Type", None)):
+            self._content_type = codec.MSGPACK_CONTENT_TYPE
+
         return r
 
+    def _stream_request(self, service, payload):
+        """Requests a newline-delimited JSON stream and yields the decoded items as they arrive"""
+
+        payload["meta"]["stream"] = True
+        r = self._request("get", service, payload, stream=True)
+        try:
+            for line in r.iter_lines():
+                if line:
+                    yield codec.json_loads(line)
+        finally:
+            r.close()
+
+    def _paginate(self, service, payload, page_size):
+        """Requests consecutive pages of a query and yields their items until the server
+        stops returning a continuation token"""
+
+        payload["meta"]["limit"] = page_size
+        while True:
+            ret = self._decode(self._request("get", service, payload))
+            yield from ret["data"]
+
+            cursor = ret["meta"].get("next_cursor", None)
+            if not cursor:
+                break
+            payload["meta"]["cursor"] = cursor
+
+    @staticmethod
+    def _decode(r):
+        """Decodes the JSON or MessagePack body of a response from the server"""
+        return codec.decode(r.content, r.headers.get("Content-Type", None))
+
     @classmethod
     def from_file(cls, load_path=None):
         """Creates a new FractalClient from file. If no path is passed in searches
@@ -167,9 +210,9 @@ class FractalClient(object):
         r = self._request("get", "molecule", payload)
 
         if full_return:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
 
     def add_molecules(self, mol_list, full_return=False):
         """Adds molecules to the Server
@@ -203,9 +246,9 @@ class FractalClient(object):
         r = self._request("post", "molecule", payload)
 
         if full_return:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
 
     ### Options section
 
@@ -219,7 +262,7 @@ class FractalClient(object):
         payload = {"meta": {}, "data": opt_list}
         r = self._request("get", "option", payload)
 
-        return r.json()["data"]
+        return self._decode(r)["data"]
 
     def add_options(self, opt_list, full_return=False):
 
@@ -229,9 +272,9 @@ class FractalClient(object):
         r = self._request("post", "option", payload)
 
         if full_return:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
 
     ### Collections section
 
@@ -259,11 +302,11 @@ class FractalClient(object):
 
         if collection_type is None:
             ret = defaultdict(list)
-            for entry in r.json()["data"]:
+            for entry in self._decode(r)["data"]:
                 ret[entry["collection"]].append(entry["name"])
             return dict(ret)
         else:
-            return [x["name"] for x in r.json()["data"]]
+            return [x["name"] for x in self._decode(r)["data"]]
 
     def get_collection(self, collection_type, collection_name, full_return=False):
         """Aquires a given collection from the server
@@ -287,11 +330,12 @@ class FractalClient(object):
         r = self._request("get", "collection", payload)
 
         if full_return:
-            return r.json()
+            return self._decode(r)
         else:
             # If nothing found
-            if len(r.json()["data"]):
-                return collection_factory(r.json()["data"][0], client=self)
+            data = self._decode(r)["data"]
+            if len(data):
+                return collection_factory(data[0], client=self)
             else:
                 return None
 
@@ -308,13 +352,14 @@ class FractalClient(object):
         assert r.status_code == 200
 
         if full_return:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
 
     ### Results section
 
-    def get_results(self, **kwargs):
+    @staticmethod
+    def _results_payload(kwargs):
 
         keys = ["program", "molecule", "driver", "method", "basis", "options", "hash_index", "id", "status"]
         query = {}
@@ -326,12 +371,59 @@ class FractalClient(object):
         if "projection" in kwargs:
             payload["meta"]["projection"] = kwargs["projection"]
 
+        return payload
+
+    def get_results(self, **kwargs):
+
+        payload = self._results_payload(kwargs)
         r = self._request("get", "result", payload)
 
         if kwargs.get("return_full", False):
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
+
+    def iter_results(self, **kwargs):
+        """Iterates over all results matching the query. Results are streamed from
+        the server and decoded one at a time so that memory use stays constant,
+        the server's result limit does not apply.
+
+        Parameters
+        ----------
+        **kwargs
+            The query and projection keys of `get_results`
+
+        Yields
+        ------
+        dict
+            The JSON form of each result
+        """
+
+        payload = self._results_payload(kwargs)
+        yield from self._stream_request("result", payload)
+
+    def paginate_results(self, page_size=1000, **kwargs):
+        """Iterates over all results matching the query, results are requested
+        `page_size` at a time with keyset pagination.
+
+        Parameters
+        ----------
+        page_size : int, optional
+            The number of results per request, the server caps this at its result limit
+        **kwargs
+            The query and projection keys of `get_results`
+
+        Yields
+        ------
+        dict
+            The JSON form of each result
+        """
+
+        payload = self._results_payload(kwargs)
+        if "id" in payload["data"]:
+            raise KeyError("Results queried by id are not paginated, use `get_results`.")
+
+        yield from self._paginate("result", payload, page_size)
 
     def get_procedures(self, procedure_id, return_objects=True):
 
@@ -340,12 +432,62 @@ class FractalClient(object):
 
         if return_objects:
             ret = []
-            for packet in r.json()["data"]:
+            for packet in self._decode(r)["data"]:
                 tmp = orm.build_orm(packet, client=self)
                 ret.append(tmp)
             return ret
         else:
-            return r.json()
+            return self._decode(r)
+
+    def iter_procedures(self, procedure_query, return_objects=True):
+        """Iterates over all procedures matching the query, procedures are streamed
+        from the server one at a time without the server's limit.
+
+        Parameters
+        ----------
+        procedure_query : dict
+            The query of `get_procedures`
+        return_objects : bool, optional
+            Returns procedure objects rather than the JSON form
+
+        Yields
+        ------
+        object or dict
+            Each procedure
+        """
+
+        payload = {"meta": {}, "data": procedure_query}
+        for packet in self._stream_request("procedure", payload):
+            if return_objects:
+                yield orm.build_orm(packet, client=self)
+            else:
+                yield packet
+
+    def paginate_procedures(self, procedure_query, page_size=1000, return_objects=True):
+        """Iterates over all procedures matching the query, procedures are requested
+        `page_size` at a time with keyset pagination.
+
+        Parameters
+        ----------
+        procedure_query : dict
+            The query of `get_procedures`
+        page_size : int, optional
+            The number of procedures per request
+        return_objects : bool, optional
+            Returns procedure objects rather than the JSON form
+
+        Yields
+        ------
+        object or dict
+            Each procedure
+        """
+
+        payload = {"meta": {}, "data": procedure_query}
+        for packet in self._paginate("procedure", payload, page_size):
+            if return_objects:
+                yield orm.build_orm(packet, client=self)
+            else:
+                yield packet
 
     # Must compute results?
     # def add_results(self, db, full_return=False):
@@ -365,7 +507,45 @@ class FractalClient(object):
 
     ### Compute section
 
-    def add_compute(self, program, method, basis, driver, options, molecule_id, return_full=False, tag=None):
+    def add_compute(self,
+                    program,
+                    method,
+                    basis,
+                    driver,
+                    options,
+                    molecule_id,
+                    return_full=False,
+                    tag=None,
+                    priority=None):
+        """Adds single point computations to the queue.
+
+        Parameters
+        ----------
+        program : str
+            The program to execute the computation with
+        method : str
+            The method of the computation
+        basis : str
+            The basis of the computation
+        driver : str
+            The driver of the computation ("energy", "gradient", ...)
+        options : str
+            The name of the options set to use
+        molecule_id : str or list of str
+            The molecules to compute
+        return_full : bool, optional
+            Returns the full JSON return if True
+        tag : str, optional
+            The queue tag to submit the tasks under
+        priority : int, optional
+            The priority of the tasks, higher priority tasks are run first.
+            Tasks of the same priority are run in submission order.
+
+        Returns
+        -------
+        dict
+            The "submitted", "completed", and "queue" ids of the computations
+        """
 
         # Always a list
         if isinstance(molecule_id, str):
@@ -380,6 +560,7 @@ class FractalClient(object):
                 "basis": basis,
                 "options": options,
                 "tag": tag,
+                "priority": priority,
             },
             "data": molecule_id
         }
@@ -387,11 +568,11 @@ class FractalClient(object):
         r = self._request("post", "task_queue", payload)
 
         if return_full:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
 
-    def add_procedure(self, procedure, program, program_options, molecule_id, return_full=False):
+    def add_procedure(self, procedure, program, program_options, molecule_id, return_full=False, priority=None):
 
         # Always a list
         if isinstance(molecule_id, str):
@@ -401,6 +582,7 @@ class FractalClient(object):
             "meta": {
                 "procedure": procedure,
                 "program": program,
+                "priority": priority,
             },
             "data": molecule_id
         }
@@ -409,9 +591,9 @@ class FractalClient(object):
         r = self._request("post", "task_queue", payload)
 
         if return_full:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
 
     def check_tasks(self, query, projection=None, return_full=False):
         """Checks the status of tasks in the Fractal queue.
@@ -437,9 +619,31 @@ class FractalClient(object):
         r = self._request("get", "task_queue", payload)
 
         if return_full:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
+
+    def paginate_tasks(self, query, projection=None, page_size=1000):
+        """Iterates over all tasks matching the query, tasks are requested
+        `page_size` at a time with keyset pagination.
+
+        Parameters
+        ----------
+        query : dict
+            A query to find tasks
+        projection : dict, optional
+            The fields to return, defaults to the status, error, and tag of each task
+        page_size : int, optional
+            The number of tasks per request
+
+        Yields
+        ------
+        dict
+            Each task
+        """
+
+        payload = {"meta": {"projection": projection}, "data": query}
+        yield from self._paginate("task_queue", payload, page_size)
 
     def add_service(self, service, data, options, return_full=False):
 
@@ -458,9 +662,9 @@ class FractalClient(object):
         r = self._request("post", "service_queue", payload)
 
         if return_full:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
 
     def check_services(self, query, return_full=False):
         """Checks the status of services in the Fractal queue.
@@ -487,6 +691,6 @@ class FractalClient(object):
         r = self._request("get", "service_queue", payload)
 
         if return_full:
-            return r.json()
+            return self._decode(r)
         else:
-            return r.json()["data"]
+            return self._decode(r)["data"]
@@ -0,0 +1,282 @@
+"""
+Encoders and decoders for the data sent between a FractalServer and its clients
+"""
+
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+
+    # Older versions of ujson round floats to 10 digits
+    if int(ujson.__version__.split(".")[0]) < 2:
+        ujson = None
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+
+    # Task ids and other integer keys are allowed as map keys
+    _msgpack_unpack_options = {"raw": False}
+    if msgpack.version >= (1, 0):
+        _msgpack_unpack_options["strict_map_key"] = False
+except ImportError:
+    msgpack = None
+
+__all__ = [
+    "json_dumps", "json_loads", "get_json_backend", "msgpack_dumps", "msgpack_loads", "has_msgpack", "encode",
+    "decode", "is_msgpack"
+]
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# MessagePack extension type of NumPy arrays, the data is a packed [dtype, shape, buffer] list
+_NUMPY_EXT_CODE = 1
+
+
+def _default(obj):
+    """Converts NumPy types which the JSON encoders do not understand"""
+
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError("Object of type '{}' is not JSON serializable".format(type(obj).__name__))
+
+
+def _stdlib_dumps(data):
+    return json.dumps(data, default=_default)
+
+
+def _stdlib_loads(data):
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("UTF-8")
+    return json.loads(data)
+
+
+if orjson is not None:
+    _orjson_options = getattr(orjson, "OPT_SERIALIZE_NUMPY", 0) | getattr(orjson, "OPT_NON_STR_KEYS", 0)
+
+    def _dumps(data):
+        try:
+            return orjson.dumps(data, default=_default, option=_orjson_options).decode("UTF-8")
+        except TypeError:
+            # Integer keys or too deeply nested data on older orjson versions
+            return _stdlib_dumps(data)
+
+    _loads = orjson.loads
+    _backend = "orjson"
+
+elif ujson is not None:
+
+    def _dumps(data):
+        try:
+            return ujson.dumps(data)
+        except (TypeError, OverflowError):
+            # ujson does not understand NumPy types
+            return _stdlib_dumps(data)
+
+    _loads = ujson.loads
+    _backend = "ujson"
+
+else:
+    _dumps = _stdlib_dumps
+    _loads = _stdlib_loads
+    _backend = "json"
+
+
+def get_json_backend():
+    """Returns the name of the JSON library in use, "orjson", "ujson", or "json"
+
+    Returns
+    -------
+    str
+        The name of the backend
+    """
+    return _backend
+
+
+def json_dumps(data):
+    """Encodes data as JSON with the fastest available backend. NumPy arrays
+    and scalars are encoded as lists and numbers.
+
+    Parameters
+    ----------
+    data : object
+        The data to encode
+
+    Returns
+    -------
+    str
+        The JSON string
+
+    """
+    return _dumps(data)
+
+
+def json_loads(data):
+    """Decodes a JSON document with the fastest available backend.
+
+    Parameters
+    ----------
+    data : str or bytes
+        The JSON document
+
+    Returns
+    -------
+    object
+        The decoded data
+
+    """
+    return _loads(data)
+
+
+def has_msgpack():
+    """Checks if the msgpack library is available
+
+    Returns
+    -------
+    bool
+        True if MessagePack can be encoded and decoded
+    """
+    return msgpack is not None
+
+
+def _msgpack_default(obj):
+    """Packs numeric NumPy arrays as a typed extension, other NumPy types as MessagePack types"""
+
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind in "biuf":
+            data = msgpack.packb([obj.dtype.str, list(obj.shape), np.ascontiguousarray(obj).tobytes()],
+                                 use_bin_type=True)
+            return msgpack.ExtType(_NUMPY_EXT_CODE, data)
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError("Object of type '{}' is not MessagePack serializable".format(type(obj).__name__))
+
+
+def _msgpack_ext_hook(code, data, as_arrays):
+    if code == _NUMPY_EXT_CODE:
+        dtype, shape, buf = msgpack.unpackb(data, raw=False)
+        arr = np.frombuffer(buf, dtype=np.dtype(dtype)).reshape(shape)
+        if as_arrays:
+            return arr
+        return arr.tolist()
+
+    return msgpack.ExtType(code, data)
+
+
+def msgpack_dumps(data):
+    """Encodes data as MessagePack, numeric NumPy arrays are stored as a typed
+    binary extension rather than a list of numbers.
+
+    Parameters
+    ----------
+    data : object
+        The data to encode
+
+    Returns
+    -------
+    bytes
+        The MessagePack document
+
+    """
+    if msgpack is None:
+        raise ImportError("MessagePack encoding requires msgpack, please install this python module.")
+
+    return msgpack.packb(data, default=_msgpack_default, use_bin_type=True)
+
+
+def msgpack_loads(data, as_arrays=False):
+    """Decodes a MessagePack document.
+
+    Parameters
+    ----------
+    data : bytes
+        The MessagePack document
+    as_arrays : bool, optional
+        Returns NumPy arrays for array extensions, otherwise these are returned as lists
+
+    Returns
+    -------
+    object
+        The decoded data
+
+    """
+    if msgpack is None:
+        raise ImportError("MessagePack decoding requires msgpack, please install this python module.")
+
+    return msgpack.unpackb(
+        data, ext_hook=lambda code, ext: _msgpack_ext_hook(code, ext, as_arrays), **_msgpack_unpack_options)
+
+
+def encode(data, content_type=JSON_CONTENT_TYPE):
+    """Encodes data for the given Content-Type
+
+    Parameters
+    ----------
+    data : object
+        The data to encode
+    content_type : str, optional
+        Either "application/json" or "application/msgpack"
+
+    Returns
+    -------
+    str or bytes
+        The encoded data
+
+    """
+    if is_msgpack(content_type):
+        return msgpack_dumps(data)
+    else:
+        return json_dumps(data)
+
+
+def decode(data, content_type=JSON_CONTENT_TYPE):
+    """Decodes data of the given Content-Type, JSON is assumed for unknown types
+
+    Parameters
+    ----------
+    data : str or bytes
+        The encoded data
+    content_type : str, optional
+        The Content-Type header of the data
+
+    Returns
+    -------
+    object
+        The decoded data
+
+    """
+    if is_msgpack(content_type):
+        return msgpack_loads(data)
+    else:
+        return json_loads(data)
+
+
+def is_msgpack(content_type):
+    """Checks if a Content-Type or Accept header refers to MessagePack
+
+    Parameters
+    ----------
+    content_type : str
+        The header value
+
+    Returns
+    -------
+    bool
+        True if the header contains "application/msgpack"
+    """
+    return (content_type is not None) and (MSGPACK_CONTENT_TYPE in content_type)
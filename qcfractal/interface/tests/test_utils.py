@@ -2,6 +2,9 @@
 Tests for the interface utility functions.
 """
 
+import numpy as np
+import pytest
+
 from . import portal
 
 
@@ -18,3 +21,47 @@ def test_replace_dict_keys():
 
     ret = portal.dict_utils.replace_dict_keys({5: {5: 10}}, {5: 10})
     assert ret == {10: {10: 10}}
+
+
+def test_codec_numpy():
+
+    data = {"geometry": np.arange(6, dtype=np.double).reshape(2, 3), "energy": np.float64(-1.5), "n": np.int64(3)}
+    ret = portal.codec.json_loads(portal.codec.json_dumps(data))
+
+    assert ret == {"geometry": [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]], "energy": -1.5, "n": 3}
+    assert portal.codec.get_json_backend() in ["orjson", "ujson", "json"]
+
+
+def test_codec_loads_bytes():
+
+    data = {"meta": {"index": "id"}, "data": [1.0000000000000002, "H2O"]}
+    ret = portal.codec.json_loads(portal.codec.json_dumps(data).encode("UTF-8"))
+
+    assert ret == data
+
+
+def test_codec_msgpack():
+    pytest.importorskip("msgpack")
+
+    data = {
+        "geometry": np.arange(6, dtype=np.double).reshape(2, 3),
+        "real": np.array([True, False]),
+        "symbols": np.array(["H", "O"]),
+        "energy": np.float64(-1.5),
+        5: "int_key"
+    }
+    blob = portal.codec.encode(data, "application/msgpack")
+    assert isinstance(blob, bytes)
+
+    ret = portal.codec.decode(blob, "application/msgpack")
+    assert ret == {
+        "geometry": [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]],
+        "real": [True, False],
+        "symbols": ["H", "O"],
+        "energy": -1.5,
+        5: "int_key"
+    }
+
+    ret = portal.codec.msgpack_loads(blob, as_arrays=True)
+    assert isinstance(ret["geometry"], np.ndarray)
+    assert ret["geometry"].shape == (2, 3)
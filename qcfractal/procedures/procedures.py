@@ -62,6 +62,7 @@ def procedure_single_input_parser(storage, data):
 
     # Construct full tasks
     full_tasks = []
+    stubs = []
     for k, v in runs.items():
         if v["molecule"]["id"] in completed:
             continue
@@ -74,7 +75,7 @@ def procedure_single_input_parser(storage, data):
         result_obj = json.loads(result_stub)
         result_obj["molecule"] = v["molecule"]["id"]
         result_obj["status"] = "INCOMPLETE"
-        base_id = storage.add_results([result_obj])["data"][0]
+        stubs.append(result_obj)
 
         # Build task object
         task = {
@@ -88,11 +89,12 @@ def procedure_single_input_parser(storage, data):
             "hooks": [],
             "tag": tag,
             "parser": "single",
-            "base_result": ("results", base_id)
         }
 
         full_tasks.append(task)
 
+    # Add all result stubs at once
+    procedures_util.add_task_stubs(storage, full_tasks, stubs, "results")
 
     return full_tasks, completed, errors
 
@@ -129,8 +131,13 @@ def procedure_single_output_parser(storage, data):
     return completed, errors, hook_data
 
 
-def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"):
+def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index", return_hash_indices=False):
     """
+    Builds the optimization tasks of a set of molecules. All molecules are added, checked
+    for existing procedures, and given procedure stubs with a constant number of queries.
+
+    An optional "keywords" list of the packet holds keyword updates for each molecule, such
+    as the constraints of a scan, which are applied on top of the shared keywords.
 
     json_data = {
         "meta": {
@@ -146,8 +153,12 @@ def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"
             },
         },
         "data": ["mol_id_1", "mol_id_2", ...],
+        "keywords": [{"constraints": {...}}, {"constraints": {...}}, ...],
     }
 
+    If `return_hash_indices` is True the hash_index of each molecule is returned as a fourth
+    element, in the order of the molecules and None for molecules which were not found.
+
     qc_schema_input = {
         "schema_name": "qc_schema_input",
         "schema_version": 1,
@@ -179,8 +190,9 @@ def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"
 
     """
 
-    # Unpack individual QC tasks
-    runs, errors = procedures_util.unpack_single_run_meta(storage, data["meta"]["qc_meta"], data["data"])
+    # Unpack individual QC tasks, every molecule keeps its own run
+    runs, errors = procedures_util.unpack_single_run_meta(
+        storage, data["meta"]["qc_meta"], data["data"], by_index=True)
 
     if "options" in data["meta"]:
         if data["meta"]["options"] is None:
@@ -202,9 +214,13 @@ def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"
         "qcfractal_tags": data["meta"]
     })
 
-    full_tasks = []
-    duplicate_lookup = []
-    for k, v in runs.items():
+    keyword_updates = data.get("keywords", None)
+
+    # Molecules which share their keys share a task
+    full_tasks = {}
+    hash_indices = [None] * len(data["data"])
+    for idx in sorted(runs):
+        k, v = runs[idx]
 
         # Coerce qc_template information
         packet = json.loads(template)
@@ -212,6 +228,11 @@ def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"
         del v["molecule"]
         packet["input_specification"] = v
 
+        if keyword_updates is not None:
+            packet["keywords"].update(keyword_updates[idx])
+            tags = packet["qcfractal_tags"]
+            tags["keywords"] = dict(tags.get("keywords", None) or {}, **keyword_updates[idx])
+
         # Unique nesting of args
         keys = {
             "type": "optimization",
@@ -223,7 +244,9 @@ def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"
         # Add to args document to carry through to storage
         hash_index = procedures_util.hash_procedure_keys(keys)
         packet["hash_index"] = hash_index
-        duplicate_lookup.append(hash_index)
+        hash_indices[idx] = hash_index
+        if hash_index in full_tasks:
+            continue
 
         task = {
             "hash_index": hash_index,
@@ -238,12 +261,14 @@ def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"
             "parser": "optimization"
         }
 
-        full_tasks.append(task)
+        full_tasks[hash_index] = task
+
+    full_tasks = list(full_tasks.values())
 
     # Find and handle duplicates
     query = storage.get_procedures(
         {
-            "hash_index": duplicate_lookup
+            "hash_index": [x["hash_index"] for x in full_tasks]
         }, projection={"hash_index": True,
                        "id": True})["data"]
 
@@ -268,66 +293,80 @@ def procedure_optimization_input_parser(storage, data, duplicate_id="hash_index"
 
         full_tasks = new_tasks
 
-    # Add task stubs
-    for task in full_tasks:
-        stub = {"hash_index": task["hash_index"], "procedure": "optimization", "program": data["meta"]["program"]}
-        ret = storage.add_procedures([stub])
-        task["base_result"] = ("procedure", ret["data"][0])
+    # Add all task stubs at once
+    stubs = [{
+        "hash_index": task["hash_index"],
+        "procedure": "optimization",
+        "program": data["meta"]["program"]
+    } for task in full_tasks]
+    procedures_util.add_task_stubs(storage, full_tasks, stubs, "procedure")
+
+    if return_hash_indices:
+        return full_tasks, duplicates, errors, hash_indices
 
     return full_tasks, duplicates, errors
 
 
 def procedure_optimization_output_parser(storage, data):
+    """
+    Adds a batch of finished optimizations. All molecules of the batch are added with
+    one add_molecules, all trajectory results with one add_results, and all procedures
+    are updated with one update_procedures.
+    """
 
     new_procedures = {}
     new_hooks = {}
 
-    # Each optimization is a unique entry:
+    # Gather the start/stop molecules and trajectory computations of all optimizations
+    mols = {}
+    traj_dict = {}
     for result, hooks in data:
         key = result["queue_id"]
 
-        # Convert start/stop molecules to hash
-        mols = {"initial": result["initial_molecule"], "final": result["final_molecule"]}
-        mol_keys = storage.add_molecules(mols)["data"]
-        result["initial_molecule"] = mol_keys["initial"]
-        result["final_molecule"] = mol_keys["final"]
+        mols[(key, "initial")] = result["initial_molecule"]
+        mols[(key, "final")] = result["final_molecule"]
+        for num, traj in enumerate(result["trajectory"]):
+            traj_dict[(key, num)] = traj
+            mols[(key, num)] = traj["molecule"]
+
+    mol_keys = storage.add_molecules(mols)["data"]
+
+    # Parse trajectory computations and add queue_id
+    results = procedures_util.parse_single_runs(storage, traj_dict, molecule_ids=mol_keys)
+    for (key, num), v in results.items():
+        v["queue_id"] = key
 
-        # Parse trajectory computations and add queue_id
-        traj_dict = {k: v for k, v in enumerate(result["trajectory"])}
-        results = procedures_util.parse_single_runs(storage, traj_dict)
-        for k, v in results.items():
-            v["queue_id"] = key
+    # Add trajectory results and return ids
+    traj_keys = list(results.keys())
+    ret = storage.add_results([results[k] for k in traj_keys])
+    traj_ids = dict(zip(traj_keys, ret["data"]))
 
-        # Add trajectory results and return ids
-        ret = storage.add_results(list(results.values()))
-        result["trajectory"] = ret["data"]
+    # Each optimization is a unique entry:
+    for result, hooks in data:
+        key = result["queue_id"]
+
+        # Convert start/stop molecules to hash
+        result["initial_molecule"] = mol_keys[(key, "initial")]
+        result["final_molecule"] = mol_keys[(key, "final")]
+        result["trajectory"] = [traj_ids[(key, num)] for num in range(len(result["trajectory"]))]
 
         # Coerce tags
         result.update(result["qcfractal_tags"])
         del result["input_specification"]
         del result["qcfractal_tags"]
-        # print("Adding optimization result")
-        # print(json.dumps(v, indent=2))
         new_procedures[key] = result
         if len(hooks):
             new_hooks[key] = hooks
 
-        storage.update_procedure(result["hash_index"], result)
-    # print(list(new_procedures.values()))
-    # raise Exception()
-    # ret = storage.add_procedures(list(new_procedures.values()))
+    storage.update_procedures(list(new_procedures.values()))
 
     # Create a list of (queue_id, located) to update the queue with
     completed = list(new_procedures.keys())
 
     errors = []
-    # if len(ret["meta"]["errors"]):
-    #     # errors = [(k, "Duplicate results found")]
-    #     raise ValueError("TODO: Cannot yet handle queue result duplicates.")
 
     hook_data = procedures_util.parse_hooks(new_procedures, new_hooks)
 
-    # return (ret, hook_data)
     return completed, errors, hook_data
 
 
@@ -9,7 +9,7 @@ import json
 from .. import interface
 
 
-def unpack_single_run_meta(storage, meta, molecules):
+def unpack_single_run_meta(storage, meta, molecules, by_index=False):
     """Transforms a metadata compute packet into an expanded
     QC Schema for multiple runs.
 
@@ -21,11 +21,15 @@ def unpack_single_run_meta(storage, meta, molecules):
         A JSON description of the metadata involved with the computation
     molecules : list of str, dict
         A list of molecule ID's or full JSON molecules associated with the run.
+    by_index : bool, optional
+        Key the runs by the position of their molecule, each run is then a (key, run) tuple.
+        Molecules which appear several times keep a run each.
 
     Returns
     -------
     ret : tuple(dict, list)
-        A dictionary of JSON representations with keys built in.
+        A dictionary of JSON representations with keys built in, and the (key, message)
+        errors of the molecules which could not be read or found.
 
     Examples
     --------
@@ -50,6 +54,13 @@ def unpack_single_run_meta(storage, meta, molecules):
     indexed_molecules = {k: v for k, v in enumerate(molecules)}
     raw_molecules_query = storage.mixed_molecule_get(indexed_molecules)
 
+    # Molecules without a run are reported by their position
+    errors = list(raw_molecules_query["meta"]["errors"])
+    error_keys = {x[0] for x in errors}
+    for idx in sorted(raw_molecules_query["meta"]["missing"]):
+        if idx not in error_keys:
+            errors.append((idx, "Molecule not found"))
+
     # Pull out the needed options
     if meta["options"] is None:
         option_set = {}
@@ -84,12 +95,16 @@ def unpack_single_run_meta(storage, meta, molecules):
         data["molecule"] = mol
 
         indexer["molecule"] = mol["id"]
-        tasks[interface.schema.format_result_indices(indexer)] = data
+        key = interface.schema.format_result_indices(indexer)
+        if by_index:
+            tasks[idx] = (key, data)
+        else:
+            tasks[key] = data
 
-    return tasks, []
+    return tasks, errors
 
 
-def parse_single_runs(storage, results):
+def parse_single_runs(storage, results, molecule_ids=None):
     """Summary
 
     Parameters
@@ -98,6 +113,9 @@ def parse_single_runs(storage, results):
         A live connection to the current database.
     results : dict
         A (key, result) dictionary of the single return results.
+    molecule_ids : dict, optional
+        A (key, molecule id) dictionary of molecules which were already added,
+        otherwise the molecules of the results are added.
 
     Returns
     -------
@@ -108,8 +126,11 @@ def parse_single_runs(storage, results):
     """
 
     # Get molecule ID's
-    mols = {k: v["molecule"] for k, v in results.items()}
-    mol_ret = storage.add_molecules(mols)["data"]
+    if molecule_ids is None:
+        mols = {k: v["molecule"] for k, v in results.items()}
+        mol_ret = storage.add_molecules(mols)["data"]
+    else:
+        mol_ret = molecule_ids
 
     for k, v in results.items():
 
@@ -130,6 +151,44 @@ def parse_single_runs(storage, results):
 
     return results
 
+
+def add_task_stubs(storage, tasks, stubs, table):
+    """Inserts the result or procedure stubs of a set of tasks with a single insert
+    and points each task to its stub.
+
+    Parameters
+    ----------
+    storage : DBSocket
+        A live connection to the current database.
+    tasks : list of dict
+        The tasks, in the same order as the stubs
+    stubs : list of dict
+        The stubs of the results or procedures the tasks compute
+    table : str
+        Either "results" or "procedure"
+
+    Returns
+    -------
+    list of str
+        The stub ids in the order of the stubs
+    """
+
+    if len(stubs) == 0:
+        return []
+
+    if table == "results":
+        ids = storage.add_results(stubs)["data"]
+    elif table == "procedure":
+        ids = storage.add_procedures(stubs)["data"]
+    else:
+        raise KeyError("Stub table '{}' not understood".format(table))
+
+    for task, base_id in zip(tasks, ids):
+        task["base_result"] = (table, base_id)
+
+    return ids
+
+
 def single_run_hash(data, program=None):
 
     single_keys = interface.schema.format_result_indices(data, program=program)
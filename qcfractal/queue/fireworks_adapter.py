@@ -81,7 +81,7 @@ class FireworksAdapter:
         fireworks.core.rocket_launcher.rapidfire(self.lpad, strm_lvl="CRITICAL")
 
     def list_tasks(self):
-        return list(self.queue.values())
+        return [v[0] for v in self.queue.values()]
 
     def task_count(self):
         return len(self.queue)
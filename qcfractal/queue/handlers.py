@@ -15,20 +15,25 @@ class TaskQueueHandler(APIHandler):
     Takes in a data packet the contains the molecule_hash, modelchem and options objects.
     """
 
-    def post(self):
+    async def post(self):
         """Summary
         """
-        self.authenticate("compute")
+        await self.authenticate("compute")
 
         # Grab objects
         storage = self.objects["storage_socket"]
 
         # Format tasks
+        priority = self.json["meta"].pop("priority", None)
         func = procedures.get_procedure_input_parser(self.json["meta"]["procedure"])
-        full_tasks, complete_tasks, errors = func(storage, self.json)
+        full_tasks, complete_tasks, errors = await self.run_in_executor(func, storage, self.json)
+
+        if priority is not None:
+            for task in full_tasks:
+                task["priority"] = int(priority)
 
         # Add tasks to queue
-        ret = storage.queue_submit(full_tasks)
+        ret = await self.run_in_executor(storage.queue_submit, full_tasks)
         self.logger.info("TaskQueue: Added {} tasks.".format(ret["meta"]["n_inserted"]))
 
         ret["data"] = [x for x in ret["data"] if x is not None]
@@ -38,10 +43,10 @@ class TaskQueueHandler(APIHandler):
 
         self.write(ret)
 
-    def get(self):
+    async def get(self):
         """Posts new services to the service queue
         """
-        self.authenticate("read")
+        await self.authenticate("read")
 
         # Grab objects
         storage = self.objects["storage_socket"]
@@ -50,7 +55,12 @@ class TaskQueueHandler(APIHandler):
         if projection is None:
             projection = {x: True for x in ["status", "error", "tag"]}
 
-        ret = storage.get_queue(self.json["data"], projection=projection)
+        ret = await self.run_in_executor(
+            storage.get_queue,
+            self.json["data"],
+            projection=projection,
+            limit=self.json["meta"].get("limit", 0),
+            cursor=self.json["meta"].get("cursor", None))
 
         self.write(ret)
 
@@ -60,28 +70,22 @@ class ServiceQueueHandler(APIHandler):
     Takes in a data packet the contains the molecule_hash, modelchem and options objects.
     """
 
-    def post(self):
-        """Posts new services to the service queue
-        """
-        self.authenticate("compute")
-
-        # Grab objects
-        storage = self.objects["storage_socket"]
-
+    @staticmethod
+    def submit_services(storage_socket, data, logger):
         # Figure out initial molecules
         errors = []
-        ordered_mol_dict = {x: mol for x, mol in enumerate(self.json["data"])}
-        mol_query = storage.mixed_molecule_get(ordered_mol_dict)
+        ordered_mol_dict = {x: mol for x, mol in enumerate(data["data"])}
+        mol_query = storage_socket.mixed_molecule_get(ordered_mol_dict)
 
         # Build out services
         submitted_services = []
         for idx, mol in mol_query["data"].items():
-            tmp = services.initializer(self.json["meta"]["service"], storage, self.json["meta"], mol)
+            tmp = services.initializer(data["meta"]["service"], storage_socket, data["meta"], mol)
             submitted_services.append(tmp)
 
         # Figure out complete services
         service_hashes = [x.data["hash_index"] for x in submitted_services]
-        found_hashes = storage.get_procedures({"hash_index": service_hashes}, projection={"hash_index": True})
+        found_hashes = storage_socket.get_procedures({"hash_index": service_hashes}, projection={"hash_index": True})
         found_hashes = set(x["hash_index"] for x in found_hashes["data"])
 
         new_services = []
@@ -95,25 +99,37 @@ class ServiceQueueHandler(APIHandler):
                 new_services.append(x)
 
         # Add services to database
-        ret = storage.add_services([service.get_json() for service in new_services])
-        self.logger.info("ServiceQueue: Added {} services.\n".format(ret["meta"]["n_inserted"]))
+        ret = storage_socket.add_services([service.get_json() for service in new_services])
+        logger.info("ServiceQueue: Added {} services.\n".format(ret["meta"]["n_inserted"]))
 
         ret["data"] = {"submitted": ret["data"], "completed": list(complete_tasks), "queue": ret["meta"]["duplicates"]}
         ret["meta"]["duplicates"] = []
         ret["meta"]["errors"].extend(errors)
 
+        return ret
+
+    async def post(self):
+        """Posts new services to the service queue
+        """
+        await self.authenticate("compute")
+
+        # Grab objects
+        storage = self.objects["storage_socket"]
+
+        ret = await self.run_in_executor(self.submit_services, storage, self.json, self.logger)
+
         self.write(ret)
 
-    def get(self):
+    async def get(self):
         """Posts new services to the service queue
         """
-        self.authenticate("read")
+        await self.authenticate("read")
 
         # Grab objects
         storage = self.objects["storage_socket"]
 
         projection = {x: True for x in ["status", "error_message", "tag"]}
-        ret = storage.get_services(self.json["data"], projection=projection)
+        ret = await self.run_in_executor(storage.get_services, self.json["data"], projection=projection)
 
         self.write(ret)
 
@@ -178,16 +194,16 @@ class QueueManagerHandler(APIHandler):
             error_data.extend(err)
             hooks.extend(hks)
 
-        # Handle hooks and complete tasks
-        storage_socket.handle_hooks(hooks)
+        # Complete tasks before the hooks can wake their services
         storage_socket.queue_mark_complete(completed)
         storage_socket.queue_mark_error(error_data)
+        storage_socket.handle_hooks(hooks)
         return len(completed), len(error_data)
 
-    def get(self):
+    async def get(self):
         """Pulls new tasks from the Servers queue
         """
-        self.authenticate("queue")
+        await self.authenticate("queue")
 
         # Grab objects
         storage = self.objects["storage_socket"]
@@ -196,47 +212,61 @@ class QueueManagerHandler(APIHandler):
         name = self.json["meta"]["name"]
         tag = self.json["meta"].get("tag", None)
         kwargs = {
+            "manager": name,
             "limit": self.json["meta"].get("limit", 100),
             "tag": tag,
         } # yapf: disable
 
         # Grab new tasks and write out
-        new_tasks = storage.queue_get_next(**kwargs)
+        new_tasks = await self.run_in_executor(storage.queue_get_next, **kwargs)
         self.write({"meta": {"n_found": len(new_tasks), "success": True}, "data": new_tasks})
         self.logger.info("QueueManager: Served {} tasks.".format(len(new_tasks)))
 
         # Update manager logs
-        storage.manager_update(name, tag=tag, submitted=len(new_tasks))
+        await self.run_in_executor(storage.manager_update, name, tag=tag, submitted=len(new_tasks))
 
-    def post(self):
+    async def post(self):
         """Posts complete tasks to the Servers queue
         """
-        self.authenticate("queue")
+        await self.authenticate("queue")
 
         # Grab objects
         storage = self.objects["storage_socket"]
 
-        ret = self.insert_complete_tasks(storage, self.json["data"], self.logger)
+        ret = await self.run_in_executor(self.insert_complete_tasks, storage, self.json["data"], self.logger)
         self.write({"meta": {"n_inserted": ret[0]}, "data": True})
         self.logger.info("QueueManager: Aquired {} complete tasks.".format(len(self.json["data"])))
 
         # Update manager logs
         name = self.json["meta"]["name"]
         tag = self.json["meta"].get("tag", None)
-        storage.manager_update(name, tag=tag, completed=len(self.json["data"]))
+        await self.run_in_executor(storage.manager_update, name, tag=tag, completed=len(self.json["data"]))
 
-    def put(self):
+    async def put(self):
+        """Renews the leases of tasks held by a manager (heartbeat) or returns
+        the tasks to the queue (shutdown)
         """
-        """
-        self.authenticate("queue")
+        await self.authenticate("queue")
 
         storage = self.objects["storage_socket"]
 
-        storage.queue_reset_status(self.json["data"])
+        name = self.json["meta"]["name"]
+        operation = self.json["meta"].get("operation", "shutdown")
+
+        if operation == "heartbeat":
+            renewed = await self.run_in_executor(storage.queue_renew_leases, name, self.json["data"])
+            self.write({"meta": {"n_renewed": renewed}, "data": True})
+
+            # Update manager logs
+            await self.run_in_executor(storage.manager_update, name)
+            self.logger.debug("QueueManager: Heartbeat of manager {}, renewed {} task leases.".format(name, renewed))
+            return
+
+        # Only the tasks the manager still holds go back to the queue
+        returned = await self.run_in_executor(storage.queue_reset_status, self.json["data"], name)
         self.write({"meta": {}, "data": True})
 
         # Update manager logs
-        name = self.json["meta"]["name"]
-        storage.manager_update(name, returned=len(self.json["data"]))
+        await self.run_in_executor(storage.manager_update, name, returned=returned)
         self.logger.info("QueueManager: Shutdown of manager {} detected, recycling {} incomplete tasks.".format(
-            name, len(self.json["data"])))
+            name, returned))
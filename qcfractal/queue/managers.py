@@ -135,7 +135,7 @@ class QueueManager:
 
     def shutdown(self):
 
-        task_ids = [x[0] for x in self.list_current_tasks()]
+        task_ids = self.list_current_tasks()
         if len(task_ids) == 0:
             return True
 
@@ -177,6 +177,9 @@ class QueueManager:
 
             self.active -= len(results)
 
+        # Renew the leases of the tasks we still hold so the server does not requeue them
+        self.heartbeat()
+
         open_slots = max(0, self.max_tasks - self.active)
 
         if (new_tasks is False) or (open_slots == 0):
@@ -189,13 +192,34 @@ class QueueManager:
             # TODO something as we didnt successfully get data
             self.logger.warning("Aquisition of new tasks was not successful.")
 
-        new_tasks = r.json()["data"]
+        new_tasks = self.client._decode(r)["data"]
 
         # Add new tasks to queue
         self.queue_adapter.submit_tasks(new_tasks)
         self.active += len(new_tasks)
         return True
 
+    def heartbeat(self):
+        """Renews the server leases of all tasks currently held by this manager
+
+        Returns
+        -------
+        bool
+            Return True if the leases were successfully renewed
+        """
+
+        task_ids = self.list_current_tasks()
+        if len(task_ids) == 0:
+            return True
+
+        payload = {"meta": {"name": self.name_str, "tag": self.queue_tag, "operation": "heartbeat"}, "data": task_ids}
+        r = self.client._request("put", "queue_manager", payload, noraise=True)
+        if r.status_code != 200:
+            self.logger.warning("Heartbeat was not successful. Held tasks may be requeued by the server.")
+            return False
+
+        return True
+
     def await_results(self):
         """A synchronous method for testing or small launches
         that awaits task completion.
@@ -217,7 +241,7 @@ class QueueManager:
 
         Returns
         -------
-        ret : list of tuples
-            All tasks currently still in the database
+        ret : list of str
+            The ids of all tasks currently held by the queue
         """
         return self.queue_adapter.list_tasks()
@@ -3,25 +3,57 @@ The FractalServer class
 """
 
 import asyncio
+import concurrent.futures
+import copy
+import functools
 import logging
+import os
 import ssl
 import threading
+import time
 import traceback
 
+import tornado.httpserver
 import tornado.ioloop
 import tornado.log
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 
 from . import interface
 from . import queue
 from . import services
 from . import storage_sockets
+from .storage_sockets import storage_utils
 from . import web_handlers
 
 myFormatter = logging.Formatter('[%(asctime)s] %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
 
 
+def _remove_owned_file(filename, pid):
+    if os.getpid() == pid:
+        os.remove(filename)
+
+
+def _check_prefork():
+    """Raises if an IOLoop or a MongoDB connection exists, neither can be shared with forked workers"""
+
+    # IOLoop.current() would itself create an asyncio loop, so the registry of IOLoops is checked instead
+    if len(tornado.ioloop.IOLoop._ioloop_for_asyncio):
+        raise RuntimeError("An IOLoop was created before the FractalServer workers were forked. A FractalServer "
+                           "with multiple workers must be built before any IOLoop.")
+
+    try:
+        from mongoengine.connection import _connections
+    except ImportError:
+        _connections = {}
+
+    if len(_connections):
+        raise RuntimeError("A MongoDB connection was opened before the FractalServer workers were forked. A "
+                           "FractalServer with multiple workers must be built before any database connection.")
+
+
 def _build_ssl():
     from cryptography import x509
     from cryptography.x509.oid import NameOID
@@ -72,6 +104,67 @@ def _build_ssl():
     return cert_pem, key_pem
 
 
+# Service fields which the hooks of running tasks update, services write these when they submit tasks
+service_hook_fields = ("remaining_tasks", "awake")
+
+# Periodic storage jobs handle at most this many batches per pass, the remainder is left for the next pass
+periodic_batches = 10
+
+
+def iterate_service(storage, data):
+    """Iterates a single service
+
+    Parameters
+    ----------
+    storage : StorageSocket
+        The storage socket the service reads from and submits tasks to
+    data : dict
+        The service document, this is modified in place
+
+    Returns
+    -------
+    tuple
+        The new service document, the finished procedure or False, and the update
+        document of the changes to the service (see storage_utils.document_update). Fields
+        owned by the hooks are left out of the update so that concurrent hooks are not overwritten.
+    """
+
+    # Services modify their data in place, keep the stored state to find the changes
+    stored = copy.deepcopy(data)
+
+    # Attempt to iteration and get message
+    try:
+        obj = services.build(data["service"], storage, data)
+        finished = obj.iterate()
+        data = obj.get_json()
+    except Exception as e:
+        print(traceback.format_exc())
+        data["status"] = "ERROR"
+        data["error_message"] = "FractalServer Service Build and Iterate Error:\n" + traceback.format_exc()
+        finished = False
+
+    if finished is not False:
+        finished.pop("awake", None)
+
+    return data, finished, storage_utils.document_update(stored, data, ignore=service_hook_fields)
+
+
+# Storage sockets of a service process, built on the first iteration in the process
+_process_storage = {}
+
+
+def _iterate_service_process(storage_args, data):
+    """Iterates a service in a pool process with a storage socket of that process"""
+
+    if storage_args not in _process_storage:
+        uri, project_name, db_type, bypass_security = storage_args
+        kwargs = {"build_indexes": False} if db_type == "mongoengine" else {}
+        _process_storage[storage_args] = storage_sockets.storage_socket_factory(
+            uri, project_name=project_name, db_type=db_type, bypass_security=bypass_security, **kwargs)
+
+    return iterate_service(_process_storage[storage_args], data)
+
+
 class FractalServer:
     def __init__(
             self,
@@ -79,12 +172,15 @@ class FractalServer:
             # Server info options
             port=8888,
             loop=None,
+            workers=1,
             security=None,
             ssl_options=None,
 
             # Database options
             storage_uri="mongodb://localhost",
             storage_project_name="molssistorage",
+            storage_type="mongoengine",
+            storage_threads=4,
 
             # Queue options
             queue_socket=None,
@@ -93,7 +189,12 @@ class FractalServer:
             logfile_prefix=None,
 
             # Queue options
-            max_active_services=10):
+            max_active_services=10,
+            service_sweep_frequency=600,
+            service_workers=4,
+            service_executor="thread",
+            archive_frequency=3600,
+            lease_frequency=60):
 
         # Save local options
         self.port = port
@@ -103,6 +204,11 @@ class FractalServer:
             self._address = "https://localhost:" + str(self.port) + "/"
 
         self.max_active_services = max_active_services
+        self.service_sweep_frequency = service_sweep_frequency
+        self.archive_frequency = archive_frequency
+        self.lease_frequency = lease_frequency
+        self.storage_threads = storage_threads
+        self.service_workers = service_workers
 
         # Setup logging.
         if logfile_prefix is not None:
@@ -143,11 +249,10 @@ class FractalServer:
             ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             ssl_ctx.load_cert_chain(ssl_options["crt"], ssl_options["key"])
 
-            # Destroy keyfiles upon close
+            # Destroy keyfiles upon close, forked workers leave them to the parent process
             import atexit
-            import os
-            atexit.register(os.remove, cert_name)
-            atexit.register(os.remove, key_name)
+            atexit.register(_remove_owned_file, cert_name, os.getpid())
+            atexit.register(_remove_owned_file, key_name, os.getpid())
             self.client_verify = False
         elif ssl_options is False:
             ssl_ctx = None
@@ -160,18 +265,64 @@ class FractalServer:
         else:
             raise KeyError("ssl_options not understood")
 
+        # Pre-fork the worker processes which share the listening socket, each worker
+        # builds its own storage socket, thread pool, and IOLoop after the fork
+        self.workers = workers
+        self.worker_id = 0
+        self._sockets = None
+        if workers != 1:
+            if loop is not None:
+                raise ValueError("Cannot pass a loop to a FractalServer with multiple workers.")
+            if storage_type == "memory":
+                raise ValueError("The 'memory' storage type cannot be shared between multiple workers.")
+
+            _check_prefork()
+            self._sockets = tornado.netutil.bind_sockets(self.port)
+            self.worker_id = tornado.process.fork_processes(workers)
+            self.logger.info("FractalServer worker {} started with pid {}.".format(self.worker_id, os.getpid()))
+
+            # Never reuse an event loop of the parent process
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+        # Periodic jobs and the internal QueueManager only run in the first worker
+        self.primary = self.worker_id == 0
+
         # Setup the database connection
         self.storage = storage_sockets.storage_socket_factory(
-            storage_uri, project_name=storage_project_name, bypass_security=storage_bypass_security)
+            storage_uri,
+            project_name=storage_project_name,
+            db_type=storage_type,
+            bypass_security=storage_bypass_security)
         self.logger.info("Connected to '{}'' with database name '{}'\n.".format(storage_uri, storage_project_name))
 
+        # Services iterate on their own pool, each service is owned by at most one iteration
+        if service_executor == "thread":
+            self.service_executor = concurrent.futures.ThreadPoolExecutor(max_workers=service_workers)
+        elif service_executor == "process":
+            if storage_type == "memory":
+                raise ValueError("The 'memory' storage type cannot be shared with service processes.")
+            self.service_executor = concurrent.futures.ProcessPoolExecutor(max_workers=service_workers)
+        else:
+            raise KeyError("Service executor '{}' not recognized.".format(service_executor))
+
+        self._storage_args = (storage_uri, storage_project_name, storage_type, storage_bypass_security)
+        self._owned_services = set()
+        self._owned_services_lock = threading.Lock()
+        self._services_pass = None
+        self._last_service_sweep = 0
+        self._periodic_passes = {}
+
         # Pull the current loop if we need it
         self.loop = loop or tornado.ioloop.IOLoop.current()
 
+        # Blocking storage calls of the handlers run on a bounded pool so that the IOLoop stays responsive
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=storage_threads)
+
         # Build up the application
         self.objects = {
             "storage_socket": self.storage,
             "logger": self.logger,
+            "executor": self.executor,
         }
 
         endpoints = [
@@ -190,7 +341,7 @@ class FractalServer:
         ]
 
         # Queue manager if direct build
-        if queue_socket is not None:
+        if (queue_socket is not None) and self.primary:
 
             if security == "local":
                 raise ValueError("Cannot yet use local security with a internal QueueManager")
@@ -211,7 +362,10 @@ class FractalServer:
 
         self.http_server = tornado.httpserver.HTTPServer(self.app, ssl_options=ssl_ctx)
 
-        self.http_server.listen(self.port)
+        if self._sockets is None:
+            self.http_server.listen(self.port)
+        else:
+            self.http_server.add_sockets(self._sockets)
 
         # Add periodic callback holders
         self.periodic = {}
@@ -229,6 +383,22 @@ class FractalServer:
 
         self.logger.info("FractalServer successfully started. Starting IOLoop.\n")
 
+        if self.primary:
+            self._start_periodics()
+
+        # Soft quit with a keyboard interrupt
+        try:
+            self.loop_active = True
+            if not asyncio.get_event_loop().is_running():  # Only works on Py3
+                self.loop.start()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _start_periodics(self):
+        """
+        Starts the periodic jobs, these must only run in a single worker
+        """
+
         # If we have a queue socket start up the nanny
         if "queue_manager" in self.objects:
             # Add canonical queue callback
@@ -237,17 +407,24 @@ class FractalServer:
             self.periodic["queue_manager_update"] = manager
 
         # Add services callback
-        nanny_services = tornado.ioloop.PeriodicCallback(self.update_services, 2000)
+        nanny_services = tornado.ioloop.PeriodicCallback(self._update_services_periodic, 2000)
         nanny_services.start()
         self.periodic["update_services"] = nanny_services
 
-        # Soft quit with a keyboard interrupt
-        try:
-            self.loop_active = True
-            if not asyncio.get_event_loop().is_running():  # Only works on Py3
-                self.loop.start()
-        except KeyboardInterrupt:
-            self.stop()
+        # Move finished tasks out of the task queue, frequency is given in seconds
+        if self.archive_frequency:
+            archive_pass = functools.partial(self._run_periodic, "archive_tasks", self.archive_tasks, periodic_batches)
+            archive = tornado.ioloop.PeriodicCallback(archive_pass, 1000 * self.archive_frequency)
+            archive.start()
+            self.periodic["archive_tasks"] = archive
+
+        # Requeue tasks whose manager stopped renewing their lease, frequency is given in seconds
+        if self.lease_frequency:
+            leases_pass = functools.partial(self._run_periodic, "requeue_expired_tasks", self.requeue_expired_tasks,
+                                            periodic_batches)
+            leases = tornado.ioloop.PeriodicCallback(leases_pass, 1000 * self.lease_frequency)
+            leases.start()
+            self.periodic["requeue_expired_tasks"] = leases
 
     def stop(self):
         """
@@ -269,6 +446,10 @@ class FractalServer:
         for cb in self.periodic.values():
             cb.stop()
 
+        # Finish outstanding storage calls and service iterations
+        self.executor.shutdown(wait=False)
+        self.service_executor.shutdown(wait=False)
+
         # Call exit callbacks
         for func, args, kwargs in self.exit_callbacks:
             func(*args, **kwargs)
@@ -315,52 +496,192 @@ class FractalServer:
         else:
             return self._address
 
-    def update_services(self):
+    def _update_services_periodic(self):
+        """Starts a pass over the services on the storage pool, unless the previous pass is still running"""
+
+        if (self._services_pass is not None) and (not self._services_pass.done()):
+            return
+
+        # Every so often all running services are iterated to catch wakeups which were missed
+        wake_all = False
+        if self.service_sweep_frequency and (time.time() - self._last_service_sweep > self.service_sweep_frequency):
+            self._last_service_sweep = time.time()
+            wake_all = True
+
+        self._services_pass = self._run_periodic("update_services", self.update_services, wake_all)
+
+    def _run_periodic(self, name, func, *args):
+        """Runs a periodic storage job on the storage pool, unless its previous pass is still running"""
+
+        running = self._periodic_passes.get(name, None)
+        if (running is not None) and (not running.done()):
+            return running
+
+        future = self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+        future.add_done_callback(functools.partial(self._log_periodic_error, name))
+        self._periodic_passes[name] = future
+        return future
+
+    def _log_periodic_error(self, name, future):
+        """Logs the exception of a finished periodic pass, nobody else observes its future"""
+
+        if future.cancelled():
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            self.logger.error("FractalServer: Periodic job '{}' failed.".format(name), exc_info=exc)
+
+    def _claim_services(self, service_data):
+        """Takes ownership of the services which are not being iterated, returns the claimed services"""
+
+        claimed = []
+        with self._owned_services_lock:
+            for data in service_data:
+                if data["id"] not in self._owned_services:
+                    self._owned_services.add(data["id"])
+                    claimed.append(data)
+
+        return claimed
+
+    def _release_services(self, service_data):
+        with self._owned_services_lock:
+            self._owned_services.difference_update(x["id"] for x in service_data)
+
+    def update_services(self, wake_all=False):
         """Runs through all active services and examines their current status.
+
+        Only running services which were woken by their tasks are iterated, these are
+        iterated in parallel on the service pool. Services which are still iterating from
+        another pass are skipped. All changes are written at once.
+
+        Parameters
+        ----------
+        wake_all : bool, optional
+            Iterate all running services whether they were woken or not
+
+        Returns
+        -------
+        int
+            The number of services which are still running
         """
 
-        # Grab current services
-        current_services = self.storage.get_services({"status": "RUNNING"})["data"]
+        # Grab current services, sleeping services are only counted
+        if wake_all:
+            current_services = self.storage.get_services({"status": "RUNNING"})["data"]
+            n_running = len(current_services)
+        else:
+            running = self.storage.get_services({"status": "RUNNING"}, projection={"awake": True})["data"]
+            n_running = len(running)
+
+            awake = [x["id"] for x in running if x.get("awake", False)]
+            current_services = []
+            if len(awake):
+                current_services = self.storage.get_services({"id": awake})["data"]
 
         # Grab new services if we have open slots
-        open_slots = max(0, self.max_active_services - len(current_services))
+        open_slots = max(0, self.max_active_services - n_running)
         if open_slots > 0:
             new_services = self.storage.get_services({"status": "READY"}, limit=open_slots)["data"]
             current_services.extend(new_services)
+            n_running += len(new_services)
+
+        claimed = self._claim_services(current_services)
+        running_services = n_running - len(claimed)
+
+        # Put the services back to sleep before iterating them, hooks which fire during the pass wake them again
+        self.storage.update_services([(x["id"], {"$set": {"awake": False}}) for x in claimed if x.get("awake", False)])
 
         # Loop over the services and iterate
-        running_services = 0
         new_procedures = []
         complete_ids = []
-        for data in current_services:
-
-            # Attempt to iteration and get message
-            try:
-                obj = services.build(data["service"], self.storage, data)
-                finished = obj.iterate()
-                data = obj.get_json()
-            except Exception as e:
-                print(traceback.format_exc())
-                data["status"] = "ERROR"
-                data["error_message"] = "FractalServer Service Build and Iterate Error:\n" + traceback.format_exc()
-                finished = False
-
-            self.storage.update_services([(data["id"], data)])
-
-            if finished is not False:
-
-                # Add results to procedures, remove complete_ids
-                new_procedures.append(finished)
-                complete_ids.append(data["id"])
+        updates = []
+        try:
+            if isinstance(self.service_executor, concurrent.futures.ProcessPoolExecutor):
+                futures = [
+                    self.service_executor.submit(_iterate_service_process, self._storage_args, data)
+                    for data in claimed
+                ]
             else:
-                running_services += 1
+                futures = [self.service_executor.submit(iterate_service, self.storage, data) for data in claimed]
 
-        # Add new procedures and services
-        self.storage.add_procedures(new_procedures)
-        self.storage.del_services(complete_ids)
+            for data, future in zip(claimed, futures):
+                try:
+                    data, finished, update = future.result()
+                except Exception:
+                    self.logger.error("FractalServer: Service '{}' could not be iterated:\n{}".format(
+                        data["id"], traceback.format_exc()))
+
+                    # Wake the service again so that the next pass retries it
+                    updates.append((data["id"], {"$set": {"awake": True}}))
+                    running_services += 1
+                    continue
+
+                # Only the changed parts of the service are written
+                if update:
+                    updates.append((data["id"], update))
+
+                if finished is not False:
+
+                    # Add results to procedures, remove complete_ids
+                    new_procedures.append(finished)
+                    complete_ids.append(data["id"])
+                else:
+                    running_services += 1
+
+            # Write all service changes of this pass at once
+            self.storage.update_services(updates)
+
+            # Add new procedures and services
+            self.storage.add_procedures(new_procedures)
+            self.storage.del_services(complete_ids)
+        finally:
+            self._release_services(claimed)
 
         return running_services
 
+    def archive_tasks(self, max_batches=None):
+        """Moves all COMPLETE and ERROR tasks from the task queue into the task archive
+        so that the active task queue stays small.
+
+        Parameters
+        ----------
+        max_batches : int, optional
+            Stops after this many batches of tasks, by default the task queue is drained
+
+        Returns
+        -------
+        int
+            The number of archived tasks
+        """
+
+        n_archived = self.storage.queue_archive(max_batches=max_batches)
+        if n_archived:
+            self.logger.info("FractalServer: Archived {} finished tasks.".format(n_archived))
+
+        return n_archived
+
+    def requeue_expired_tasks(self, max_batches=None):
+        """Returns RUNNING tasks whose lease has expired to the queue, these
+        tasks belong to managers which have died or lost contact with the server.
+
+        Parameters
+        ----------
+        max_batches : int, optional
+            Stops after this many batches of tasks, by default all expired tasks are requeued
+
+        Returns
+        -------
+        int
+            The number of requeued tasks
+        """
+
+        n_requeued = self.storage.queue_requeue_expired(max_batches=max_batches)
+        if n_requeued:
+            self.logger.info("FractalServer: Requeued {} tasks with expired leases.".format(n_requeued))
+
+        return n_requeued
+
 ### Functions only available if using a local queue_adapter
 
     def _check_manager(self, func_name):
@@ -419,7 +740,7 @@ class FractalServer:
         self.await_results()
         for x in range(1, max_iter + 1):
             self.logger.info("\nAwait services: Iteration {}\n".format(x))
-            running_services = self.update_services()
+            running_services = self.update_services(wake_all=True)
             self.await_results()
             if running_services == 0:
                 break
@@ -115,21 +115,33 @@ class TorsionDriveService:
                 },
                 projection={"base_result": True,
                             "status": True})
+            # A failed task wakes the service, fail without waiting on the other tasks
+            if "ERROR" in set(x["status"] for x in task_query["data"]):
+                raise KeyError("All tasks did not execute successfully.")
+
             # If all tasks are not complete, return a False
             if len(task_query["data"]) != len(self.data["required_tasks"]):
                 return False
 
-            if "ERROR" in set(x["status"] for x in task_query["data"]):
-                raise KeyError("All tasks did not execute successfully.")
+            # Fetch the procedures of all tasks at once, only the fields the scan needs
+            procedure_ids = [str(x["base_result"]["_ref"].id) for x in task_query["data"]]
+            procedures = self.storage_socket.get_procedures(
+                {
+                    "id": procedure_ids
+                }, projection=["initial_molecule", "final_molecule", "energies"])["data"]
+            procedures = {x["id"]: x for x in procedures}
 
             # Create a lookup table for task ID mapping to result from that task in the procedure table
             inv_task_lookup = {
-                x["id"]: self.storage_socket.get_procedures({
-                    "id": x["base_result"]["_ref"].id
-                })["data"][0]
-                for x in task_query["data"]
+                x["id"]: procedures[procedure_id]
+                for x, procedure_id in zip(task_query["data"], procedure_ids)
             }
 
+            # Fetch the geometries of all initial and final molecules at once
+            molecule_ids = list({x[k] for x in procedures.values() for k in ["initial_molecule", "final_molecule"]})
+            geometries = self.storage_socket.get_molecules(molecule_ids, index="id", projection=["geometry"])["data"]
+            geometries = {x["id"]: x["geometry"] for x in geometries}
+
             # Populate task results
             task_results = {}
             for key, task_ids in self.data["task_map"].items():
@@ -143,11 +155,8 @@ class TorsionDriveService:
                     # Cycle through all tasks for this entry
                     ret = inv_task_lookup[task_id]
 
-                    # Lookup molecules
-                    mol_keys = self.storage_socket.get_molecules(
-                        [ret["initial_molecule"], ret["final_molecule"]], index="id")["data"]
-
-                    task_results[key].append((mol_keys[0]["geometry"], mol_keys[1]["geometry"], ret["energies"][-1]))
+                    task_results[key].append((geometries[ret["initial_molecule"]], geometries[ret["final_molecule"]],
+                                              ret["energies"][-1]))
 
                     # Update history
                     self.data["optimization_history"][key].append(ret["id"])
@@ -182,30 +191,25 @@ class TorsionDriveService:
 
         # Prepare optimization
         initial_molecule = json.dumps(self.data["molecule_template"])
-        meta_packet = json.dumps({
-            "meta": {
-                "procedure": "optimization",
-                "keywords": self.data["optimization_meta"],
-                "program": self.data["optimization_program"],
-                "qc_meta": self.data["qc_meta"],
-                "tag": self.data["tag"]
-            },
-        })
+        meta = {
+            "procedure": "optimization",
+            "keywords": self.data["optimization_meta"],
+            "program": self.data["optimization_program"],
+            "qc_meta": self.data["qc_meta"],
+            "tag": self.data["tag"]
+        }
 
         hook_template = json.dumps({
             "document": ("service_queue", self.data["id"]),
             "updates": [["inc", "remaining_tasks", -1]]
         })
 
-        full_tasks = []
-        task_map = {}
-        submitted_hash_id_remap = []  # Tracking variable for exondary pass
+        # Gather all constrained geometries of the wavefront
+        molecules = []
+        keyword_updates = []
+        grid_keys = []
         for key, geoms in task_dict.items():
-            task_map[key] = []
-            for num, geom in enumerate(geoms):
-
-                # Update molecule
-                packet = json.loads(meta_packet)
+            for geom in geoms:
 
                 # Construct constraints
                 constraints = copy.deepcopy(self.data["torsiondrive_meta"]["dihedral_template"])
@@ -214,31 +218,46 @@ class TorsionDriveService:
                 else:
                     for con_num, k in enumerate(key):
                         constraints[con_num]["value"] = k
-                packet["meta"]["keywords"]["constraints"] = {"set": constraints}
+                keyword_updates.append({"constraints": {"set": constraints}})
 
                 mol = json.loads(initial_molecule)
                 mol["geometry"] = geom
-                packet["data"] = [mol]
-
-                # Turn packet into a full task, if there are duplicates, get the ID
-                tasks, complete, errors = procedures.get_procedure_input_parser("optimization")(
-                    self.storage_socket, packet, duplicate_id="id")
-
-                if len(complete):
-                    # Job is already complete
-                    queue_id = self.storage_socket.get_procedures({"id": complete[0]})["data"][0]["queue_id"]
-                    task_map[key].append(queue_id)
-                else:
-                    # Create a hook which will update the complete tasks uid
-                    hook = json.loads(hook_template)
-                    tasks[0]["hooks"].append(hook)
-                    # Remember the full tasks map to update task_map later
-                    submitted_hash_id_remap.append((key, num))
-                    # Create a placeholder entry at that index for now, we'll update them all
-                    # with known task ID's after we submit them
-                    task_map[key].append(None)
-                    # Add task to "list to submit"
-                    full_tasks.append(tasks[0])
+                molecules.append(mol)
+                grid_keys.append(key)
+
+        # Turn all geometries into tasks at once, existing optimizations are returned by hash
+        packet = {"meta": copy.deepcopy(meta), "data": molecules, "keywords": keyword_updates}
+        full_tasks, complete, errors, hash_indices = procedures.get_procedure_input_parser("optimization")(
+            self.storage_socket, packet, duplicate_id="hash_index", return_hash_indices=True)
+
+        # Every grid point needs its optimization, stop before anything is queued
+        if None in hash_indices:
+            raise RuntimeError("Could not build the optimizations of {} of {} constrained geometries:\n{}".format(
+                hash_indices.count(None), len(hash_indices), errors))
+
+        # Jobs which are already complete
+        hash_queue_ids = {}
+        if len(complete):
+            found = self.storage_socket.get_procedures(
+                {
+                    "hash_index": complete
+                }, projection={"hash_index": True,
+                               "queue_id": True})["data"]
+            hash_queue_ids.update({x["hash_index"]: x["queue_id"] for x in found})
+
+        # Create a hook which will update the complete tasks uid
+        for task in full_tasks:
+            task["hooks"].append(json.loads(hook_template))
+
+        # The hooks count down the remaining tasks as soon as the tasks are queued, so the counter is
+        # written before submission. A service without new tasks stays awake to collect the finished ones.
+        self.data["remaining_tasks"] = len(full_tasks)
+        self.storage_socket.update_services([(self.data["id"], {
+            "$set": {
+                "remaining_tasks": len(full_tasks),
+                "awake": len(full_tasks) == 0
+            }
+        })])
 
         # Add tasks to Nanny
         ret = self.storage_socket.queue_submit(full_tasks)
@@ -253,14 +272,13 @@ class TorsionDriveService:
 
         # Create data for next round
         # Update task map based on task IDs
-        for (key, list_index), returned_id in zip(submitted_hash_id_remap, ret['data']):
-            task_map[key][list_index] = returned_id
+        hash_queue_ids.update({task["hash_index"]: queue_id for task, queue_id in zip(full_tasks, ret["data"])})
+        task_map = {key: [] for key in task_dict}
+        for key, hash_index in zip(grid_keys, hash_indices):
+            task_map[key].append(hash_queue_ids[hash_index])
         self.data["task_map"] = task_map
         self.data["required_tasks"] = list({x for v in task_map.values() for x in v})
 
-        # TODO edit remaining tasks to reflect duplicates
-        self.data["remaining_tasks"] = len(self.data["required_tasks"])
-
     def finalize(self):
         # Add finalize state
         # Parse remaining procedures
@@ -0,0 +1,228 @@
+"""
+Declares the indexes of the MongoDB tables and the queries they serve
+"""
+
+import datetime
+import logging
+import threading
+
+import pymongo
+from bson.objectid import ObjectId
+
+# Fields prefixed with '-' are indexed in descending order
+table_indexes = {
+    "collections": [{"fields": ("collection", "name"), "unique": True}],
+    "options": [{"fields": ("program", "name"), "unique": True}],
+    "molecules": [
+        {"fields": ("molecule_hash", "molecular_formula")},
+        {"fields": ("molecular_formula", )},
+    ],
+    "results": [
+        {"fields": ("program", "driver", "method", "basis", "molecule", "options"), "unique": True},
+        {"fields": ("molecule", "status")},
+        {"fields": ("status", )},
+    ],
+    "procedures": [
+        {"fields": ("hash_index", )},
+        {"fields": ("procedure", "program")},
+        {"fields": ("status", )},
+    ],
+    "service_queue": [
+        {"fields": ("hash_index", )},
+        {"fields": ("status", "tag", "hash_index")},
+    ],
+    "task_queue": [
+        {"fields": ("status", "tag", "-priority", "created_on")},
+        {"fields": ("status", "-priority", "created_on")},
+        {"fields": ("status", "lease_expiry")},
+        {"fields": ("base_result", ), "unique": True},
+    ],
+    "task_queue_archive": [
+        {"fields": ("base_result", )},
+        {"fields": ("status", )},
+    ],
+    "users": [{"fields": ("username", ), "unique": True}],
+    "queue_managers": [
+        {"fields": ("name", ), "unique": True},
+        {"fields": ("tag", )},
+    ],
+}  # yapf: disable
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+# The queries on the request and queue paths, (name, table, filter, sort)
+hot_queries = [
+    ("get_molecules", "molecules", {"molecule_hash": {"$in": [""]}}, None),
+    ("get_results", "results", {"molecule": {"$in": [ObjectId()]}, "status": "COMPLETE"}, None),
+    ("get_procedures", "procedures", {"hash_index": {"$in": [""]}}, None),
+    ("get_services", "service_queue", {"status": "RUNNING"}, None),
+    ("get_services_by_hash", "service_queue", {"hash_index": {"$in": [""]}}, None),
+    ("queue_get_next", "task_queue", {"status": "WAITING"}, [("priority", -1), ("created_on", 1)]),
+    ("queue_get_next_tag", "task_queue", {"status": "WAITING", "tag": ""}, [("priority", -1), ("created_on", 1)]),
+    ("queue_requeue_expired", "task_queue", {"status": "RUNNING", "lease_expiry": {"$lt": _epoch}}, None),
+    ("queue_submit", "task_queue", {"base_result": {"$in": [None]}}, None),
+    ("queue_archive", "task_queue", {"status": {"$in": ["COMPLETE", "ERROR"]}}, None),
+    ("get_queue_archive", "task_queue_archive", {"base_result": {"$in": [None]}}, None),
+    ("manager_update", "queue_managers", {"name": ""}, None),
+]  # yapf: disable
+
+
+def index_keys(fields):
+    """Translates index fields to a pymongo key specification"""
+    return [(x[1:], pymongo.DESCENDING) if x.startswith("-") else (x, pymongo.ASCENDING) for x in fields]
+
+
+def _plan_stages(plan):
+    """Lists the (stage, index name) pairs of a query plan"""
+    stages = [(plan.get("stage"), plan.get("indexName", None))]
+    for key in ["inputStage", "outerStage", "innerStage"]:
+        if key in plan:
+            stages.extend(_plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+class IndexManager:
+    """
+    Creates the declared indexes of a MongoDB database and audits their use.
+    """
+
+    def __init__(self, database, indexes=None, queries=None, logger=None):
+        """
+        Parameters
+        ----------
+        database : pymongo.database.Database
+            The project database
+        indexes : dict, optional
+            A {table: [index]} dictionary of the indexes to build, defaults to `table_indexes`
+        queries : list, optional
+            The (name, table, filter, sort) queries to explain, defaults to `hot_queries`
+        logger : logging.Logger, optional
+            The logger to report to
+        """
+
+        self._database = database
+        self._indexes = indexes if indexes is not None else table_indexes
+        self._queries = queries if queries is not None else hot_queries
+        self.logger = logger or logging.getLogger('IndexManager')
+
+    def existing(self, table):
+        """Returns a {key tuple: (name, unique)} dictionary of the indexes of a table"""
+
+        found = {}
+        for name, info in self._database[table].index_information().items():
+            key = tuple((k, v if isinstance(v, str) else int(v)) for k, v in info["key"])
+            found[key] = (name, info.get("unique", False))
+        return found
+
+    def missing(self):
+        """Lists the declared (table, index) pairs which do not exist in the database"""
+
+        ret = []
+        for table, indexes in self._indexes.items():
+            found = self.existing(table)
+            for index in indexes:
+                if tuple(index_keys(index["fields"])) not in found:
+                    ret.append((table, index))
+        return ret
+
+    def build(self, background=True):
+        """
+        Creates all missing indexes. Indexes which cannot be built, such as unique
+        indexes over duplicate data, are logged and skipped.
+
+        Parameters
+        ----------
+        background : bool, optional
+            Build indexes without blocking other operations on the table
+
+        Returns
+        -------
+        dict
+            A {table: [index name]} dictionary of the created indexes
+        """
+
+        created = {}
+        for table, index in self.missing():
+            try:
+                name = self._database[table].create_index(
+                    index_keys(index["fields"]), unique=index.get("unique", False), background=background)
+            except pymongo.errors.OperationFailure as err:
+                self.logger.warning("Could not build index {} on table '{}': {}".format(index["fields"], table, err))
+                continue
+
+            self.logger.info("Built index '{}' on table '{}'.".format(name, table))
+            created.setdefault(table, []).append(name)
+
+        return created
+
+    def build_async(self):
+        """Creates all missing indexes on a daemon thread, returns the thread"""
+
+        thread = threading.Thread(target=self.build, name="IndexManager", daemon=True)
+        thread.start()
+        return thread
+
+    def unused(self):
+        """
+        Lists the (table, index name) pairs which have not been used since the server started,
+        or None if index statistics are not available.
+        """
+
+        ret = []
+        try:
+            for table in self._indexes:
+                for stats in self._database[table].aggregate([{"$indexStats": {}}]):
+                    if (stats["name"] != "_id_") and (stats["accesses"]["ops"] == 0):
+                        ret.append((table, stats["name"]))
+        except (pymongo.errors.OperationFailure, NotImplementedError):
+            return None
+
+        return ret
+
+    def explain(self):
+        """
+        Explains the hot queries.
+
+        Returns
+        -------
+        list of dict
+            The name, table, plan stages, and used indexes of each query. Queries
+            whose plan holds a COLLSCAN stage are flagged with "collscan".
+        """
+
+        ret = []
+        for name, table, query, sort in self._queries:
+            cursor = self._database[table].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            stages = _plan_stages(plan)
+            ret.append({
+                "name": name,
+                "table": table,
+                "stages": [x[0] for x in stages],
+                "indexes": [x[1] for x in stages if x[1] is not None],
+                "collscan": any(x[0] == "COLLSCAN" for x in stages)
+            })
+
+        return ret
+
+    def check(self):
+        """
+        Audits the indexes of the database.
+
+        Returns
+        -------
+        dict
+            "missing" lists the declared indexes which do not exist, "unused" lists the
+            indexes without accesses, and "queries" holds the explained hot queries
+        """
+
+        return {
+            "missing": [(table, index["fields"]) for table, index in self.missing()],
+            "unused": self.unused(),
+            "queries": self.explain()
+        }
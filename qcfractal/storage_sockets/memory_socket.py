@@ -0,0 +1,2213 @@
+"""
+In-memory Database class that mirrors the MongoengineSocket without a running database
+"""
+
+import collections
+import copy
+import datetime
+import logging
+import threading
+from typing import List, Union, Dict
+
+import bcrypt
+import bson
+import bson.errors
+import pandas as pd
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+from . import storage_utils
+# Pull in the hashing algorithms from the client
+from .. import interface
+
+UpdateResult = collections.namedtuple("UpdateResult", ["matched_count", "modified_count", "upserted_id"])
+DeleteResult = collections.namedtuple("DeleteResult", ["deleted_count"])
+
+
+def _translate_id_index(index):
+    if index in ["id", "ids"]:
+        return "_id"
+    else:
+        raise KeyError("Id Index alias '{}' not understood".format(index))
+
+
+def _str_to_indices(ids):
+    for num, x in enumerate(ids):
+        if isinstance(x, str):
+            ids[num] = ObjectId(x)
+
+
+def _str_to_indices_with_errors(ids):
+    if isinstance(ids, (str, ObjectId)):
+        ids = [ids]
+
+    good = []
+    bad = []
+    for x in ids:
+        if isinstance(x, str):
+            try:
+                good.append(ObjectId(x))
+            except bson.errors.InvalidId:
+                bad.append(x)
+        elif isinstance(x, ObjectId):
+            good.append(x)
+        else:
+            bad.append(x)
+    return good, bad
+
+
+def _copy(doc):
+    """Copies a document through BSON so that stored documents look exactly like MongoDB documents"""
+    return bson.BSON.encode(doc).decode()
+
+
+def _hashable(value):
+    """Builds an index key from a document value"""
+    if isinstance(value, dict):
+        return tuple((k, _hashable(v)) for k, v in sorted(value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    else:
+        return value
+
+
+_missing = object()
+
+_result_required = ("program", "driver", "method", "molecule", "status")
+_result_status = ("COMPLETE", "INCOMPLETE", "ERROR")
+
+
+def _validate_result(doc):
+    """Returns why a result document is invalid or None if it is valid"""
+
+    missing = [k for k in _result_required if doc.get(k) is None]
+    if missing:
+        return "Missing required fields: {}".format(", ".join(missing))
+
+    if doc["status"] not in _result_status:
+        return "Status '{}' is not one of {}".format(doc["status"], ", ".join(_result_status))
+
+    return None
+
+
+def _get_field(doc, key):
+    for k in key.split("."):
+        if not isinstance(doc, dict) or (k not in doc):
+            return _missing
+        doc = doc[k]
+    return doc
+
+
+def _set_field(doc, key, value):
+    keys = key.split(".")
+    for k in keys[:-1]:
+        doc = doc.setdefault(k, {})
+    doc[keys[-1]] = value
+
+
+def _equals(value, target):
+    # Missing fields match None, array fields match any of their elements
+    if value is _missing:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, (list, tuple)):
+        return target in value
+    if isinstance(target, tuple):
+        target = list(target)
+    return value == target
+
+
+def _compare(op):
+    def func(value, target):
+        if (value is _missing) or (value is None):
+            return False
+        try:
+            return op(value, target)
+        except TypeError:
+            return False
+
+    return func
+
+
+_operators = {
+    "$in": lambda value, target: any(_equals(value, x) for x in target),
+    "$nin": lambda value, target: not any(_equals(value, x) for x in target),
+    "$ne": lambda value, target: not _equals(value, target),
+    "$exists": lambda value, target: (value is not _missing) == bool(target),
+    "$lt": _compare(lambda value, target: value < target),
+    "$lte": _compare(lambda value, target: value <= target),
+    "$gt": _compare(lambda value, target: value > target),
+    "$gte": _compare(lambda value, target: value >= target),
+}
+
+
+def _is_operator(cond):
+    return isinstance(cond, dict) and len(cond) > 0 and all(k.startswith("$") for k in cond)
+
+
+def _match(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_match(doc, q) for q in cond):
+                return False
+            continue
+
+        value = _get_field(doc, key)
+        if _is_operator(cond):
+            if not all(_operators[op](value, target) for op, target in cond.items()):
+                return False
+        elif not _equals(value, cond):
+            return False
+
+    return True
+
+
+def _project(doc, projection):
+    if projection is None:
+        return doc
+
+    if not isinstance(projection, dict):
+        projection = {k: True for k in projection}
+
+    # Inclusion projections keep the _id unless explicitly removed
+    if any(projection.values()):
+        keep = {k for k, v in projection.items() if v}
+        if projection.get("_id", True):
+            keep.add("_id")
+        return {k: v for k, v in doc.items() if k in keep}
+    else:
+        return {k: v for k, v in doc.items() if projection.get(k, True)}
+
+
+def _sort_docs(docs, sort):
+    """Sorts documents by a list of (field, direction) pairs"""
+    for key, direction in reversed(sort):
+
+        # None and missing fields sort first, as in MongoDB
+        def sort_key(doc):
+            value = _get_field(doc, key)
+            if value is _missing or value is None:
+                return (0, 0)
+            return (1, value)
+
+        docs = sorted(docs, key=sort_key, reverse=(direction < 0))
+    return docs
+
+
+def _apply_update(doc, update, insert=False):
+    """Applies MongoDB style update operators to a document in place"""
+    for op, fields in update.items():
+        if op == "$set":
+            for k, v in fields.items():
+                _set_field(doc, k, v)
+        elif op == "$setOnInsert":
+            if insert:
+                for k, v in fields.items():
+                    _set_field(doc, k, v)
+        elif op == "$unset":
+            for k in fields:
+                keys = k.split(".")
+                parent = _get_field(doc, ".".join(keys[:-1])) if len(keys) > 1 else doc
+                if isinstance(parent, dict):
+                    parent.pop(keys[-1], None)
+        elif op == "$inc":
+            for k, v in fields.items():
+                value = _get_field(doc, k)
+                _set_field(doc, k, v if value is _missing else value + v)
+        elif op == "$push":
+            for k, v in fields.items():
+                value = _get_field(doc, k)
+                value = [] if value is _missing else value
+                if isinstance(v, dict) and ("$each" in v):
+                    value.extend(v["$each"])
+                else:
+                    value.append(v)
+                _set_field(doc, k, value)
+        else:
+            raise KeyError("Update operator '{}' not understood.".format(op))
+
+
+class MemoryTable:
+    """
+    A dict-backed table of documents with hash indices.
+
+    Documents are stored by their ObjectId. Every indexed field keeps a
+    {value: set of ids} map so that equality and $in queries only look at
+    matching documents, a unique key tuple can be enforced on top.
+    """
+
+    def __init__(self, name, index_fields=(), unique_fields=None, lock=None):
+
+        self.name = name
+        self._lock = lock or threading.RLock()
+
+        self._docs = {}
+        self._indices = {field: collections.defaultdict(set) for field in index_fields}
+        self._unique_fields = tuple(unique_fields) if unique_fields else None
+        self._unique = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _index_values(self, doc, field):
+        value = _get_field(doc, field)
+        if value is _missing:
+            return [None]
+        values = [_hashable(value)]
+
+        # Multikey index, array fields are indexed by each of their elements
+        if isinstance(value, list):
+            values.extend(_hashable(x) for x in value)
+        return values
+
+    def _unique_key(self, doc):
+        ret = []
+        for field in self._unique_fields:
+            value = _get_field(doc, field)
+            ret.append(None if value is _missing else _hashable(value))
+        return tuple(ret)
+
+    def _add_index(self, doc):
+        for field, index in self._indices.items():
+            for value in self._index_values(doc, field):
+                index[value].add(doc["_id"])
+
+        if self._unique_fields:
+            self._unique[self._unique_key(doc)] = doc["_id"]
+
+    def _remove_index(self, doc):
+        for field, index in self._indices.items():
+            for value in self._index_values(doc, field):
+                index[value].discard(doc["_id"])
+                if len(index[value]) == 0:
+                    del index[value]
+
+        if self._unique_fields:
+            self._unique.pop(self._unique_key(doc), None)
+
+    def _check_unique(self, doc):
+        if self._unique_fields is None:
+            return
+
+        found = self._unique.get(self._unique_key(doc), doc["_id"])
+        if found != doc["_id"]:
+            raise KeyError("Duplicate key {} in table '{}'.".format(self._unique_key(doc), self.name))
+
+    def _candidates(self, query):
+        """Narrows a query down to a set of ids with the hash indices"""
+
+        ids = None
+        for key, cond in query.items():
+            if (key != "_id") and (key not in self._indices):
+                continue
+
+            if _is_operator(cond):
+                if set(cond) != {"$in"}:
+                    continue
+                values = cond["$in"]
+            else:
+                values = [cond]
+
+            if key == "_id":
+                found = {x for x in values if isinstance(x, ObjectId) and (x in self._docs)}
+            else:
+                index = self._indices[key]
+                found = set()
+                for value in values:
+                    found |= index.get(_hashable(value), set())
+
+            ids = found if ids is None else (ids & found)
+
+        # ObjectId's are monotonic so sorting keeps the insertion order
+        if ids is None:
+            return list(self._docs.keys())
+        else:
+            return sorted(ids)
+
+    @staticmethod
+    def _residual(query):
+        """The part of a query which the candidates do not already match"""
+
+        # The candidates already match their ids exactly, large id lists are not matched again
+        if ("_id" in query) and ((not _is_operator(query["_id"])) or (set(query["_id"]) == {"$in"})):
+            return {k: v for k, v in query.items() if k != "_id"}
+        return query
+
+    def _find_ids(self, query, sort=None, limit=0):
+        query = query or {}
+
+        residual = self._residual(query)
+        ids = [x for x in self._candidates(query) if _match(self._docs[x], residual)]
+
+        if sort:
+            ids = [x["_id"] for x in _sort_docs([self._docs[x] for x in ids], sort)]
+
+        if limit:
+            ids = ids[:limit]
+
+        return ids
+
+    def insert_one(self, doc):
+        """Inserts a document, an ObjectId is added to `doc` if it does not have one.
+
+        Raises a KeyError for duplicate ids or unique keys.
+        """
+
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+
+        with self._lock:
+            if doc["_id"] in self._docs:
+                raise KeyError("Duplicate id {} in table '{}'.".format(doc["_id"], self.name))
+
+            doc = _copy(doc)
+            self._check_unique(doc)
+            self._docs[doc["_id"]] = doc
+            self._add_index(doc)
+
+        return doc["_id"]
+
+    def find(self, query=None, projection=None, limit=0, sort=None):
+        """Returns copies of all documents matching a MongoDB style query"""
+
+        with self._lock:
+            ids = self._find_ids(query, sort=sort, limit=limit)
+            return [_project(_copy(self._docs[x]), projection) for x in ids]
+
+    def iter_find(self, query=None, projection=None, batch_size=1000):
+        """Yields copies of all documents matching a MongoDB style query in insertion order. Documents
+        are matched and copied `batch_size` at a time, documents removed in between are skipped."""
+
+        query = query or {}
+        residual = self._residual(query)
+        with self._lock:
+            ids = self._candidates(query)
+
+        for start in range(0, len(ids), batch_size):
+            with self._lock:
+                docs = [self._docs.get(x, None) for x in ids[start:start + batch_size]]
+                batch = [_project(_copy(x), projection) for x in docs if (x is not None) and _match(x, residual)]
+
+            yield from batch
+
+    def find_one(self, query=None, projection=None):
+        found = self.find(query, projection=projection, limit=1)
+        if len(found):
+            return found[0]
+        else:
+            return None
+
+    def count(self, query=None):
+        with self._lock:
+            return len(self._find_ids(query))
+
+    def _update(self, query, update, upsert=False, multi=True):
+        matched = 0
+        modified = 0
+        upserted_id = None
+
+        with self._lock:
+            ids = self._find_ids(query, limit=0 if multi else 1)
+            for x in ids:
+                old = self._docs[x]
+                new = _copy(old)
+                _apply_update(new, update)
+                new = _copy(new)
+                matched += 1
+
+                if new == old:
+                    continue
+
+                self._remove_index(old)
+                try:
+                    self._check_unique(new)
+                except KeyError:
+                    self._add_index(old)
+                    raise
+
+                self._docs[x] = new
+                self._add_index(new)
+                modified += 1
+
+            if upsert and (matched == 0):
+                doc = {k: v for k, v in query.items() if not (k.startswith("$") or _is_operator(v))}
+                _apply_update(doc, update, insert=True)
+                upserted_id = self.insert_one(doc)
+
+        return UpdateResult(matched, modified, upserted_id)
+
+    def update_one(self, query, update, upsert=False):
+        return self._update(query, update, upsert=upsert, multi=False)
+
+    def update_many(self, query, update, upsert=False):
+        return self._update(query, update, upsert=upsert, multi=True)
+
+    def replace_one(self, query, doc):
+        with self._lock:
+            ids = self._find_ids(query, limit=1)
+            if len(ids) == 0:
+                return UpdateResult(0, 0, None)
+
+            old = self._docs[ids[0]]
+            new = _copy(doc)
+            new["_id"] = old["_id"]
+
+            self._remove_index(old)
+            try:
+                self._check_unique(new)
+            except KeyError:
+                self._add_index(old)
+                raise
+
+            self._docs[new["_id"]] = new
+            self._add_index(new)
+
+        return UpdateResult(1, int(new != old), None)
+
+    def delete_many(self, query):
+        with self._lock:
+            ids = self._find_ids(query)
+            for x in ids:
+                self._remove_index(self._docs.pop(x))
+
+        return DeleteResult(len(ids))
+
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            self._unique.clear()
+            for index in self._indices.values():
+                index.clear()
+
+
+class MemorySocket:
+    """
+        In-memory QCDB wrapper class with the MongoengineSocket API.
+
+        Each table keeps hash indices on the same keys as the MongoDB tables,
+        all data is lost when the socket is closed.
+    """
+
+    def __init__(self, uri=None, project="molssidb", bypass_security=False, logger=None, max_limit=1000):
+        """
+        Constructs a new in-memory socket, the uri is not used.
+
+        """
+
+        # Logging data
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger('MemorySocket')
+
+        # Security
+        self._bypass_security = bypass_security
+
+        # Static data
+        self._table_indices = {
+            "collections": interface.schema.get_table_indices("collection"),
+            "options": interface.schema.get_table_indices("options"),
+            "results": interface.schema.get_table_indices("result"),
+            "molecules": interface.schema.get_table_indices("molecule"),
+            "procedures": interface.schema.get_table_indices("procedure"),
+            "service_queue": interface.schema.get_table_indices("service_queue"),
+            "task_queue": interface.schema.get_table_indices("task_queue"),
+            "task_queue_archive": ("status", "base_result"),
+            "users": ("username", ),
+            "queue_managers": ("name", )
+        }
+        self._valid_tables = set(self._table_indices.keys())
+
+        # Unique keys match the unique indices of the MongoDB models
+        self._table_unique_indices = {
+            "collections": ("collection", "name"),
+            "options": ("program", "name"),
+            "results": self._table_indices["results"],
+            "task_queue": ("base_result", ),
+            "users": ("username", ),
+            "queue_managers": ("name", ),
+        }
+
+        # Additional lookups which are not part of the table keys
+        self._table_extra_indices = {
+            "procedures": ("hash_index", "status"),
+            "results": ("status", ),
+            "queue_managers": ("tag", )
+        }
+
+        self._lower_results_index = ["method", "basis", "options", "program"]
+
+        self._queue_order = [("priority", -1), ("created_on", 1)]
+
+        # Seconds a manager holds a claimed task without renewing it before it is requeued
+        self._queue_lease_time = 600
+
+        # Finished tasks are moved from the task queue to the task archive
+        self._archive_status = ["COMPLETE", "ERROR"]
+
+        self._project_name = project
+        self._max_limit = max_limit
+
+        # Batched writes and queue claims must see a consistent view of the tables
+        self._lock = self._build_lock()
+
+        self._tables = {}
+        for table, indices in self._table_indices.items():
+            indices = tuple(indices) + self._table_extra_indices.get(table, ())
+            self._tables[table] = self._build_table(table, indices, self._table_unique_indices.get(table))
+
+    def _build_lock(self):
+        return threading.RLock()
+
+    def _build_table(self, name, index_fields, unique_fields):
+        return MemoryTable(name, index_fields=index_fields, unique_fields=unique_fields, lock=self._lock)
+
+    ### Meta functions
+
+    def __str__(self):
+        return "<MemorySocket: project='{0:s}'>".format(str(self._project_name))
+
+    def init_database(self):
+        """
+        Builds out the initial project structure, all tables are created on construction.
+        """
+        return {}
+
+    def _clear_db(self, db_name: str):
+        """Dangerous, make sure you are deleting the right DB"""
+
+        if db_name == self._project_name:
+            logging.info('Clearing database: {}'.format(db_name))
+            for table in self._tables.values():
+                table.drop()
+
+    def get_project_name(self):
+        return self._project_name
+
+    def mixed_molecule_get(self, data):
+        return storage_utils.mixed_molecule_get(self, data)
+
+    def _add_generic(self, data, table, return_map=True):
+        """
+        Helper function that facilitates adding a record.
+        """
+
+        meta = {"errors": [], "n_inserted": 0, "success": False, "duplicates": [], "error_description": False}
+
+        if len(data) == 0:
+            ret = {}
+            meta["success"] = True
+            ret["meta"] = meta
+            ret["data"] = {}
+            return ret
+
+        error_skips = set()
+        with self._lock:
+            for num, d in enumerate(data):
+                try:
+                    self._tables[table].insert_one(d)
+                    meta["n_inserted"] += 1
+                except KeyError:
+                    meta["duplicates"].append(tuple(d.get(key) for key in self._table_indices[table]))
+                    error_skips.add(num)
+
+        # Only duplicates, no true errors
+        meta["success"] = True
+        if len(error_skips):
+            meta["error_description"] = "Found duplicates"
+
+        # Convert id in-place
+        for d in data:
+            d["id"] = str(d["_id"])
+            del d["_id"]
+
+        # Add id's of new keys
+        rdata = []
+        if return_map:
+            for x in range(len(data)):
+                if x in error_skips:
+                    rdata.append(None)
+                else:
+                    rdata.append(data[x]["id"])
+
+        ret = {"data": rdata, "meta": meta}
+
+        return ret
+
+    def _del_by_index(self, table, hashes, index="_id"):
+        """
+        Helper function that facilitates deletion based on hash.
+        """
+
+        if isinstance(hashes, str):
+            hashes = [hashes]
+
+        if index == "_id":
+            _str_to_indices(hashes)
+
+        return self._tables[table].delete_many({index: {"$in": hashes}}).deleted_count
+
+    def _get_generic(self, query, table, projection=None, allow_generic=False, limit=0, cursor=None):
+
+        meta = storage_utils.get_metadata()
+
+        data = []
+
+        # Assume we want to lookup via unique key tuple, all tuples are found with a single query
+        if isinstance(query, (tuple, list)):
+            keys = self._table_indices[table]
+            data = storage_utils.find_unique_keys(self._tables[table], keys, query, projection=projection, meta=meta)
+
+        elif isinstance(query, dict):
+
+            query = self._translate_generic_query(query, meta)
+
+            # Limited queries are paged by _id, the continuation token resumes after the last document
+            sort = None
+            if limit or cursor:
+                sort = [("_id", 1)]
+
+            if cursor:
+                try:
+                    query = storage_utils.add_cursor_query(query, cursor)
+                except KeyError:
+                    meta["errors"].append(("Bad cursor", cursor))
+                    query = None
+
+            # One document past the page tells if there is a next page
+            data = []
+            if query is not None:
+                data = self._tables[table].find(query, projection=projection, limit=limit and limit + 1, sort=sort)
+
+            if limit and (len(data) > limit):
+                data = data[:limit]
+                meta["next_cursor"] = storage_utils.encode_cursor(data[-1]["_id"])
+        else:
+            meta["errors"] = "Malformed query"
+
+        meta["n_found"] = len(data)
+        if len(meta["errors"]) == 0:
+            meta["success"] = True
+
+        # Convert ID
+        for d in data:
+            d["id"] = str(d.pop("_id"))
+
+        ret = {"meta": meta, "data": data}
+        return ret
+
+    def _translate_generic_query(self, query, meta=None):
+        """Translates the "id" key to ObjectId's and list values to $in queries"""
+
+        # Handle specific ID query
+        if "id" in query:
+            ids, bad_ids = _str_to_indices_with_errors(query["id"])
+            if bad_ids and (meta is not None):
+                meta["errors"].append(("Bad Ids", bad_ids))
+
+            query["_id"] = ids
+            del query["id"]
+
+        for k, v in query.items():
+            if isinstance(v, (list, tuple)):
+                query[k] = {"$in": v}
+
+        return query
+
+    def _iter_generic(self, query, table, projection=None, batch_size=1000):
+
+        query = self._translate_generic_query(query)
+        for d in self._tables[table].iter_find(query, projection=projection, batch_size=batch_size):
+            d["id"] = str(d.pop("_id"))
+            yield d
+
+    def _doc_to_json(self, doc, with_ids=True, id_fields=()):
+        """Converts a stored document to MongoDB extended JSON and renames _id to id, or removes it altogether"""
+
+        if not doc:
+            return
+
+        return storage_utils.raw_to_json(doc, with_ids=with_ids, id_fields=id_fields)
+
+### Molecule functions
+
+    def add_molecules(self, data):
+        """
+        Adds molecules to the database.
+
+        Parameters
+        ----------
+        data : dict of molecule-like JSON objects
+            A {key: molecule} dictionary of molecules to input.
+
+        Returns
+        -------
+        bool
+            Whether the operation was successful.
+        """
+
+        # Build a dictionary of new molecules
+        new_mols = {}
+        for key, dmol in data.items():
+            mol = interface.Molecule(dmol, dtype="json", orient=False)
+            new_mols[key] = mol
+
+        new_kv_hash = {k: v.get_hash() for k, v in new_mols.items()}
+        new_vk_hash = collections.defaultdict(list)
+        for k, v in new_kv_hash.items():
+            new_vk_hash[v].append(k)
+
+        # We need to filter out what is already in the database
+        old_mols = self.get_molecules(list(new_kv_hash.values()), index="hash")["data"]
+
+        # If we have hash matches check to for duplicates
+        key_mapper = {}
+        for old_mol in old_mols:
+
+            # This is the user provided key
+            new_mol_keys = new_vk_hash[old_mol["identifiers"]["molecule_hash"]]
+            new_mol = new_mols[new_mol_keys[0]]
+
+            if new_mol.compare(old_mol):
+                for x in new_mol_keys:
+                    del new_mols[x]
+                    key_mapper[x] = old_mol["id"]
+            else:
+                raise KeyError("!!! WARNING !!!: Hash collision detected")
+
+        # Carefully make this flat
+        new_hashes = set()
+        new_inserts = []
+        for new_key, new_mol in new_mols.items():
+            data = new_mol.to_json()
+            data["identifiers"] = {}
+
+            # Build new molecule hash
+            data["molecule_hash"] = new_mol.get_hash()
+            data["identifiers"]["molecule_hash"] = data["molecule_hash"]
+
+            if data["molecule_hash"] in new_hashes:
+                continue
+
+            # Build chemical identifiers
+            data["identifiers"]["molecular_formula"] = new_mol.get_molecular_formula()
+            data["molecular_formula"] = data["identifiers"]["molecular_formula"]
+
+            new_hashes.add(data["molecule_hash"])
+            new_inserts.append(data)
+
+        ret = self._add_generic(new_inserts, "molecules", return_map=True)
+        ret["meta"]["duplicates"].extend(list(key_mapper.keys()))
+        ret["meta"]["validation_errors"] = []
+
+        # Add the new keys to the key map
+        for mol in new_inserts:
+            for x in new_vk_hash[mol["molecule_hash"]]:
+                key_mapper[x] = mol["id"]
+
+        ret["data"] = key_mapper
+
+        return ret
+
+    def get_molecules(self, molecule_ids, index="id", projection=None):
+        """
+        Gets molecules from the database.
+
+        Parameters
+        ----------
+        molecule_ids : str or list of strs
+            The keys of the molecules
+        index : str, optional
+            The key type, "id", "molecule_hash", or "molecular_formula"
+        projection : list of str, optional
+            Only return these fields of the molecules and their id
+
+        Returns
+        -------
+        dict
+            The molecules in "data" and the query metadata in "meta"
+        """
+
+        ret = {"meta": storage_utils.get_metadata(), "data": []}
+
+        try:
+            index = storage_utils.translate_molecule_index(index)
+        except KeyError as e:
+            ret["meta"]["error_description"] = repr(e)
+            return ret
+
+        if not isinstance(molecule_ids, (list, tuple)):
+            molecule_ids = [molecule_ids]
+
+        bad_ids = []
+        if index == "_id":
+            molecule_ids, bad_ids = _str_to_indices_with_errors(molecule_ids)
+
+        # Project out the duplicates we use for top level keys
+        if projection is None:
+            proj = {"molecule_hash": False, "molecular_formula": False}
+        else:
+            proj = {k: True for k in projection}
+
+        data = self._tables["molecules"].find({index: {"$in": molecule_ids}}, projection=proj)
+
+        ret["meta"]["success"] = True
+        ret["meta"]["n_found"] = len(data)
+        if len(bad_ids):
+            ret["meta"]["errors"].append(("Bad Ids", bad_ids))
+
+        # Translate ID's back
+        for r in data:
+            r["id"] = str(r.pop("_id"))
+
+        ret["data"] = data
+
+        return ret
+
+    def del_molecules(self, values, index="id"):
+        """
+        Removes a molecule from the database from its hash.
+
+        Parameters
+        ----------
+        values : str or list of strs
+            The hash of a molecule.
+
+        Returns
+        -------
+        int
+            The number of deleted molecules.
+        """
+
+        index = storage_utils.translate_molecule_index(index)
+
+        return self._del_by_index("molecules", values, index=index)
+
+### Options functions
+
+    def add_options(self, data: Union[Dict, List[Dict]]):
+        """Add one option uniqely identified by 'program' and the 'name'.
+
+        Parameters
+        ----------
+         data : dict or List[dict]
+            The attribites of the 'option' or options to be inserted.
+            Must include for each 'option':
+                program : str, program name
+                name : str, option name
+
+        Returns
+        -------
+            A dict with keys: 'data' and 'meta'
+            (see storage_utils.add_metadata())
+            The 'data' part is a list of ids of the inserted options
+            data['duplicates'] has the duplicate entries
+
+        Notes
+        ------
+            Duplicates are not considered errors.
+
+        """
+
+        if isinstance(data, dict):
+            data = [data]
+
+        meta = storage_utils.add_metadata()
+        keys = self._table_indices["options"]
+
+        options = []
+        try:
+            for d in data:
+                for k in keys:
+                    if not isinstance(d[k], str):
+                        raise KeyError("Option field '{}' must be a string.".format(k))
+
+                doc = dict(d)
+                try:
+                    options.append(str(self._tables["options"].insert_one(doc)))
+                    meta['n_inserted'] += 1
+                except KeyError:
+                    meta['duplicates'].append(tuple(str(d[k]) for k in keys))
+            meta["success"] = True
+        except KeyError as err:
+            meta["validation_errors"].append(err)
+        except Exception as err:
+            meta['error_description'] = err
+
+        ret = {"data": options, "meta": meta}
+        return ret
+
+    def get_options(self, program: str=None, name: str=None, return_json: bool=True,
+                    with_ids: bool=True, limit=None):
+        """Search for one (unique) option based on the 'program'
+        and the 'name'. No overwrite allowed.
+
+        Parameters
+        ----------
+        program : str or list of tuples
+            program name, or a list of (program, name) tuples which are found with a single query
+        name : str
+            option name
+        return_json : bool, optional
+            Return the results as a json object
+            Default is True
+        with_ids : bool, optional
+            Include the DB ids in the returned object (names 'id')
+            Default is True
+        limit : int, optional
+            Maximum number of resaults to return.
+            If this number is greater than the socket's max_limit then
+            the max_limit will be returned instead.
+            Default is to return the socket's max_limit (when limit=None or 0)
+
+        Returns
+        -------
+            A dict with keys: 'data' and 'meta'
+            (see storage_utils.get_metadata())
+            The 'data' part is an object of the result or None if not found
+        """
+
+        if isinstance(program, list) and all(isinstance(x, (list, tuple)) for x in program):
+            ret = self._get_generic(program, "options")
+            if not with_ids:
+                for d in ret["data"]:
+                    del d["id"]
+            return ret
+
+        meta = storage_utils.get_metadata()
+        query = {}
+        if program:
+            query['program'] = program
+        if name:
+            query['name'] = name
+        q_limit = limit if limit and limit < self._max_limit else self._max_limit
+
+        data = self._tables["options"].find(query)
+        meta["n_found"] = len(data)
+        meta["success"] = True
+
+        data = data[:q_limit]
+        if return_json:
+            rdata = [self._doc_to_json(d, with_ids) for d in data]
+        else:
+            rdata = data
+
+        return {"data": rdata, "meta": meta}
+
+    def del_option(self, program, name):
+        """
+        Removes a option set from the database based on its keys.
+
+        Parameters
+        ----------
+        program : str
+            The program of the option set
+        name : str
+            The name of the option set
+
+        Returns
+        -------
+        int
+           number of deleted documents
+        """
+
+        return self._tables["options"].delete_many({"program": program, "name": name}).deleted_count
+
+### Collection functions
+
+    def add_collection(self, collection: str, name: str, data, overwrite: bool=False):
+        """Add (or update) a collection to the database.
+
+        Parameters
+        ----------
+        collection : str
+        name : str
+        data : dict
+        overwrite : bool
+            Update existing collection
+
+        Returns
+        -------
+        A dict with keys: 'data' and 'meta'
+            (see storage_utils.add_metadata())
+            The 'data' part is the id of the inserted document or none
+
+        Notes
+        -----
+        ** Change: The data doesn't have to include the ID, the document
+        is identified by the (collection, name) pairs.
+        ** Change: New fields will be added to the collection, but existing won't
+            be removed.
+        """
+
+        meta = storage_utils.add_metadata()
+        col_id = None
+        try:
+
+            if ("id" in data) and (data["id"] == "local"):
+                del data["id"]
+
+            doc = {k: v for k, v in data.items() if k != "id"}
+            doc.update({"collection": collection, "name": name})
+
+            table = self._tables["collections"]
+            if overwrite:
+                table.update_one({"collection": collection, "name": name}, {"$set": doc})
+                col_id = table.find_one({"collection": collection, "name": name}, projection={"_id": True})["_id"]
+            else:
+                col_id = table.insert_one(doc)
+
+            meta['success'] = True
+            meta['n_inserted'] = 1
+            col_id = str(col_id)
+        except Exception as err:
+            meta['error_description'] = str(err)
+
+        ret = {'data': col_id, 'meta': meta}
+        return ret
+
+    def get_collections(self, collection: str=None, name: str=None, return_json: bool=True,
+                        with_ids: bool=True, limit: int=None):
+        """Get collection by collection and/or name
+
+        Parameters
+        ----------
+        collection : str, optional
+        name : str, optional
+        return_json : bool
+        with_ids : bool
+        limit : int
+
+        Returns
+        -------
+        A dict with keys: 'data' and 'meta'
+            The data is a list of the collections found
+        """
+
+        meta = storage_utils.get_metadata()
+        query = {}
+        if collection:
+            query['collection'] = collection
+        if name:
+            query['name'] = name
+        q_limit = limit if limit and limit < self._max_limit else self._max_limit
+
+        data = self._tables["collections"].find(query)
+        meta["n_found"] = len(data)
+        meta["success"] = True
+
+        data = data[:q_limit]
+        if return_json:
+            rdata = [self._doc_to_json(d, with_ids) for d in data]
+        else:
+            rdata = data
+
+        return {"data": rdata, "meta": meta}
+
+    def del_collection(self, collection: str, name: str):
+        """
+        Remove a collection from the database from its keys.
+
+        Parameters
+        ----------
+        collection: str
+            Collection type
+        name : str
+            Collection name
+
+        Returns
+        -------
+        int
+            Number of documents deleted
+        """
+
+        return self._tables["collections"].delete_many({"collection": collection, "name": name}).deleted_count
+
+### Results functions
+
+    def add_results(self, data: List[dict], update_existing: bool=False, return_json=True):
+        """
+        Add results from a given dict. The dict should have all the required
+        keys of a result.
+
+        Parameters
+        ----------
+        data : list of dict
+            Each dict must have:
+            program, driver, method, basis, options, molecule
+            Where molecule is the molecule id in the DB
+            In addition, it should have the other attributes that it needs
+            to store
+        update_existing : bool (default False)
+            Update existing results
+
+        Returns
+        -------
+            Dict with keys: data, meta
+            Data is the ids of the inserted/updated/existing docs, in the
+            same order as the input. Errored entries have 'None' as their id.
+        """
+
+        meta = storage_utils.add_metadata()
+
+        if len(data) == 0:
+            meta["success"] = True
+            return {"data": [], "meta": meta}
+
+        for d in data:
+            for i in self._lower_results_index:
+                if d.get(i) is None:
+                    continue
+
+                d[i] = d[i].lower()
+
+            if ("molecule" in d) and not isinstance(d['molecule'], ObjectId):
+                d['molecule'] = ObjectId(d['molecule'])
+
+        keys = self._table_indices["results"]
+        table = self._tables["results"]
+
+        results = []
+        with self._lock:
+            for d in data:
+                if (not update_existing) and (not d.get("status")):
+                    d["status"] = "INCOMPLETE"
+
+                # Mirrors the required fields and status choices of the Result model
+                error = _validate_result({"status": "INCOMPLETE", **d})
+                if error:
+                    meta["validation_errors"].append((tuple(str(d.get(k)) for k in keys), error))
+                    results.append(None)
+                    continue
+
+                key = {k: d.get(k) for k in keys}
+                if update_existing:
+                    upd = table.update_one(key, storage_utils.result_upsert(d), upsert=True)
+                    if upd.upserted_id is None:
+                        results.append(str(table.find_one(key, projection={"_id": True})["_id"]))
+                    else:
+                        results.append(str(upd.upserted_id))
+                        meta['n_inserted'] += 1
+                    continue
+
+                try:
+                    results.append(str(table.insert_one(d)))
+                    meta['n_inserted'] += 1
+                except KeyError:
+                    meta['duplicates'].append(tuple(str(d[k]) for k in keys))
+                    results.append(str(table.find_one(key, projection={"_id": True})["_id"]))
+                d.pop("_id", None)
+
+        meta["success"] = len(meta["validation_errors"]) == 0
+
+        ret = {"data": results, "meta": meta}
+        return ret
+
+    def get_results_by_ids(self, ids: List[str]=None, projection=None, return_json=True,
+                           with_ids=True):
+        """
+        Get list of Results using the given list of Ids
+
+        Parameters
+        ----------
+        ids : List of str
+            Ids of the results in the DB
+        projection : list/set/tuple of keys, default is None
+            The fields to return, default to return all
+        return_json : bool, default is True
+            Return the results as a list of json inseated of objects
+        with_ids: bool, default is True
+            Include the ids in the returned objects/dicts
+
+        Returns
+        -------
+        Dict with keys: data, meta
+            Data is the objects found
+        """
+
+        meta = storage_utils.get_metadata()
+
+        ids, bad_ids = _str_to_indices_with_errors(ids or [])
+        if bad_ids:
+            meta["errors"].append(("Bad Ids", bad_ids))
+
+        data = self._tables["results"].find({"_id": {"$in": ids}}, projection=projection)
+        meta["n_found"] = len(data)
+        meta["success"] = True
+
+        data = data[:self._max_limit]
+        if return_json:
+            rdata = [self._doc_to_json(d, with_ids, id_fields=("molecule", )) for d in data]
+        else:
+            rdata = data
+
+        return {"data": rdata, "meta": meta}
+
+    def get_results_count(self):
+        """
+        TODO: just return the count, used for big queries
+
+        Returns
+        -------
+
+        """
+        pass
+
+    def get_results(self,
+                    program: str=None,
+                    method: str=None,
+                    basis: str=None,
+                    molecule: str=None,
+                    driver: str=None,
+                    options: str=None,
+                    status: str='COMPLETE',
+                    projection=None,
+                    limit: int=None,
+                    skip: int=None,
+                    return_json=True,
+                    with_ids=True,
+                    cursor: str=None):
+        """
+
+        Parameters
+        ----------
+        program : str
+        method : str
+        basis : str
+        molecule : str
+            Molecule id in the DB
+        driver : str
+        options : str
+            The id of the option in the DB
+        status : bool, default is 'COMPLETE'
+            The status of the result: 'COMPLETE', 'INCOMPLETE', or 'ERROR'
+        projection : list/set/tuple of keys, default is None
+            The fields to return, default to return all
+        limit : int, default is None
+            maximum number of results to return
+            if 'limit' is greater than the global setting self._max_limit,
+            the self._max_limit will be returned instead
+            (This is to avoid overloading the server)
+        skip : int, default is None TODO
+            skip the first 'skip' resaults. Used to paginate
+        return_json : bool, deafult is True
+            Return the results as a list of json inseated of objects
+        with_ids : bool, default is True
+            Include the ids in the returned objects/dicts
+        cursor : str, default is None
+            The continuation token of the previous page, results are ordered by their
+            id and meta["next_cursor"] holds the token of the next page if there is one
+
+        Returns
+        -------
+        Dict with keys: data, meta
+            Data is the objects found
+        """
+
+        meta = storage_utils.get_metadata()
+        parsed_query = self._results_query(
+            program=program,
+            method=method,
+            basis=basis,
+            molecule=molecule,
+            driver=driver,
+            options=options,
+            status=status)
+
+        q_limit = limit if limit and limit < self._max_limit else self._max_limit
+
+        # Keyset pagination, the continuation token holds the last id of the previous page
+        if cursor:
+            try:
+                parsed_query["_id"] = {"$gt": storage_utils.decode_cursor(cursor)}
+            except KeyError as err:
+                meta['error_description'] = str(err)
+                return {"data": [], "meta": meta}
+
+        data = self._tables["results"].find(parsed_query, projection=projection, limit=q_limit + 1, sort=[("_id", 1)])
+        if len(data) > q_limit:
+            data = data[:q_limit]
+            meta["next_cursor"] = storage_utils.encode_cursor(data[-1]["_id"])
+
+        meta["n_found"] = len(data)
+        meta["success"] = True
+        if return_json:
+            rdata = [self._doc_to_json(d, with_ids, id_fields=("molecule", )) for d in data]
+        else:
+            rdata = data
+
+        return {"data": rdata, "meta": meta}
+
+    def _results_query(self, program=None, method=None, basis=None, molecule=None, driver=None, options=None,
+                       status='COMPLETE'):
+        """Builds the table query of get_results"""
+
+        query = {}
+        if program:
+            query['program'] = program
+        if method:
+            query['method'] = method
+        if basis:
+            query['basis'] = basis
+        if molecule:
+            query['molecule'], _ = _str_to_indices_with_errors(molecule)
+        if driver:
+            query['driver'] = driver
+        if options:
+            query['options'] = options
+        if status:
+            query['status'] = status
+
+        parsed_query = {}
+        for key, value in query.items():
+            if key == "molecule":
+                parsed_query[key] = {"$in": value}
+            elif key == "status":
+                parsed_query[key] = value
+            elif isinstance(value, (list, tuple)):
+                parsed_query[key] = {"$in": [v.lower() for v in value]}
+            else:
+                parsed_query[key] = value.lower()
+
+        return parsed_query
+
+    def iter_results(self,
+                     program: str=None,
+                     method: str=None,
+                     basis: str=None,
+                     molecule: str=None,
+                     driver: str=None,
+                     options: str=None,
+                     status: str='COMPLETE',
+                     id: List[str]=None,
+                     projection=None,
+                     with_ids=True,
+                     batch_size: int=1000):
+        """
+        Iterates over all Results matching the query of `get_results` or a list of ids. Results
+        are not capped at `max_limit`.
+
+        Parameters
+        ----------
+        id : List of str, optional
+            Ids of the results in the DB, all other query parameters are ignored if given
+        projection : list/set/tuple of keys, default is None
+            The fields to return, default to return all
+        with_ids : bool, default is True
+            Include the ids in the returned dicts
+        batch_size : int, default is 1000
+            The number of results which are read from the table at once
+
+        Yields
+        ------
+        dict
+            The JSON form of each Result
+        """
+
+        if id is not None:
+            ids, _ = _str_to_indices_with_errors(id)
+            parsed_query = {"_id": {"$in": ids}}
+        else:
+            parsed_query = self._results_query(
+                program=program,
+                method=method,
+                basis=basis,
+                molecule=molecule,
+                driver=driver,
+                options=options,
+                status=status)
+
+        for d in self._tables["results"].iter_find(parsed_query, projection=projection, batch_size=batch_size):
+            yield self._doc_to_json(d, with_ids, id_fields=("molecule", ))
+
+    def del_results(self, ids: List[str]):
+        """
+        Removes results from the database using their ids
+        (Should be cautious! other tables maybe referencing results)
+
+        Parameters
+        ----------
+        ids : list of str
+            The Ids of the results to be deleted
+
+        Returns
+        -------
+        int
+            number of results deleted
+        """
+
+        obj_ids = [ObjectId(x) for x in ids]
+
+        return self._tables["results"].delete_many({"_id": {"$in": obj_ids}}).deleted_count
+
+### Procedure/service functions
+
+    def add_procedures(self, data):
+
+        ret = self._add_generic(data, "procedures")
+        ret["meta"]["validation_errors"] = []  # TODO
+
+        return ret
+
+    def get_procedures(self, query, projection=None, limit=0, cursor=None):
+        """
+        Finds procedures matching the query. Queries with a `limit` are ordered by id, meta["next_cursor"]
+        holds the continuation token of the next page which is passed back as `cursor`.
+        """
+
+        return self._get_generic(
+            query, "procedures", allow_generic=True, projection=projection, limit=limit, cursor=cursor)
+
+    def iter_procedures(self, query, projection=None, batch_size=1000):
+        """
+        Iterates over all procedures matching the query without the `max_limit` cap.
+        """
+
+        return self._iter_generic(query, "procedures", projection=projection, batch_size=batch_size)
+
+    def update_procedure(self, hash_index, data):
+        """
+        This should be removed, temporary patch to make this more canonical
+        """
+
+        ret = self._tables["procedures"].update_one({"hash_index": hash_index}, {"$set": data})
+        return ret.modified_count
+
+    def update_procedures(self, data):
+        """
+        Updates several procedures at once, procedures are matched by their hash_index.
+
+        Parameters
+        ----------
+        data : list of dict
+            The new fields of each procedure, including its hash_index
+
+        Returns
+        -------
+        int
+            The number of modified procedures
+        """
+
+        table = self._tables["procedures"]
+
+        modified_count = 0
+        with self._lock:
+            for d in data:
+                modified_count += table.update_one({"hash_index": d["hash_index"]}, {"$set": d}).modified_count
+
+        return modified_count
+
+    def add_services(self, data):
+
+        ret = self._add_generic(data, "service_queue", return_map=True)
+        ret["meta"]["validation_errors"] = []  # TODO
+
+        # Right now services expect hash return
+        # This and bad and should be fixed
+        serv = self.get_services({"id": ret["data"]})
+        ret["data"] = [x["hash_index"] for x in serv["data"]]
+
+        # Means we have duplicates in the queue, massage results
+        if len(ret["meta"]["duplicates"]):
+            ret["meta"]["duplicates"] = [x[2] for x in ret["meta"]["duplicates"]]
+            ret["meta"]["error_description"] = False
+
+        return ret
+
+    def get_services(self, query, projection=None, limit=0):
+
+        return self._get_generic(query, "service_queue", projection=projection, allow_generic=True, limit=limit)
+
+    def update_services(self, updates):
+        """
+        Writes the new state of several services at once.
+
+        Parameters
+        ----------
+        updates : list of (id, dict) tuples
+            The service id with either the full service document, which replaces the
+            stored document, or an update document of operators such as $set and $unset
+            (see storage_utils.document_update). Empty updates are skipped.
+
+        Returns
+        -------
+        tuple
+            The number of matched and modified services
+        """
+
+        table = self._tables["service_queue"]
+
+        match_count = 0
+        modified_count = 0
+        with self._lock:
+            for uid, data in updates:
+                if storage_utils.is_update_document(data):
+                    result = table.update_one({"_id": ObjectId(uid)}, data)
+                elif len(data):
+                    result = table.replace_one({"_id": ObjectId(uid)}, data)
+                else:
+                    continue
+
+                match_count += result.matched_count
+                modified_count += result.modified_count
+
+        return (match_count, modified_count)
+
+    def del_services(self, values, index="id"):
+
+        index = _translate_id_index(index)
+
+        return self._del_by_index("service_queue", values, index=index)
+
+### Queue handling functions
+
+    def queue_submit(self, data: List[Dict]):
+        """Submit a list of tasks to the queue.
+        Tasks are unique by their base_result, which should be inserted into
+        the DB first before submitting it's corresponding task to the queue
+        (with result.status='INCOMPLETE' as the default)
+        The default task.status is 'WAITING'
+
+        Duplicate tasks sould be a rare case.
+        Hooks are merged if the task already exists
+
+        Parameters
+        ----------
+        data : list of tasks (dict)
+            A task is a dict, with the following fields:
+            - hash_index: idx, not used anymore
+            - spec: dynamic field (dict-like), can have any structure
+            - hooks: list of any objects representing listeners (for now)
+            - tag: str
+            - priority: int, higher priority tasks are served first (default 0)
+            - base_results: tuple (required), first value is the class type
+             of the result, {'results' or 'procedure'). The second value is
+             the ID of the result in the DB. Example:
+             "base_result": ('results', result_id)
+
+        Returns
+        -------
+        dict (data and meta)
+            'data' is a list of the IDs of the tasks IN ORDER, including
+            duplicates. An errored task has 'None' in its ID
+            meta['duplicates'] has the duplicate tasks
+        """
+
+        meta = storage_utils.add_metadata()
+        table = self._tables["task_queue"]
+
+        results = []
+        with self._lock:
+            for d in data:
+                try:
+                    if not isinstance(d['base_result'], tuple):
+                        raise Exception("base_result must be a tuple not {}."
+                                        .format(type(d['base_result'])))
+
+                    if d['base_result'][0] == 'results':
+                        base_result = {"_cls": "Result", "_ref": DBRef("results", ObjectId(d['base_result'][1]))}
+                    elif d['base_result'][0] == 'procedure':
+                        base_result = {"_cls": "Procedure", "_ref": DBRef("procedure", ObjectId(d['base_result'][1]))}
+                    else:
+                        raise TypeError("Base_result type must be 'results' or 'procedure',"
+                                        " {} is given.".format(d['base_result'][0]))
+
+                    if not isinstance(d.get("priority", 0), int):
+                        raise TypeError("Task priority must be an int, {} is given.".format(d["priority"]))
+                except Exception as err:
+                    meta["errors"].append(str(err))
+                    results.append(None)
+                    continue
+
+                # Mirror the defaults of the TaskQueue model, None values are not stored
+                now = datetime.datetime.now()
+                task = {"hooks": [], "priority": 0, "parser": '', "status": "WAITING"}
+                task.update({"created_on": now, "modified_on": now})
+                task.update(d)
+                task["base_result"] = base_result
+                task = {k: v for k, v in task.items() if v is not None}
+
+                try:
+                    results.append(str(table.insert_one(task)))
+                    meta['n_inserted'] += 1
+                    continue
+                except KeyError:
+                    pass
+
+                # Duplicate tasks are a rare case, merge the hooks into the existing task
+                found = table.find_one({"base_result": base_result}, projection={"status": True, "tag": True})
+                results.append(str(found["_id"]))
+                meta["duplicates"].append((found.get("status"), str(found.get("tag")), str(base_result["_ref"].id)))
+
+                if task["hooks"]:
+                    table.update_one({"_id": found["_id"]}, {"$push": {"hooks": {"$each": task["hooks"]}}})
+
+        if len(meta["duplicates"]):
+            self.logger.warning("queue_submit got {} duplicate tasks.".format(len(meta["duplicates"])))
+
+        meta["success"] = True
+
+        ret = {"data": results, "meta": meta}
+        return ret
+
+    def _task_to_json(self, task):
+        # The TaskQueue model flattens the generic reference on output
+        task["base_result"] = task["base_result"]["_ref"]
+        return self._doc_to_json(task, with_ids=True)
+
+    def queue_get_next(self, manager=None, limit=100, tag=None, lease_time=None, as_json=True):
+        """Claims up to `limit` WAITING tasks and marks them as RUNNING.
+
+        Tasks are served highest priority first and oldest first within a
+        priority. The claim holds the socket lock, so concurrent managers
+        never receive the same task.
+
+        Each claimed task carries a lease which the manager must renew with
+        `queue_renew_leases`; tasks whose lease runs out are requeued by
+        `queue_requeue_expired`.
+
+        Parameters
+        ----------
+        manager : str, optional
+            The name of the claiming manager
+        limit : int, optional
+            The maximum number of tasks to claim
+        tag : str, optional
+            Only claim tasks with this tag
+        lease_time : int, optional
+            Length of the lease in seconds, defaults to the socket lease time
+        as_json : bool, optional
+            Return tasks as JSON
+
+        Returns
+        -------
+        list of the claimed tasks
+        """
+
+        # Figure out query, tagless has no requirements
+        query = {"status": "WAITING"}
+        if tag is not None:
+            query["tag"] = tag
+
+        table = self._tables["task_queue"]
+        lease_time = lease_time or self._queue_lease_time
+
+        with self._lock:
+            found = table.find(query, projection={"_id": True}, limit=limit, sort=self._queue_order)
+            found = [x["_id"] for x in found]
+            if len(found) == 0:
+                return []
+
+            now = datetime.datetime.utcnow()
+            table.update_many({
+                "_id": {
+                    "$in": found
+                }
+            }, {
+                "$set": {
+                    "status": "RUNNING",
+                    "manager": manager,
+                    "lease_expiry": now + datetime.timedelta(seconds=lease_time),
+                    "modified_on": now
+                }
+            })
+
+            found = table.find({"_id": {"$in": found}}, sort=self._queue_order)
+
+        if as_json:
+            found = [self._task_to_json(task) for task in found]
+
+        return found
+
+    def get_queue(self, query, projection=None, limit=0, cursor=None):
+        """TODO: to be replaced with a specific query
+
+        Finished tasks that were moved to the task archive are also searched,
+        archived tasks only hold their 'base_result', 'status', and 'error'.
+        Queries with a `limit` are ordered by id, meta["next_cursor"] holds the
+        continuation token of the next page which is passed back as `cursor`.
+        """
+
+        archive_query = copy.deepcopy(query)
+        ret = self._get_generic(query, "task_queue", allow_generic=True, projection=projection, limit=limit,
+                                cursor=cursor)
+
+        # Only finished tasks are archived
+        status = archive_query.get("status", None) if isinstance(archive_query, dict) else None
+        if isinstance(status, str):
+            status = [status]
+        if (status is not None) and not (set(status) & set(self._archive_status)):
+            return ret
+
+        archived = self._get_generic(
+            archive_query, "task_queue_archive", allow_generic=True, projection=projection, limit=limit, cursor=cursor)
+        found = set(x["id"] for x in ret["data"])
+        ret["data"].extend(x for x in archived["data"] if x["id"] not in found)
+
+        # Merge the pages of both tables, ids have a fixed width so they sort as strings
+        if limit:
+            more = (len(ret["data"]) > limit) or ret["meta"]["next_cursor"] or archived["meta"]["next_cursor"]
+
+            ret["data"].sort(key=lambda x: x["id"])
+            del ret["data"][limit:]
+
+            ret["meta"]["next_cursor"] = None
+            if more:
+                ret["meta"]["next_cursor"] = storage_utils.encode_cursor(ret["data"][-1]["id"])
+
+        ret["meta"]["n_found"] = len(ret["data"])
+
+        return ret
+
+    def queue_archive(self, batch_size=1000, max_batches=None):
+        """Moves all COMPLETE and ERROR tasks out of the task queue and into
+        the task archive. Only the 'base_result', 'status', and 'error' fields
+        are kept, the task id is unchanged.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of tasks moved per pass
+        max_batches : int, optional
+            Stops after this many batches, the remaining tasks are left for the next call.
+            By default the task queue is drained.
+
+        Returns
+        -------
+        int
+            The number of archived tasks
+        """
+
+        table = self._tables["task_queue"]
+        archive = self._tables["task_queue_archive"]
+        query = {"status": {"$in": self._archive_status}}
+        projection = {"base_result": True, "status": True, "error": True}
+
+        n_archived = 0
+        n_batches = 0
+        with self._lock:
+            while (max_batches is None) or (n_batches < max_batches):
+                n_batches += 1
+                found = table.find(query, projection=projection, limit=batch_size)
+                if len(found) == 0:
+                    break
+
+                for task in found:
+                    try:
+                        archive.insert_one(task)
+                    except KeyError:
+                        # Already archived by an interrupted pass
+                        pass
+
+                n_archived += table.delete_many({"_id": {"$in": [x["_id"] for x in found]}}).deleted_count
+
+        return n_archived
+
+    def queue_get_by_id(self, ids: List[str], limit: int=100, as_json: bool=True):
+        """Get tasks by their IDs
+
+        Parameters
+        ----------
+        ids : list of str
+            List of the task Ids in the DB
+        limit : int (optional)
+            max number of returned tasks. If limit > max_limit, max_limit
+            will be returned instead (safe query)
+        as_json : bool
+            Return tasks as JSON
+
+        Returns
+        -------
+        list of the found tasks
+        """
+
+        q_limit = limit if limit and limit < self._max_limit else self._max_limit
+        ids, _ = _str_to_indices_with_errors(ids)
+        found = self._tables["task_queue"].find({"_id": {"$in": ids}}, limit=q_limit)
+
+        if as_json:
+            found = [self._task_to_json(task) for task in found]
+
+        return found
+
+    def queue_mark_complete(self, task_ids: List[str]) -> int:
+        """Update the given tasks as complete
+        Note that each task is already pointing to its result location
+
+        Parameters
+        ----------
+        task_ids : list
+            IDs of the tasks to mark as COMPLETE
+
+        Returns
+        -------
+        int
+            Updated count
+        """
+
+        ids, _ = _str_to_indices_with_errors(task_ids)
+        upd = self._tables["task_queue"].update_many({"_id": {"$in": ids}}, {"$set": {"status": "COMPLETE"}})
+
+        return upd.matched_count
+
+    def queue_mark_error(self, data):
+        """Marks tasks as ERROR and wakes the services which wait on them
+
+        Parameters
+        ----------
+        data : list of (str, str) tuples
+            The task id and the error message of each task
+        """
+
+        if len(data) == 0:
+            return
+
+        dt = datetime.datetime.utcnow()
+        matched = 0
+        for queue_id, msg in data:
+            update = {
+                "$set": {
+                    "status": "ERROR",
+                    "error": msg,
+                    "modified_on": dt,
+                }
+            }
+            matched += self._tables["task_queue"].update_one({"_id": ObjectId(queue_id)}, update).matched_count
+
+        # Services are not polled, a failed task wakes its service so the failure is recorded
+        ids = [ObjectId(x[0]) for x in data]
+        tasks = self._tables["task_queue"].find({"_id": {"$in": ids}}, projection={"hooks": True})
+        services = storage_utils.hooked_services(hook for task in tasks for hook in task.get("hooks", []))
+        if len(services):
+            self._tables["service_queue"].update_many({"_id": {"$in": [ObjectId(x) for x in services]}},
+                                                      {"$set": {"awake": True}})
+
+        return matched
+
+    def queue_reset_status(self, task_ids, manager):
+        """Returns the RUNNING tasks still held by a manager to the WAITING state.
+
+        Tasks which were requeued after their lease expired and claimed by
+        another manager are left untouched.
+
+        Parameters
+        ----------
+        task_ids : list of str
+            The ids of the tasks to return to the queue
+        manager : str
+            The name of the manager holding the tasks
+
+        Returns
+        -------
+        int
+            The number of tasks returned to the queue
+        """
+
+        if len(task_ids) == 0:
+            return 0
+
+        ids, _ = _str_to_indices_with_errors(task_ids)
+        upd = self._tables["task_queue"].update_many({
+            "_id": {
+                "$in": ids
+            },
+            "status": "RUNNING",
+            "manager": manager
+        }, {"$set": {
+            "status": "WAITING",
+            "manager": None,
+            "lease_expiry": None
+        }})
+
+        return upd.matched_count
+
+    def queue_renew_leases(self, manager, task_ids, lease_time=None):
+        """Extends the lease on RUNNING tasks still held by a manager.
+
+        Parameters
+        ----------
+        manager : str
+            The name of the manager holding the tasks
+        task_ids : list of str
+            The ids of the tasks the manager is still working on
+        lease_time : int, optional
+            Length of the new lease in seconds, defaults to the socket lease time
+
+        Returns
+        -------
+        int
+            The number of renewed leases
+        """
+
+        if len(task_ids) == 0:
+            return 0
+
+        lease_time = lease_time or self._queue_lease_time
+        now = datetime.datetime.utcnow()
+
+        upd = self._tables["task_queue"].update_many({
+            "_id": {
+                "$in": [ObjectId(x) for x in task_ids]
+            },
+            "status": "RUNNING",
+            "manager": manager
+        }, {"$set": {
+            "lease_expiry": now + datetime.timedelta(seconds=lease_time)
+        }})
+
+        return upd.modified_count
+
+    def queue_requeue_expired(self, batch_size=1000, max_batches=None):
+        """Returns RUNNING tasks whose lease has run out to the WAITING state.
+
+        The number of tasks requeued is recorded as `expired` in the logs of
+        the manager which held the tasks.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of tasks requeued per database operation
+        max_batches : int, optional
+            Stops after this many batches, the remaining tasks are left for the next call.
+            By default all expired tasks are requeued.
+
+        Returns
+        -------
+        int
+            The number of requeued tasks
+        """
+
+        table = self._tables["task_queue"]
+        now = datetime.datetime.utcnow()
+        query = {"status": "RUNNING", "lease_expiry": {"$lt": now}}
+
+        n_requeued = 0
+        n_batches = 0
+        with self._lock:
+            while (max_batches is None) or (n_batches < max_batches):
+                n_batches += 1
+                found = table.find(query, projection={"_id": True, "manager": True}, limit=batch_size)
+                if len(found) == 0:
+                    break
+
+                # Group by manager so the manager logs can be updated
+                expired = collections.defaultdict(list)
+                for task in found:
+                    expired[task.get("manager", None)].append(task["_id"])
+
+                for manager, ids in expired.items():
+                    upd = table.update_many({
+                        "_id": {
+                            "$in": ids
+                        }
+                    }, {"$set": {
+                        "status": "WAITING",
+                        "manager": None,
+                        "lease_expiry": None,
+                        "modified_on": now
+                    }})
+                    n_requeued += upd.modified_count
+
+                    if manager is not None:
+                        self.manager_update(manager, expired=upd.modified_count)
+
+        return n_requeued
+
+    def handle_hooks(self, hooks):
+        """Applies the updates of the hooks of completed tasks to their services. Services
+        without remaining tasks are marked as awake so that the next service pass iterates them.
+
+        Parameters
+        ----------
+        hooks : list of list of dict
+            The hooks of each completed task
+        """
+
+        # Does not currently handle multiple identical commands
+        # Only handles service updates
+
+        table = self._tables["service_queue"]
+
+        n_updated = 0
+        with self._lock:
+            for hook_list in hooks:
+                for hook in hook_list:
+                    commands = {}
+                    for com in hook["updates"]:
+                        commands["$" + com[0]] = {com[1]: com[2]}
+
+                    upd = table.update_one({"_id": ObjectId(hook["document"][1])}, commands)
+                    n_updated += upd.modified_count
+
+            services = storage_utils.hooked_services(hook for hook_list in hooks for hook in hook_list)
+            found = table.find({"_id": {"$in": [ObjectId(x) for x in services]}}, projection={"remaining_tasks": True})
+
+            # Booleans are not counts, False marks a service which has not submitted tasks yet
+            awake = []
+            for doc in found:
+                remaining = doc.get("remaining_tasks", None)
+                if isinstance(remaining, (int, float)) and not isinstance(remaining, bool) and (remaining <= 0):
+                    awake.append(doc["_id"])
+
+            if len(awake):
+                table.update_many({"_id": {"$in": awake}}, {"$set": {"awake": True}})
+
+        return n_updated
+
+### QueueManagers
+
+    def manager_update(self, name, tag=None, submitted=0, completed=0, failures=0, returned=0, expired=0):
+        dt = datetime.datetime.utcnow()
+
+        r = self._tables["queue_managers"].update_one(
+            {
+                "name": name
+            },
+            {
+                # Provide base data
+                "$setOnInsert": {
+                    "name": name,
+                    "created_on": dt,
+                    "tag": tag,
+                },
+                # Set the date
+                "$set": {
+                    "modifed_on": dt,
+                },
+                # Incremement relevant data
+                "$inc": {
+                    "submitted": submitted,
+                    "completed": completed,
+                    "returned": returned,
+                    "failures": failures,
+                    "expired": expired
+                }
+            },
+            upsert=True)
+        return r.matched_count == 1
+
+    def get_managers(self, query, projection=None):
+
+        return self._get_generic(query, "queue_managers", allow_generic=True, projection=projection)
+
+### Users
+
+    def add_user(self, username, password, permissions=["read"]):
+        """
+        Adds a new user and associated permissions.
+
+        Passwords are stored using bcrypt.
+
+        Parameters
+        ----------
+        username : str
+            New user's username
+        password : str
+            The user's password
+        permissions : list of str, optional
+            The associated permissions of a user ['read', 'write', 'compute', 'queue', 'admin']
+
+        Returns
+        -------
+        tuple
+            Successful insert or not
+        """
+
+        hashed = bcrypt.hashpw(password.encode("UTF-8"), bcrypt.gensalt(6))
+        try:
+            self._tables["users"].insert_one({"username": username, "password": hashed, "permissions": permissions})
+            return True
+        except KeyError:
+            return False
+
+    def verify_user(self, username, password, permission):
+        """
+        Verifies if a user has the requested permissions or not.
+
+        Passwords are store and verified using bcrypt.
+
+        Parameters
+        ----------
+        username : str
+            The username to verify
+        password : str
+            The password associated with the username
+        permission : str
+            The associated permissions of a user ['read', 'write', 'compute', 'queue', 'admin']
+
+        Returns
+        -------
+        tuple
+            A tuple of (success flag, failure string)
+        """
+
+        if self._bypass_security:
+            return (True, "Success")
+
+        data = self._tables["users"].find_one({"username": username})
+        if data is None:
+            return (False, "User not found.")
+
+        pwcheck = bcrypt.checkpw(password.encode("UTF-8"), data["password"])
+        if pwcheck is False:
+            return (False, "Incorrect password.")
+
+        # Admin has access to everything
+        if (permission.lower() not in data["permissions"]) and ("admin" not in data["permissions"]):
+            return (False, "User has insufficient permissions.")
+
+        return (True, "Success")
+
+    def remove_user(self, username):
+        """Removes a user from the tables
+
+        Parameters
+        ----------
+        username : str
+            The username to remove
+
+        Returns
+        -------
+        bool
+            If the operation was successful or not.
+        """
+        return self._tables["users"].delete_many({"username": username}).deleted_count == 1
+
+### Complex parsers
+
+    def search_qc_variable(self, hashes, field):
+        """
+        Displays the first value of each `field` for each molecule in `hashes`.
+
+        Parameters
+        ----------
+        hashes : list
+            A list of molecules hashes.
+        field : str or list of str
+            A page field, or several page fields which are extracted in the same pass.
+            Nested fields use dotted names, e.g. "properties.scf_total_energy".
+
+        Returns
+        -------
+        dataframe
+            Returns a dataframe with your results. The rows will have the
+            molecule hashes and the columns will contain the field names. Each cell
+            contains the field value for the molecule in that row, or None if no
+            result of the molecule holds the field.
+
+        """
+
+        fields = [field] if isinstance(field, str) else list(field)
+
+        mols = self._tables["molecules"].find({"molecule_hash": {"$in": list(hashes)}},
+                                              projection={"molecule_hash": True})
+        mol_hashes = {x["_id"]: x["molecule_hash"] for x in mols}
+
+        d = {mol: {f: None for f in fields} for mol in hashes}
+        for result in self._tables["results"].find({"molecule": {"$in": list(mol_hashes)}}):
+            mol = mol_hashes[result["molecule"]]
+            for f in fields:
+                value = _get_field(result, f)
+                if (value is not _missing) and (d[mol][f] is None):
+                    d[mol][f] = value
+
+        return pd.DataFrame(data=d, index=fields).transpose()
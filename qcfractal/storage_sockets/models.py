@@ -251,10 +251,16 @@ class TaskQueue(db.DynamicDocument):
     # others
     hooks = db.ListField(db.DynamicField())  # ??
     tag = db.StringField(default=None)
+    priority = db.IntField(default=0)  # higher priority tasks are served first
     parser = db.StringField(default='')
     status = db.StringField(default='WAITING')
                             # choices=['RUNNING', 'WAITING', 'ERROR', 'COMPLETE'])
 
+    # claim information, set when a manager pulls the task
+    manager = db.StringField(default=None)
+    claim_token = db.StringField(default=None)
+    lease_expiry = db.DateTimeField(default=None)  # RUNNING tasks past their lease are requeued
+
     created_on = db.DateTimeField(required=True, default=datetime.datetime.now)
     modified_on = db.DateTimeField(required=True, default=datetime.datetime.now)
 
@@ -262,8 +268,10 @@ class TaskQueue(db.DynamicDocument):
 
     meta = {
         'indexes': [
-            '-created_on',
-            'status',
+            # claims are served by (priority desc, created_on asc), with or without a tag
+            {'fields': ("status", "tag", "-priority", "created_on"), 'unique': False},
+            {'fields': ("status", "-priority", "created_on"), 'unique': False},
+            {'fields': ("status", "lease_expiry"), 'unique': False},
             # {'fields': ("status", "tag", "hash_index"), 'unique': False}
             {'fields': ("base_result",), 'unique': True}  # new
 
@@ -15,8 +15,10 @@ except ImportError:
         "Mongoengine_socket requires mongoengine, please install this python module or try a different db_socket.")
 
 import collections
+import copy
 import datetime
 import logging
+import uuid
 
 import bcrypt
 import bson.errors
@@ -26,6 +28,7 @@ import json
 from typing import List, Union, Dict
 
 from . import storage_utils
+from .indexes import IndexManager
 # Pull in the hashing algorithms from the client
 from .. import interface
 
@@ -83,10 +86,12 @@ class MongoengineSocket:
                  authMechanism="SCRAM-SHA-1",
                  authSource=None,
                  logger=None,
-                 max_limit=1000):
+                 max_limit=1000,
+                 build_indexes=True):
         """
         Constructs a new socket where url and port points towards a Mongod instance.
 
+        Missing indexes are built in the background unless `build_indexes` is False.
         """
 
         # Logging data
@@ -107,6 +112,7 @@ class MongoengineSocket:
             "procedures": interface.schema.get_table_indices("procedure"),
             "service_queue": interface.schema.get_table_indices("service_queue"),
             "task_queue": interface.schema.get_table_indices("task_queue"),
+            "task_queue_archive": ("status", "base_result"),
             "users": ("username", ),
             "queue_managers": ("name", )
         }
@@ -119,12 +125,23 @@ class MongoengineSocket:
             "procedures": False,
             "service_queue": False,
             "task_queue": False,
+            "task_queue_archive": False,
             "users": True,
             "queue_managers": True,
         }
 
         self._lower_results_index = ["method", "basis", "options", "program"]
 
+        # Number of passes a queue claim makes before returning a partial batch
+        self._claim_attempts = 3
+        self._queue_order = [("priority", pymongo.DESCENDING), ("created_on", pymongo.ASCENDING)]
+
+        # Seconds a manager holds a claimed task without renewing it before it is requeued
+        self._queue_lease_time = 600
+
+        # Finished tasks are moved from the task queue to the task archive
+        self._archive_status = ["COMPLETE", "ERROR"]
+
         # disconnect from any active default connection
         disconnect()
 
@@ -163,44 +180,51 @@ class MongoengineSocket:
         self._tables = self.client[project]
         self._max_limit = max_limit
 
-        # new_table = self.init_database()
-        # for k, v in new_table.items():
-        #     if v:
-        #         self.logger.info("Add '{}' table to the database!".format(k))
+        # Build any missing indexes without delaying startup
+        self._index_manager = IndexManager(self._tables, logger=self.logger)
+        if build_indexes:
+            self.init_database()
 
     ### Mongo meta functions
 
     def __str__(self):
         return "<MongoSocket: address='{0:s}:{1:d}:{2:s}'>".format(str(self._url), self._port, str(self._tables_name))
 
-    def init_database(self):
+    def init_database(self, wait=False):
         """
         Builds out the initial project structure.
 
-        This is the Mongo definition of "Database"
+        This is the Mongo definition of "Database", tables are created on first use
+        and the indexes declared in `indexes.table_indexes` are built in the background.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Blocks until all indexes are built
+
+        Returns
+        -------
+        dict
+            A {table: [index name]} dictionary of the created indexes if `wait`, otherwise empty
         """
-        # Try to create a collection for each entry
-        table_creation = {}
-        # for table in self._valid_tables:
-        #     try:
-        #         # MongoDB "Collection" -> QCFractal "Table"
-        #         self._tables.create_collection(table)
-        #         table_creation[table] = True
-        #
-        #     except pymongo.errors.CollectionInvalid:
-        #         table_creation[table] = False
 
-        # Build the indices
-        # for table, indices in self._table_indices.items():
-        #     idx = [(x, pymongo.ASCENDING) for x in indices if x != "hash_index"]
-        #     self._tables[table].create_index(idx, unique=self._table_unique_indices[table])
+        if wait:
+            return self._index_manager.build()
 
-        # # Special queue index, hash_index should be unique
-        # for table in ["task_queue", "service_queue"]:
-        #     self._tables[table].create_index([("hash_index", pymongo.ASCENDING)], unique=True)
+        self._index_manager.build_async()
+        return {}
 
-        # Return the success array
-        return table_creation
+    def check_indexes(self):
+        """
+        Audits the indexes of the database, see `IndexManager.check`.
+
+        Returns
+        -------
+        dict
+            The missing and unused indexes and the query plans of the hot queries
+        """
+
+        return self._index_manager.check()
 
     def _clear_db(self, db_name: str):
         """Dangerous, make sure you are deleting the right DB"""
@@ -213,6 +237,7 @@ class MongoengineSocket:
             Options.drop_collection()
             Collection.drop_collection()
             TaskQueue.drop_collection()
+            self._tables["task_queue_archive"].drop()
             Procedure.drop_collection()
             User.drop_collection()
 
@@ -296,47 +321,43 @@ class MongoengineSocket:
 
         return (self._tables[table].delete_many({index: {"$in": hashes}})).deleted_count
 
-    def _get_generic(self, query, table, projection=None, allow_generic=False, limit=0):
+    def _get_generic(self, query, table, projection=None, allow_generic=False, limit=0, cursor=None):
 
         # TODO parse duplicates
         meta = storage_utils.get_metadata()
 
         data = []
 
-        # Assume we want to lookup via unique key tuple
+        # Assume we want to lookup via unique key tuple, all tuples are found with a single query
         if isinstance(query, (tuple, list)):
             keys = self._table_indices[table]
-            len_key = len(keys)
-
-            for q in query:
-                if (len(q) == len_key) and isinstance(q, (list, tuple)):
-                    q = {k: v for k, v in zip(keys, q)}
-                else:
-                    meta["errors"].append({"query": q, "error": "Malformed query"})
-                    continue
-
-                d = self._tables[table].find_one(q, projection=projection)
-                if d is None:
-                    meta["missing"].append(q)
-                else:
-                    data.append(d)
+            data = storage_utils.find_unique_keys(self._tables[table], keys, query, projection=projection, meta=meta)
 
         elif isinstance(query, dict):
 
-            # Handle specific ID query
-            if "id" in query:
-                ids, bad_ids = _str_to_indices_with_errors(query["id"])
-                if bad_ids:
-                    meta["errors"].append(("Bad Ids", bad_ids))
+            query = self._translate_generic_query(query, meta)
 
-                query["_id"] = ids
-                del query["id"]
+            # Limited queries are paged by _id, the continuation token resumes after the last document
+            sort = None
+            if limit or cursor:
+                sort = [("_id", 1)]
 
-            for k, v in query.items():
-                if isinstance(v, (list, tuple)):
-                    query[k] = {"$in": v}
+            if cursor:
+                try:
+                    query = storage_utils.add_cursor_query(query, cursor)
+                except KeyError:
+                    meta["errors"].append(("Bad cursor", cursor))
+                    query = None
+
+            # One document past the page tells if there is a next page
+            data = []
+            if query is not None:
+                data = list(
+                    self._tables[table].find(query, projection=projection, limit=limit and limit + 1, sort=sort))
 
-            data = list(self._tables[table].find(query, projection=projection, limit=limit))
+            if limit and (len(data) > limit):
+                data = data[:limit]
+                meta["next_cursor"] = storage_utils.encode_cursor(data[-1]["_id"])
         else:
             meta["errors"] = "Malformed query"
 
@@ -351,6 +372,31 @@ class MongoengineSocket:
         ret = {"meta": meta, "data": data}
         return ret
 
+    def _translate_generic_query(self, query, meta=None):
+        """Translates the "id" key to ObjectId's and list values to $in queries"""
+
+        # Handle specific ID query
+        if "id" in query:
+            ids, bad_ids = _str_to_indices_with_errors(query["id"])
+            if bad_ids and (meta is not None):
+                meta["errors"].append(("Bad Ids", bad_ids))
+
+            query["_id"] = ids
+            del query["id"]
+
+        for k, v in query.items():
+            if isinstance(v, (list, tuple)):
+                query[k] = {"$in": v}
+
+        return query
+
+    def _iter_generic(self, query, table, projection=None, batch_size=1000):
+
+        query = self._translate_generic_query(query)
+        for d in self._tables[table].find(query, projection=projection, batch_size=batch_size):
+            d["id"] = str(d.pop("_id"))
+            yield d
+
 ### Mongo molecule functions
 
     def add_molecules(self, data):
@@ -443,7 +489,24 @@ class MongoengineSocket:
 
         return ret
 
-    def get_molecules(self, molecule_ids, index="id"):
+    def get_molecules(self, molecule_ids, index="id", projection=None):
+        """
+        Gets molecules from the database.
+
+        Parameters
+        ----------
+        molecule_ids : str or list of strs
+            The keys of the molecules
+        index : str, optional
+            The key type, "id", "molecule_hash", or "molecular_formula"
+        projection : list of str, optional
+            Only return these fields of the molecules and their id
+
+        Returns
+        -------
+        dict
+            The molecules in "data" and the query metadata in "meta"
+        """
 
         ret = {"meta": storage_utils.get_metadata(), "data": []}
 
@@ -461,7 +524,10 @@ class MongoengineSocket:
             molecule_ids, bad_ids = _str_to_indices_with_errors(molecule_ids)
 
         # Project out the duplicates we use for top level keys
-        proj = {"molecule_hash": False, "molecular_formula": False}
+        if projection is None:
+            proj = {"molecule_hash": False, "molecular_formula": False}
+        else:
+            proj = {k: True for k in projection}
 
         # Make the query
         data = self._tables["molecules"].find({index: {"$in": molecule_ids}}, projection=proj)
@@ -537,6 +603,17 @@ class MongoengineSocket:
 
         return d_json
 
+    def _raw_to_json(self, doc, with_ids=True, id_fields=()):
+        """Converts a raw pymongo document to JSON in a single pass, renames _id to id or removes it altogether"""
+
+        return storage_utils.raw_to_json(doc, with_ids=with_ids, id_fields=id_fields)
+
+    def _task_to_json(self, task):
+        # The TaskQueue model flattens the generic reference on output
+        if isinstance(task.get("base_result", None), dict):
+            task["base_result"] = task["base_result"]["_ref"]
+        return self._raw_to_json(task, with_ids=True)
+
     ### Mongo options functions
 
     def add_options(self, data: Union[Dict, List[Dict]]):
@@ -595,8 +672,8 @@ class MongoengineSocket:
 
         Parameters
         ----------
-        program : str
-            program name
+        program : str or list of tuples
+            program name, or a list of (program, name) tuples which are found with a single query
         name : str
             option name
         return_json : bool, optional
@@ -618,6 +695,13 @@ class MongoengineSocket:
             The 'data' part is an object of the result or None if not found
         """
 
+        if isinstance(program, list) and all(isinstance(x, (list, tuple)) for x in program):
+            ret = self._get_generic(program, "options")
+            if not with_ids:
+                for d in ret["data"]:
+                    del d["id"]
+            return ret
+
         meta = storage_utils.get_metadata()
         query = {}
         if program:
@@ -636,7 +720,7 @@ class MongoengineSocket:
             meta['error_description'] = str(err)
 
         if return_json:
-            rdata = [self._doc_to_json(d, with_ids) for d in data]
+            rdata = [self._raw_to_json(d, with_ids) for d in data.as_pymongo()]
         else:
             rdata = data
 
@@ -756,7 +840,7 @@ class MongoengineSocket:
             meta['error_description'] = str(err)
 
         if return_json:
-            rdata = [self._doc_to_json(d, with_ids) for d in data]
+            rdata = [self._raw_to_json(d, with_ids) for d in data.as_pymongo()]
         else:
             rdata = data
 
@@ -816,41 +900,104 @@ class MongoengineSocket:
         Returns
         -------
             Dict with keys: data, meta
-            Data is the ids of the inserted/updated/existing docs
+            Data is the ids of the inserted/updated/existing docs, in the
+            same order as the input. Errored entries have 'None' as their id.
+
+        Notes
+        -----
+            All results are written with a single bulk operation against the
+            unique (program, driver, method, basis, molecule, options) index.
+            The ids of duplicates are then resolved with a single query.
+            Results which fail the validation of the Result model are skipped
+            and listed in meta["validation_errors"].
         """
 
+        meta = storage_utils.add_metadata()
+
+        if len(data) == 0:
+            meta["success"] = True
+            return {"data": [], "meta": meta}
+
         for d in data:
             for i in self._lower_results_index:
-                if d[i] is None:
+                if d.get(i) is None:
                     continue
 
                 d[i] = d[i].lower()
 
-        meta = storage_utils.add_metadata()
+            if ("molecule" in d) and not isinstance(d['molecule'], ObjectId):
+                d['molecule'] = ObjectId(d['molecule'])
+
+        keys = self._table_indices["results"]
+        ukeys = [tuple(d.get(k) for k in keys) for d in data]
+
+        # The raw bulk write bypasses the model, so every document is validated against it first
+        valid = []
+        invalid = set()
+        for num, d in enumerate(data):
+            if (not update_existing) and (not d.get("status")):
+                d["status"] = "INCOMPLETE"
+
+            try:
+                Result(**{"status": "INCOMPLETE", **d}).validate()
+                valid.append(num)
+            except (mongoengine.errors.ValidationError, mongoengine.errors.FieldDoesNotExist) as err:
+                meta["validation_errors"].append((tuple(str(x) for x in ukeys[num]), str(err)))
+                invalid.add(num)
+
+        # Pulling the collection through the model ensures the unique index exists
+        collection = Result._get_collection()
+
+        error_skips = set()
+        lookup = set()
+        if len(valid) and update_existing:
+            bulk_commands = [
+                pymongo.UpdateOne(dict(zip(keys, ukeys[num])), storage_utils.result_upsert(data[num]), upsert=True)
+                for num in valid
+            ]
+            tmp = collection.bulk_write(bulk_commands, ordered=False)
+            meta['n_inserted'] = tmp.upserted_count
+            lookup = set(ukeys[num] for num in valid)
+
+        elif len(valid):
+            try:
+                tmp = collection.insert_many([data[num] for num in valid], ordered=False)
+                meta['n_inserted'] = len(tmp.inserted_ids)
+            except pymongo.errors.BulkWriteError as tmp:
+                meta['n_inserted'] = tmp.details["nInserted"]
+                for error in tmp.details["writeErrors"]:
+                    num = valid[error["index"]]
+                    ukey = ukeys[num]
+
+                    # Duplicate key errors, the existing id is found below
+                    if error["code"] == 11000:
+                        meta['duplicates'].append(tuple(str(x) for x in ukey))
+                        lookup.add(ukey)
+                    else:
+                        meta["errors"].append({"id": str(error["op"]["_id"]), "code": error["code"], "key": ukey})
+
+                    error_skips.add(num)
+
+        # Find the ids of all updated or duplicate results in one query
+        found_ids = {}
+        if len(lookup):
+            query = {"$or": [dict(zip(keys, ukey)) for ukey in lookup]}
+            for doc in collection.find(query, projection={k: True for k in keys}):
+                found_ids[tuple(doc.get(k) for k in keys)] = str(doc["_id"])
 
         results = []
-        # try:
-        for d in data:
-            # search by index keywords not by all keys, much faster
-            doc = Result.objects(program=d['program'], name=d['driver'],
-                                 method=d['method'], basis=d['basis'],
-                                 options=d['options'], molecule=d['molecule'])
-
-            if doc.count() == 0 or update_existing:
-                if not isinstance(d['molecule'], ObjectId):
-                    d['molecule'] = ObjectId(d['molecule'])
-                doc = doc.upsert_one(**d)
-                results.append(str(doc.id))
-                meta['n_inserted'] += 1
+        for num, (ukey, d) in enumerate(zip(ukeys, data)):
+            _id = d.pop("_id", None)
+            if num in invalid:
+                results.append(None)
+            elif ukey in lookup:
+                results.append(found_ids.get(ukey, None))
+            elif num in error_skips:
+                results.append(None)
             else:
-                meta['duplicates'].append(self._doc_to_tuples(doc.first(), with_ids=False))  # TODO
-                # If new or duplicate, add the id to the return list
-                results.append(str(doc.first().id))
-        meta["success"] = True
-        # except (mongoengine.errors.ValidationError, KeyError) as err:
-        #     meta["validation_errors"].append(err)
-        # except Exception as err:
-        #     meta['error_description'] = err
+                results.append(str(_id))
+
+        meta["success"] = (len(meta["errors"]) == 0) and (len(meta["validation_errors"]) == 0)
 
         ret = {"data": results, "meta": meta}
         return ret
@@ -882,7 +1029,7 @@ class MongoengineSocket:
         data = []
         # try:
         if projection:
-            data = Result.objects(id__in=ids).only(*projection).limit(self._max_limit)
+            data = Result.objects(id__in=ids).only("id", *projection).limit(self._max_limit)
         else:
             data = Result.objects(id__in=ids).limit(self._max_limit)
 
@@ -892,7 +1039,7 @@ class MongoengineSocket:
         #     meta['error_description'] = str(err)
 
         if return_json:
-            rdata = [self._doc_to_json(d, with_ids) for d in data]
+            rdata = [self._raw_to_json(d, with_ids, id_fields=("molecule", )) for d in data.as_pymongo()]
         else:
             rdata = data
 
@@ -920,7 +1067,8 @@ class MongoengineSocket:
                     limit: int=None,
                     skip: int=None,
                     return_json=True,
-                    with_ids=True):
+                    with_ids=True,
+                    cursor: str=None):
         """
 
         Parameters
@@ -948,6 +1096,9 @@ class MongoengineSocket:
             Return the results as a list of json inseated of objects
         with_ids : bool, default is True
             Include the ids in the returned objects/dicts
+        cursor : str, default is None
+            The continuation token of the previous page, results are ordered by their
+            id and meta["next_cursor"] holds the token of the next page if there is one
 
         Returns
         -------
@@ -956,6 +1107,55 @@ class MongoengineSocket:
         """
 
         meta = storage_utils.get_metadata()
+        parsed_query = self._results_query(
+            program=program,
+            method=method,
+            basis=basis,
+            molecule=molecule,
+            driver=driver,
+            options=options,
+            status=status)
+
+        q_limit = limit if limit and limit < self._max_limit else self._max_limit
+
+        data = []
+        try:
+            # Keyset pagination, the continuation token holds the last id of the previous page
+            if cursor:
+                parsed_query["id__gt"] = storage_utils.decode_cursor(cursor)
+
+            data = Result.objects(**parsed_query).order_by("id")
+            if projection:
+                data = data.only("id", *projection)
+
+            # One document past the page tells if there is a next page, counting all matches would scan them
+            data = data.limit(q_limit + 1)
+            if return_json:
+                data = data.as_pymongo()
+
+            data = list(data)
+            if len(data) > q_limit:
+                data = data[:q_limit]
+                last = data[-1]["_id"] if return_json else data[-1].id
+                meta["next_cursor"] = storage_utils.encode_cursor(last)
+
+            meta["n_found"] = len(data)
+
+            meta["success"] = True
+        except Exception as err:
+            meta['error_description'] = str(err)
+
+        if return_json:
+            rdata = [self._raw_to_json(d, with_ids, id_fields=("molecule", )) for d in data]
+        else:
+            rdata = data
+
+        return {"data": rdata, "meta": meta}
+
+    def _results_query(self, program=None, method=None, basis=None, molecule=None, driver=None, options=None,
+                       status='COMPLETE'):
+        """Builds the mongoengine query of get_results"""
+
         query = {}
         parsed_query = {}
         if program:
@@ -983,32 +1183,60 @@ class MongoengineSocket:
             else:
                 parsed_query[key] = value.lower()
 
-        q_limit = limit if limit and limit < self._max_limit else self._max_limit
-
-        data = []
-        try:
-            if projection:
-                data = Result.objects(**parsed_query).only(*projection).limit(q_limit)
-            else:
-                data = Result.objects(**parsed_query).limit(q_limit)
+        return parsed_query
+
+    def iter_results(self,
+                     program: str=None,
+                     method: str=None,
+                     basis: str=None,
+                     molecule: str=None,
+                     driver: str=None,
+                     options: str=None,
+                     status: str='COMPLETE',
+                     id: List[str]=None,
+                     projection=None,
+                     with_ids=True,
+                     batch_size: int=1000):
+        """
+        Iterates over all Results matching the query of `get_results` or a list of ids. Results
+        are not capped at `max_limit` and are pulled from the database `batch_size` at a time.
 
-            meta["n_found"] = data.count()
-            meta["success"] = True
-        except Exception as err:
-            meta['error_description'] = str(err)
+        Parameters
+        ----------
+        id : List of str, optional
+            Ids of the results in the DB, all other query parameters are ignored if given
+        projection : list/set/tuple of keys, default is None
+            The fields to return, default to return all
+        with_ids : bool, default is True
+            Include the ids in the returned dicts
+        batch_size : int, default is 1000
+            The number of results fetched per database round trip
 
-        if return_json:
-            rdata = []
-            for d in data:
-                d = self._doc_to_json(d, with_ids)
-                if "molecule" in d:
-                    d["molecule"] = d["molecule"]["$oid"]
-                rdata.append(d)
+        Yields
+        ------
+        dict
+            The JSON form of each Result
+        """
 
+        if id is not None:
+            ids, _ = _str_to_indices_with_errors(id)
+            data = Result.objects(id__in=ids)
         else:
-            rdata = data
+            parsed_query = self._results_query(
+                program=program,
+                method=method,
+                basis=basis,
+                molecule=molecule,
+                driver=driver,
+                options=options,
+                status=status)
+            data = Result.objects(**parsed_query)
 
-        return {"data": rdata, "meta": meta}
+        if projection:
+            data = data.only("id", *projection)
+
+        for d in data.no_cache().as_pymongo().batch_size(batch_size):
+            yield self._raw_to_json(d, with_ids, id_fields=("molecule", ))
 
     def del_results(self, ids: List[str]):
         """
@@ -1039,9 +1267,22 @@ class MongoengineSocket:
 
         return ret
 
-    def get_procedures(self, query, projection=None):
+    def get_procedures(self, query, projection=None, limit=0, cursor=None):
+        """
+        Finds procedures matching the query. Queries with a `limit` are ordered by id, meta["next_cursor"]
+        holds the continuation token of the next page which is passed back as `cursor`.
+        """
 
-        return self._get_generic(query, "procedures", allow_generic=True, projection=projection)
+        return self._get_generic(
+            query, "procedures", allow_generic=True, projection=projection, limit=limit, cursor=cursor)
+
+    def iter_procedures(self, query, projection=None, batch_size=1000):
+        """
+        Iterates over all procedures matching the query without the `max_limit` cap,
+        the procedures are pulled from the database `batch_size` at a time.
+        """
+
+        return self._iter_generic(query, "procedures", projection=projection, batch_size=batch_size)
 
     def update_procedure(self, hash_index, data):
         """
@@ -1051,6 +1292,28 @@ class MongoengineSocket:
         ret = self._tables["procedures"].update_one({"hash_index": hash_index}, {"$set": data})
         return ret.modified_count
 
+    def update_procedures(self, data):
+        """
+        Updates several procedures at once, procedures are matched by their hash_index.
+
+        Parameters
+        ----------
+        data : list of dict
+            The new fields of each procedure, including its hash_index
+
+        Returns
+        -------
+        int
+            The number of modified procedures
+        """
+
+        if len(data) == 0:
+            return 0
+
+        bulk_commands = [pymongo.UpdateOne({"hash_index": d["hash_index"]}, {"$set": d}) for d in data]
+        ret = self._tables["procedures"].bulk_write(bulk_commands, ordered=False)
+        return ret.modified_count
+
     def add_services(self, data):
 
         ret = self._add_generic(data, "service_queue", return_map=True)
@@ -1073,14 +1336,34 @@ class MongoengineSocket:
         return self._get_generic(query, "service_queue", projection=projection, allow_generic=True, limit=limit)
 
     def update_services(self, updates):
+        """
+        Writes the new state of several services at once.
+
+        Parameters
+        ----------
+        updates : list of (id, dict) tuples
+            The service id with either the full service document, which replaces the
+            stored document, or an update document of operators such as $set and $unset
+            (see storage_utils.document_update). Empty updates are skipped.
 
-        match_count = 0
-        modified_count = 0
+        Returns
+        -------
+        tuple
+            The number of matched and modified services
+        """
+
+        bulk_commands = []
         for uid, data in updates:
-            result = self._tables["service_queue"].replace_one({"_id": ObjectId(uid)}, data)
-            match_count += result.matched_count
-            modified_count += result.modified_count
-        return (match_count, modified_count)
+            if storage_utils.is_update_document(data):
+                bulk_commands.append(pymongo.UpdateOne({"_id": ObjectId(uid)}, data))
+            elif len(data):
+                bulk_commands.append(pymongo.ReplaceOne({"_id": ObjectId(uid)}, data))
+
+        if len(bulk_commands) == 0:
+            return (0, 0)
+
+        result = self._tables["service_queue"].bulk_write(bulk_commands, ordered=False)
+        return (result.matched_count, result.modified_count)
 
     def del_services(self, values, index="id"):
 
@@ -1108,6 +1391,7 @@ class MongoengineSocket:
             - spec: dynamic field (dict-like), can have any structure
             - hooks: list of any objects representing listeners (for now)
             - tag: str
+            - priority: int, higher priority tasks are served first (default 0)
             - base_results: tuple (required), first value is the class type
              of the result, {'results' or 'procedure'). The second value is
              the ID of the result in the DB. Example:
@@ -1119,21 +1403,25 @@ class MongoengineSocket:
             'data' is a list of the IDs of the tasks IN ORDER, including
             duplicates. An errored task has 'None' in its ID
             meta['duplicates'] has the duplicate tasks
+
+        Notes
+        -----
+            All tasks are inserted with a single insert_many, duplicates are
+            resolved with a single query and their hooks merged with a single
+            bulk_write.
         """
 
         meta = storage_utils.add_metadata()
 
-        results = []
-        for d in data:
+        results = [None] * len(data)
+        new_tasks = []
+        new_index = []
+        for num, d in enumerate(data):
             try:
                 if not isinstance(d['base_result'], tuple):
                     raise Exception("base_result must be a tuple not {}."
                                     .format(type(d['base_result'])))
 
-                # If saved as DBRef, then use raw query to retrieve (avoid this)
-                # if d['base_result'][0] in ('results', 'procedure'):
-                #     base_result = DBRef(d['base_result'][0], d['base_result'][1])
-
                 result_obj = None
                 if d['base_result'][0] == 'results':
                     result_obj = Result(id=d['base_result'][1])
@@ -1144,61 +1432,238 @@ class MongoengineSocket:
                                     " {} is given.".format(d['base_result'][0]))
                 task = TaskQueue(**d)
                 task.base_result = result_obj
-                task.save()
-                results.append(str(task.id))
-                meta['n_inserted'] += 1
-            except mongoengine.errors.NotUniqueError as err:  # rare case
-                # If results is stored as DBRef, get it with:
-                # task = TaskQueue.objects(__raw__={'base_result': base_result}).first()  # avoid
-
-                # If base_result is stored as a Result or Procedure class, get it with:
-                task = TaskQueue.objects(base_result=result_obj).first()
-                self.logger.warning('queue_submit got a duplicate task: ', task.to_mongo())
-                if d['hooks']:  # merge hooks
-                    task.hooks.extend(d['hooks'])
-                    task.save()
-                results.append(str(task.id))
-                meta['duplicates'].append(self._doc_to_tuples(task, with_ids=False))  # TODO
+                task.validate()
+
+                new_tasks.append(task.to_mongo().to_dict())
+                new_index.append(num)
             except Exception as err:
-                meta["success"] = False
                 meta["errors"].append(str(err))
-                results.append(None)
+
+        if len(new_tasks) == 0:
+            meta["success"] = True
+            return {"data": results, "meta": meta}
+
+        # Insert all tasks at once, the unique base_result index flags duplicates
+        collection = TaskQueue._get_collection()
+        duplicates = []
+        try:
+            tmp = collection.insert_many(new_tasks, ordered=False)
+            meta['n_inserted'] = len(tmp.inserted_ids)
+        except pymongo.errors.BulkWriteError as tmp:
+            meta['n_inserted'] = tmp.details["nInserted"]
+            for error in tmp.details["writeErrors"]:
+                if error["code"] == 11000:
+                    duplicates.append(error["index"])
+                else:
+                    meta["errors"].append(error["errmsg"])
+                new_tasks[error["index"]]["_id"] = None
+
+        for num, task in zip(new_index, new_tasks):
+            if task["_id"] is not None:
+                results[num] = str(task["_id"])
+
+        # Duplicate tasks are a rare case, find them with a single query
+        if len(duplicates):
+            self.logger.warning("queue_submit got {} duplicate tasks.".format(len(duplicates)))
+
+            refs = [new_tasks[x]["base_result"] for x in duplicates]
+            proj = {"base_result": True, "status": True, "tag": True}
+            found = collection.find({"base_result": {"$in": refs}}, projection=proj)
+            found = {x["base_result"]["_ref"]: x for x in found}
+
+            hook_updates = []
+            for x in duplicates:
+                task = found.get(new_tasks[x]["base_result"]["_ref"], None)
+                if task is None:
+                    meta["errors"].append("Duplicate task for {} could not be found.".format(
+                        new_tasks[x]["base_result"]["_ref"]))
+                    continue
+
+                results[new_index[x]] = str(task["_id"])
+                meta["duplicates"].append((task.get("status"), str(task.get("tag")),
+                                           str(task["base_result"]["_ref"].id)))
+
+                # Merge hooks
+                if new_tasks[x]["hooks"]:
+                    push = {"$push": {"hooks": {"$each": new_tasks[x]["hooks"]}}}
+                    hook_updates.append(pymongo.UpdateOne({"_id": task["_id"]}, push))
+
+            if len(hook_updates):
+                collection.bulk_write(hook_updates, ordered=False)
 
         meta["success"] = True
 
         ret = {"data": results, "meta": meta}
         return ret
 
-    def queue_get_next(self, limit=100, tag=None, as_json=True):
+    def queue_get_next(self, manager=None, limit=100, tag=None, lease_time=None, as_json=True):
+        """Claims up to `limit` WAITING tasks and marks them as RUNNING.
+
+        Tasks are served highest priority first and oldest first within a
+        priority. Tasks are claimed with an update that only matches WAITING
+        tasks and stamps them with a token unique to this call. Only tasks
+        holding this token are returned, so concurrent managers never receive
+        the same task.
+
+        Each claimed task carries a lease which the manager must renew with
+        `queue_renew_leases`; tasks whose lease runs out are requeued by
+        `queue_requeue_expired`.
+
+        Parameters
+        ----------
+        manager : str, optional
+            The name of the claiming manager
+        limit : int, optional
+            The maximum number of tasks to claim
+        tag : str, optional
+            Only claim tasks with this tag
+        lease_time : int, optional
+            Length of the lease in seconds, defaults to the socket lease time
+        as_json : bool, optional
+            Return tasks as JSON
+
+        Returns
+        -------
+        list of the claimed tasks
+        """
 
         # Figure out query, tagless has no requirements
         query = {"status": "WAITING"}
         if tag is not None:
             query["tag"] = tag
 
-        found = TaskQueue.objects(**query).limit(limit).order_by('-created_on')
+        collection = TaskQueue._get_collection()
+        claim_token = str(uuid.uuid4())
+        lease_time = lease_time or self._queue_lease_time
+
+        # Other managers may claim some of our candidates, try to fill up the request a few times
+        candidates = []
+        n_claimed = 0
+        for attempt in range(self._claim_attempts):
+            found = collection.find(query, projection={"_id": True}, limit=limit - n_claimed)
+            found = [x["_id"] for x in found.sort(self._queue_order)]
+            if len(found) == 0:
+                break
+
+            now = datetime.datetime.utcnow()
+            upd = collection.update_many({
+                "_id": {
+                    "$in": found
+                },
+                "status": "WAITING"
+            }, {
+                "$set": {
+                    "status": "RUNNING",
+                    "manager": manager,
+                    "claim_token": claim_token,
+                    "lease_expiry": now + datetime.timedelta(seconds=lease_time),
+                    "modified_on": now
+                }
+            })
+
+            candidates.extend(found)
+            n_claimed += upd.modified_count
+            if n_claimed >= limit:
+                break
 
-        query = {"_id": {"$in": [x.id for x in found]}}
+        if n_claimed == 0:
+            return []
 
-        # update_many using pymongo in one DB access
-        upd = TaskQueue._collection.update_many(
-            query, {"$set": {
-                "status": "RUNNING",
-                "modified_on": datetime.datetime.utcnow()
-            }})
+        found = TaskQueue.objects(__raw__={
+            "_id": {
+                "$in": candidates
+            },
+            "claim_token": claim_token
+        }).order_by('-priority', 'created_on')
 
         if as_json:
-            found = [self._doc_to_json(task, with_ids=True) for task in found]
-
-        if upd.modified_count != len(found):
-            self.logger.warning("QUEUE: Number of found projects does not match the number of updated projects.")
+            found = [self._task_to_json(task) for task in found.as_pymongo()]
 
         return found
 
-    def get_queue(self, query, projection=None):
-        """TODO: to be replaced with a specific query, add limit"""
+    def get_queue(self, query, projection=None, limit=0, cursor=None):
+        """TODO: to be replaced with a specific query
 
-        return self._get_generic(query, "task_queue", allow_generic=True, projection=projection)
+        Finished tasks that were moved to the task archive are also searched,
+        archived tasks only hold their 'base_result', 'status', and 'error'.
+        Queries with a `limit` are ordered by id, meta["next_cursor"] holds the
+        continuation token of the next page which is passed back as `cursor`.
+        """
+
+        archive_query = copy.deepcopy(query)
+        ret = self._get_generic(query, "task_queue", allow_generic=True, projection=projection, limit=limit,
+                                cursor=cursor)
+
+        # Only finished tasks are archived
+        status = archive_query.get("status", None) if isinstance(archive_query, dict) else None
+        if isinstance(status, str):
+            status = [status]
+        if (status is not None) and not (set(status) & set(self._archive_status)):
+            return ret
+
+        archived = self._get_generic(
+            archive_query, "task_queue_archive", allow_generic=True, projection=projection, limit=limit, cursor=cursor)
+        found = set(x["id"] for x in ret["data"])
+        ret["data"].extend(x for x in archived["data"] if x["id"] not in found)
+
+        # Merge the pages of both tables, ids have a fixed width so they sort as strings
+        if limit:
+            more = (len(ret["data"]) > limit) or ret["meta"]["next_cursor"] or archived["meta"]["next_cursor"]
+
+            ret["data"].sort(key=lambda x: x["id"])
+            del ret["data"][limit:]
+
+            ret["meta"]["next_cursor"] = None
+            if more:
+                ret["meta"]["next_cursor"] = storage_utils.encode_cursor(ret["data"][-1]["id"])
+
+        ret["meta"]["n_found"] = len(ret["data"])
+
+        return ret
+
+    def queue_archive(self, batch_size=1000, max_batches=None):
+        """Moves all COMPLETE and ERROR tasks out of the task queue and into
+        the task archive. Only the 'base_result', 'status', and 'error' fields
+        are kept, the task id is unchanged.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of tasks moved per database operation
+        max_batches : int, optional
+            Stops after this many batches, the remaining tasks are left for the next call.
+            By default the task queue is drained.
+
+        Returns
+        -------
+        int
+            The number of archived tasks
+        """
+
+        collection = TaskQueue._get_collection()
+        archive = self._tables["task_queue_archive"]
+        query = {"status": {"$in": self._archive_status}}
+        projection = {"base_result": True, "status": True, "error": True}
+
+        n_archived = 0
+        n_batches = 0
+        while (max_batches is None) or (n_batches < max_batches):
+            n_batches += 1
+            found = list(collection.find(query, projection=projection, limit=batch_size))
+            if len(found) == 0:
+                break
+
+            try:
+                archive.insert_many(found, ordered=False)
+            except pymongo.errors.BulkWriteError as err:
+                # Duplicates were archived by an interrupted pass, anything else is a real error
+                if any(x["code"] != 11000 for x in err.details["writeErrors"]):
+                    raise
+
+            ret = collection.delete_many({"_id": {"$in": [x["_id"] for x in found]}, **query})
+            n_archived += ret.deleted_count
+
+        return n_archived
 
     def queue_get_by_id(self, ids: List[str], limit: int=100, as_json: bool=True):
         """Get tasks by their IDs
@@ -1222,7 +1687,7 @@ class MongoengineSocket:
         found = TaskQueue.objects(id__in=ids).limit(q_limit)
 
         if as_json:
-            found = [self._doc_to_json(task, with_ids=True) for task in found]
+            found = [self._task_to_json(task) for task in found.as_pymongo()]
 
         return found
 
@@ -1246,6 +1711,13 @@ class MongoengineSocket:
         return found
 
     def queue_mark_error(self, data):
+        """Marks tasks as ERROR and wakes the services which wait on them
+
+        Parameters
+        ----------
+        data : list of (str, str) tuples
+            The task id and the error message of each task
+        """
         bulk_commands = []
         dt = datetime.datetime.utcnow()
         for queue_id, msg in data:
@@ -1262,15 +1734,145 @@ class MongoengineSocket:
             return
 
         ret = TaskQueue._collection.bulk_write(bulk_commands, ordered=False)
+
+        # Services are not polled, a failed task wakes its service so the failure is recorded
+        ids = [ObjectId(x[0]) for x in data]
+        tasks = TaskQueue._collection.find({"_id": {"$in": ids}}, projection={"hooks": True})
+        services = storage_utils.hooked_services(hook for task in tasks for hook in task.get("hooks", []))
+        if len(services):
+            self._tables["service_queue"].update_many({"_id": {"$in": [ObjectId(x) for x in services]}},
+                                                      {"$set": {"awake": True}})
+
         return ret
 
-    def queue_reset_status(self, task_ids):
-        """TODO: needs tests"""
-        found = TaskQueue.objects(id__in=task_ids).update(status='WAITING')
+    def queue_reset_status(self, task_ids, manager):
+        """Returns the RUNNING tasks still held by a manager to the WAITING state.
+
+        Tasks which were requeued after their lease expired and claimed by
+        another manager are left untouched.
+
+        Parameters
+        ----------
+        task_ids : list of str
+            The ids of the tasks to return to the queue
+        manager : str
+            The name of the manager holding the tasks
+
+        Returns
+        -------
+        int
+            The number of tasks returned to the queue
+        """
+
+        if len(task_ids) == 0:
+            return 0
+
+        found = TaskQueue.objects(id__in=task_ids, status="RUNNING", manager=manager).update(
+            status="WAITING", manager=None, lease_expiry=None)
 
         return found
 
+    def queue_renew_leases(self, manager, task_ids, lease_time=None):
+        """Extends the lease on RUNNING tasks still held by a manager.
+
+        Parameters
+        ----------
+        manager : str
+            The name of the manager holding the tasks
+        task_ids : list of str
+            The ids of the tasks the manager is still working on
+        lease_time : int, optional
+            Length of the new lease in seconds, defaults to the socket lease time
+
+        Returns
+        -------
+        int
+            The number of renewed leases
+        """
+
+        if len(task_ids) == 0:
+            return 0
+
+        lease_time = lease_time or self._queue_lease_time
+        now = datetime.datetime.utcnow()
+
+        upd = TaskQueue._get_collection().update_many({
+            "_id": {
+                "$in": [ObjectId(x) for x in task_ids]
+            },
+            "status": "RUNNING",
+            "manager": manager
+        }, {"$set": {
+            "lease_expiry": now + datetime.timedelta(seconds=lease_time)
+        }})
+
+        return upd.modified_count
+
+    def queue_requeue_expired(self, batch_size=1000, max_batches=None):
+        """Returns RUNNING tasks whose lease has run out to the WAITING state.
+
+        The number of tasks requeued is recorded as `expired` in the logs of
+        the manager which held the tasks.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of tasks requeued per database operation
+        max_batches : int, optional
+            Stops after this many batches, the remaining tasks are left for the next call.
+            By default all expired tasks are requeued.
+
+        Returns
+        -------
+        int
+            The number of requeued tasks
+        """
+
+        collection = TaskQueue._get_collection()
+        now = datetime.datetime.utcnow()
+        query = {"status": "RUNNING", "lease_expiry": {"$lt": now}}
+
+        n_requeued = 0
+        n_batches = 0
+        while (max_batches is None) or (n_batches < max_batches):
+            n_batches += 1
+            found = list(collection.find(query, projection={"_id": True, "manager": True}, limit=batch_size))
+            if len(found) == 0:
+                break
+
+            # Group by manager so the manager logs can be updated
+            expired = collections.defaultdict(list)
+            for task in found:
+                expired[task.get("manager", None)].append(task["_id"])
+
+            for manager, ids in expired.items():
+                upd = collection.update_many({
+                    "_id": {
+                        "$in": ids
+                    },
+                    **query
+                }, {"$set": {
+                    "status": "WAITING",
+                    "manager": None,
+                    "lease_expiry": None,
+                    "modified_on": now
+                }})
+                n_requeued += upd.modified_count
+
+                if (manager is not None) and upd.modified_count:
+                    self.manager_update(manager, expired=upd.modified_count)
+
+        return n_requeued
+
     def handle_hooks(self, hooks):
+        """Applies the updates of the hooks of completed tasks to their services. Services
+        without remaining tasks are marked as awake so that the next service pass iterates them.
+
+        Parameters
+        ----------
+        hooks : list of list of dict
+            The hooks of each completed task
+        """
 
         # Very dangerous, we need to modify this substatially
         # Does not currently handle multiple identical commands
@@ -1290,11 +1892,24 @@ class MongoengineSocket:
             return
 
         ret = self._tables["service_queue"].bulk_write(bulk_commands, ordered=False)
+
+        services = storage_utils.hooked_services(hook for hook_list in hooks for hook in hook_list)
+        self._tables["service_queue"].update_many({
+            "_id": {
+                "$in": [ObjectId(x) for x in services]
+            },
+            "remaining_tasks": {
+                "$lte": 0
+            }
+        }, {"$set": {
+            "awake": True
+        }})
+
         return ret
 
 ### QueueManagers
 
-    def manager_update(self, name, tag=None, submitted=0, completed=0, failures=0, returned=0):
+    def manager_update(self, name, tag=None, submitted=0, completed=0, failures=0, returned=0, expired=0):
         dt = datetime.datetime.utcnow()
 
         r = self._tables["queue_managers"].update_one(
@@ -1317,7 +1932,8 @@ class MongoengineSocket:
                     "submitted": submitted,
                     "completed": completed,
                     "returned": returned,
-                    "failures": failures
+                    "failures": failures,
+                    "expired": expired
                 }
             },
             upsert=True)
@@ -1426,29 +2042,54 @@ class MongoengineSocket:
 
     def search_qc_variable(self, hashes, field):
         """
-        Displays the first `field` value for each molecule in `hashes`.
+        Displays the first value of each `field` for each molecule in `hashes`.
 
         Parameters
         ----------
         hashes : list
             A list of molecules hashes.
-        field : str
-            A page field.
+        field : str or list of str
+            A page field, or several page fields which are extracted in the same pass.
+            Nested fields use dotted names, e.g. "properties.scf_total_energy".
 
         Returns
         -------
         dataframe
             Returns a dataframe with your results. The rows will have the
-            molecule hashes and the column will contain the name. Each cell
-            contains the field value for the molecule in that row.
+            molecule hashes and the columns will contain the field names. Each cell
+            contains the field value for the molecule in that row, or None if no
+            result of the molecule holds the field.
 
         """
-        d = {}
-        for mol in hashes:
-            command = [{"$match": {"molecule_hash": mol}}, {"$group": {"_id": {}, "value": {"$push": "$" + field}}}]
-            results = list(self.project["results"].aggregate(command))
-            if len(results) == 0 or len(results[0]["value"]) == 0:
-                d[mol] = None
-            else:
-                d[mol] = results[0]["value"][0]
-        return pd.DataFrame(data=d, index=[field]).transpose()
+        fields = [field] if isinstance(field, str) else list(field)
+        hashes = list(hashes)
+
+        # Results reference molecules by id
+        mols = self._tables["molecules"].find({"molecule_hash": {"$in": hashes}}, projection={"molecule_hash": True})
+        mol_hashes = {x["_id"]: x["molecule_hash"] for x in mols}
+
+        # Group the values of all requested fields by molecule in a single pipeline, dotted
+        # field names are not valid group keys so the values are stored by position
+        command = [{
+            "$match": {
+                "molecule": {
+                    "$in": list(mol_hashes)
+                },
+                "$or": [{f: {"$exists": True}} for f in fields]
+            }
+        }, {
+            "$group": {
+                "_id": "$molecule",
+                **{"f" + str(num): {"$push": "$" + f} for num, f in enumerate(fields)}
+            }
+        }]
+
+        d = {mol: {f: None for f in fields} for mol in hashes}
+        for group in self._tables["results"].aggregate(command):
+            mol = mol_hashes[group["_id"]]
+            for num, f in enumerate(fields):
+                values = [x for x in group["f" + str(num)] if x is not None]
+                if len(values):
+                    d[mol][f] = values[0]
+
+        return pd.DataFrame(data=d, index=fields).transpose()
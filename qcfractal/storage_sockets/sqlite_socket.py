@@ -0,0 +1,468 @@
+"""
+SQLite Database class for single node deployments without a MongoDB server
+"""
+
+import datetime
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import bson
+from bson.objectid import ObjectId
+
+from .memory_socket import (MemorySocket, UpdateResult, DeleteResult, _copy, _get_field, _missing, _is_operator,
+                            _match, _project, _sort_docs, _apply_update)
+
+# SQLite limits the number of bound variables, larger $in queries are passed as a JSON array
+_max_variables = 500
+
+_range_operators = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def _sqlite_path(uri, project):
+    """Finds the database file from a 'sqlite:///path' uri, other uri's place the file in the current directory"""
+    if uri is None:
+        return project + ".sqlite"
+    elif uri.startswith("sqlite:///"):
+        return uri[len("sqlite:///"):]
+    elif "://" in uri:
+        return project + ".sqlite"
+    elif os.path.isdir(uri):
+        return os.path.join(uri, project + ".sqlite")
+    else:
+        return uri
+
+
+def _sql_value(value):
+    """Converts a document value to a value for an indexed column"""
+    if value is _missing or value is None:
+        return None
+    elif isinstance(value, (str, int, float)):
+        return value
+    elif isinstance(value, ObjectId):
+        return str(value)
+    elif isinstance(value, datetime.datetime):
+        # Fixed width so that dates sort correctly
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    else:
+        return bson.json_util.dumps(value, sort_keys=True)
+
+
+class SQLiteConnection:
+    """
+    A single SQLite connection shared by all tables of a socket.
+
+    Entering the connection starts an IMMEDIATE transaction which holds the
+    database write lock until the outermost block exits, nested blocks join
+    the running transaction.
+    """
+
+    def __init__(self, path):
+
+        self._lock = threading.RLock()
+        self._depth = 0
+
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self.connection.execute("BEGIN IMMEDIATE")
+            except Exception:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        try:
+            if self._depth == 0:
+                if exc_type is None:
+                    self.connection.execute("COMMIT")
+                else:
+                    self.connection.execute("ROLLBACK")
+        finally:
+            self._lock.release()
+
+        return False
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+class SQLiteTable:
+    """
+    A table of BSON documents with an indexed column for each index field.
+
+    Equality and $in conditions on indexed columns are evaluated by SQLite,
+    the remaining conditions are matched on the decoded documents. Unique
+    keys are enforced by a UNIQUE column holding the encoded key tuple.
+    """
+
+    def __init__(self, name, index_fields=(), unique_fields=None, connection=None):
+
+        self.name = name
+        self._conn = connection
+        self._index_fields = tuple(index_fields)
+        self._unique_fields = tuple(unique_fields) if unique_fields else None
+
+        self._columns = ("_id", "unique_key") + self._index_fields + ("document", )
+        self._sql_insert = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            self.name, ", ".join('"{}"'.format(x) for x in self._columns), ", ".join("?" for x in self._columns))
+        self._sql_update = 'UPDATE "{}" SET {} WHERE "_id" = ?'.format(
+            self.name, ", ".join('"{}" = ?'.format(x) for x in self._columns[1:]))
+
+        self._create_table()
+
+    def _create_table(self):
+
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS "{}" ("_id" TEXT PRIMARY KEY, '
+                               '"unique_key" TEXT UNIQUE, "document" BLOB NOT NULL)'.format(self.name))
+
+            # Add columns for index fields which are new to this table and fill them from the documents
+            found = {x[1] for x in self._conn.execute('PRAGMA table_info("{}")'.format(self.name))}
+            missing = [x for x in self._index_fields if x not in found]
+            for field in missing:
+                self._conn.execute('ALTER TABLE "{}" ADD COLUMN "{}"'.format(self.name, field))
+
+            if missing:
+                for row in self._conn.execute('SELECT "document" FROM "{}"'.format(self.name)):
+                    self._write(bson.BSON(row[0]).decode(), insert=False)
+
+            for field in self._index_fields:
+                self._conn.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}")'.format(self.name, field))
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM "{}"'.format(self.name))[0][0]
+
+    def _row(self, doc):
+        unique_key = None
+        if self._unique_fields:
+            unique_key = json.dumps([_sql_value(_get_field(doc, x)) for x in self._unique_fields])
+
+        row = [str(doc["_id"]), unique_key]
+        row.extend(_sql_value(_get_field(doc, x)) for x in self._index_fields)
+        row.append(bson.BSON.encode(doc))
+        return row
+
+    def _write(self, doc, insert=True):
+        row = self._row(doc)
+        try:
+            if insert:
+                self._conn.execute(self._sql_insert, row)
+            else:
+                self._conn.execute(self._sql_update, row[1:] + row[:1])
+        except sqlite3.IntegrityError:
+            raise KeyError("Duplicate key for document {} in table '{}'.".format(doc["_id"], self.name))
+
+    def _where(self, query):
+        """Translates the indexed part of a query to SQL, returns the clause, its parameters, and
+        whether the clause covers the full query"""
+
+        clauses = []
+        params = []
+        exact = True
+        for key, cond in query.items():
+
+            # Unique key lookups are an $or of indexed queries
+            if key == "$or":
+                branches = [self._where(q) for q in cond]
+                n_params = sum(len(x[1]) for x in branches)
+                if len(branches) == 0:
+                    clauses.append("0")
+                elif any(not x[2] for x in branches) or (n_params > _max_variables):
+                    # Large $or's are split into chunks by _split_or before they reach this point
+                    exact = False
+                elif all(x[0] for x in branches):
+                    clauses.append("(" + " OR ".join("(" + x[0][len(" WHERE "):] + ")" for x in branches) + ")")
+                    for x in branches:
+                        params.extend(x[1])
+                continue
+
+            if (key != "_id") and (key not in self._index_fields):
+                exact = False
+                continue
+
+            # Keyset pagination compares document ids, which sort as their hex strings
+            if (key == "_id") and _is_operator(cond):
+                ranges = {k: v for k, v in cond.items() if k in _range_operators}
+                if any(not isinstance(v, ObjectId) for v in ranges.values()):
+                    exact = False
+                    continue
+
+                for op, value in ranges.items():
+                    clauses.append('"_id" {} ?'.format(_range_operators[op]))
+                    params.append(str(value))
+
+                cond = {k: v for k, v in cond.items() if k not in ranges}
+                if len(cond) == 0:
+                    continue
+
+            if _is_operator(cond):
+                if set(cond) != {"$in"}:
+                    exact = False
+                    continue
+                values = list(cond["$in"])
+            else:
+                values = [cond]
+
+            # Only ObjectId's are stored as the document id
+            if key == "_id":
+                values = [x for x in values if isinstance(x, ObjectId)]
+
+            # Arrays and embedded documents are matched on the documents
+            if any(isinstance(x, (list, tuple)) for x in values):
+                exact = False
+                continue
+
+            values = [_sql_value(x) for x in values]
+            clause = []
+            if None in values:
+                values = [x for x in values if x is not None]
+                clause.append('"{}" IS NULL'.format(key))
+
+            if len(values) > _max_variables:
+                clause.append('"{}" IN (SELECT value FROM json_each(?))'.format(key))
+                params.append(json.dumps(values))
+            elif len(values):
+                clause.append('"{}" IN ({})'.format(key, ", ".join("?" for x in values)))
+                params.extend(values)
+
+            if len(clause) == 0:
+                clause.append("0")
+            clauses.append("(" + " OR ".join(clause) + ")")
+
+        if len(clauses) == 0:
+            return "", params, exact
+
+        return " WHERE " + " AND ".join(clauses), params, exact
+
+    def _split_or(self, query):
+        """Splits a top level $or whose indexed branches exceed the variable limit of SQLite into queries
+        which each hold a chunk of the branches, returns None for queries which do not need to be split"""
+
+        branches = query.get("$or", None)
+        if not branches:
+            return None
+
+        where = [self._where(q) for q in branches]
+        if any(not x[2] for x in where) or (sum(len(x[1]) for x in where) <= _max_variables):
+            return None
+
+        rest = {k: v for k, v in query.items() if k != "$or"}
+        n_rest = len(self._where(rest)[1])
+
+        chunks = [[]]
+        n_params = n_rest
+        for branch, (clause, params, exact) in zip(branches, where):
+            if chunks[-1] and (n_params + len(params) > _max_variables):
+                chunks.append([])
+                n_params = n_rest
+            chunks[-1].append(branch)
+            n_params += len(params)
+
+        return [dict(rest, **{"$or": x}) for x in chunks]
+
+    def _find(self, query, sort=None, limit=0):
+        query = query or {}
+
+        # Each chunk of a large $or is an indexed query, documents matching several chunks are kept once
+        split = self._split_or(query)
+        if split is not None:
+            docs = {}
+            for chunk in split:
+                for doc in self._find(chunk):
+                    docs.setdefault(doc["_id"], doc)
+
+            docs = _sort_docs(list(docs.values()), sort or [("_id", 1)])
+            if limit:
+                docs = docs[:limit]
+            return docs
+
+        where, params, exact = self._where(query)
+        sql = 'SELECT "document" FROM "{}"'.format(self.name) + where
+
+        # Sort in SQLite when all sort fields are indexed
+        sql_sort = sort and all((key == "_id") or (key in self._index_fields) for key, direction in sort)
+        if sql_sort:
+            sql += " ORDER BY " + ", ".join('"{}" {}'.format(key, "DESC" if direction < 0 else "ASC")
+                                            for key, direction in sort)
+        elif not sort:
+            sql += ' ORDER BY "_id"'
+
+        if limit and exact and (sql_sort or not sort):
+            sql += " LIMIT {:d}".format(limit)
+
+        docs = [bson.BSON(row[0]).decode() for row in self._conn.execute(sql, params)]
+        docs = [x for x in docs if _match(x, query)]
+
+        if sort and not sql_sort:
+            docs = _sort_docs(docs, sort)
+
+        if limit:
+            docs = docs[:limit]
+
+        return docs
+
+    def insert_one(self, doc):
+        """Inserts a document, an ObjectId is added to `doc` if it does not have one.
+
+        Raises a KeyError for duplicate ids or unique keys.
+        """
+
+        if "_id" not in doc:
+            doc["_id"] = ObjectId()
+
+        with self._conn:
+            self._write(_copy(doc))
+
+        return doc["_id"]
+
+    def find(self, query=None, projection=None, limit=0, sort=None):
+        """Returns all documents matching a MongoDB style query"""
+
+        return [_project(x, projection) for x in self._find(query, sort=sort, limit=limit)]
+
+    def iter_find(self, query=None, projection=None, batch_size=1000):
+        """Yields all documents matching a MongoDB style query in _id order, rows are read
+        `batch_size` at a time after the last id of the previous batch"""
+
+        query = query or {}
+
+        # The chunks of a large $or are merged in _id order, documents matching several chunks are kept once
+        split = self._split_or(query)
+        if split is not None:
+            last = None
+            chunks = [self.iter_find(x, batch_size=batch_size) for x in split]
+            for doc in heapq.merge(*chunks, key=lambda x: str(x["_id"])):
+                if doc["_id"] != last:
+                    last = doc["_id"]
+                    yield _project(doc, projection)
+            return
+
+        where, params, exact = self._where(query)
+        sql = 'SELECT "_id", "document" FROM "{}"'.format(self.name) + (where + " AND " if where else " WHERE ")
+        sql += '"_id" > ? ORDER BY "_id" LIMIT {:d}'.format(batch_size)
+
+        last = ""
+        while True:
+            rows = self._conn.execute(sql, params + [last])
+            for row in rows:
+                doc = bson.BSON(row[1]).decode()
+                if _match(doc, query):
+                    yield _project(doc, projection)
+
+            if len(rows) < batch_size:
+                break
+            last = rows[-1][0]
+
+    def find_one(self, query=None, projection=None):
+        found = self.find(query, projection=projection, limit=1)
+        if len(found):
+            return found[0]
+        else:
+            return None
+
+    def count(self, query=None):
+        return len(self._find(query))
+
+    def _update(self, query, update, upsert=False, multi=True):
+        matched = 0
+        modified = 0
+        upserted_id = None
+
+        with self._conn:
+            for old in self._find(query, limit=0 if multi else 1):
+                new = _copy(old)
+                _apply_update(new, update)
+                new = _copy(new)
+                matched += 1
+
+                if new == old:
+                    continue
+
+                self._write(new, insert=False)
+                modified += 1
+
+            if upsert and (matched == 0):
+                doc = {k: v for k, v in query.items() if not (k.startswith("$") or _is_operator(v))}
+                _apply_update(doc, update, insert=True)
+                upserted_id = self.insert_one(doc)
+
+        return UpdateResult(matched, modified, upserted_id)
+
+    def update_one(self, query, update, upsert=False):
+        return self._update(query, update, upsert=upsert, multi=False)
+
+    def update_many(self, query, update, upsert=False):
+        return self._update(query, update, upsert=upsert, multi=True)
+
+    def replace_one(self, query, doc):
+        with self._conn:
+            found = self._find(query, limit=1)
+            if len(found) == 0:
+                return UpdateResult(0, 0, None)
+
+            new = _copy(doc)
+            new["_id"] = found[0]["_id"]
+            self._write(new, insert=False)
+
+        return UpdateResult(1, int(new != found[0]), None)
+
+    def delete_many(self, query):
+        with self._conn:
+            ids = [str(x["_id"]) for x in self._find(query)]
+            self._conn.execute('DELETE FROM "{}" WHERE "_id" IN (SELECT value FROM json_each(?))'.format(self.name),
+                               (json.dumps(ids), ))
+
+        return DeleteResult(len(ids))
+
+    def drop(self):
+        with self._conn:
+            self._conn.execute('DELETE FROM "{}"'.format(self.name))
+
+
+class SQLiteSocket(MemorySocket):
+    """
+        SQLite QCDB wrapper class with the MongoengineSocket API.
+
+        Every table is stored as an SQLite table with an indexed column for
+        each of its index fields and a BSON column with the full document.
+        The database runs in WAL mode so that readers do not block writers.
+    """
+
+    def __init__(self, uri=None, project="molssidb", bypass_security=False, logger=None, max_limit=1000):
+        """
+        Constructs a new socket, uri's of the form 'sqlite:///path/to/file.sqlite' select the database file.
+        Otherwise the file is named after the project.
+
+        """
+
+        self._path = _sqlite_path(uri, project)
+        self._connection = SQLiteConnection(self._path)
+
+        super().__init__(
+            uri, project=project, bypass_security=bypass_security, logger=logger or logging.getLogger('SQLiteSocket'),
+            max_limit=max_limit)
+
+    def _build_lock(self):
+        # Batched writes and queue claims run as a single transaction
+        return self._connection
+
+    def _build_table(self, name, index_fields, unique_fields):
+        return SQLiteTable(name, index_fields=index_fields, unique_fields=unique_fields, connection=self._connection)
+
+    def __str__(self):
+        return "<SQLiteSocket: path='{0:s}' project='{1:s}'>".format(str(self._path), str(self._project_name))
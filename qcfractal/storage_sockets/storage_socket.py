@@ -7,7 +7,7 @@ def storage_socket_factory(uri, project_name, logger=None, db_type='mongoengine'
     """
     Factory for generating storage sockets. Spins up a given storage layer on request given common inputs.
 
-    Right now only supports MongoDB
+    Supports MongoDB, SQLite, and a non-persistent in-memory store
 
     Parameters
     ----------
@@ -17,8 +17,10 @@ def storage_socket_factory(uri, project_name, logger=None, db_type='mongoengine'
         Name of the project
     logger : logging.Logger, Optional, Default: None
         Specific logger to report to
-    db_type : string, Optional, Default: 'pymongo'
-        socket type, 'pymongo' or 'mongoengine'
+    db_type : string, Optional, Default: 'mongoengine'
+        socket type, 'mongoengine', 'sqlite', or 'memory'. The 'sqlite' socket takes uri's of the
+        form 'sqlite:///path/to/file.sqlite'. The 'memory' socket ignores the uri and
+        keeps all data in the current process
     **kwargs
         Additional keyword arguments to pass to the storage constructor
 
@@ -30,5 +32,11 @@ def storage_socket_factory(uri, project_name, logger=None, db_type='mongoengine'
     if db_type == "mongoengine":
         from . import mongoengine_socket
         return mongoengine_socket.MongoengineSocket(uri, project=project_name, logger=logger, **kwargs)
+    elif db_type == "memory":
+        from . import memory_socket
+        return memory_socket.MemorySocket(uri, project=project_name, logger=logger, **kwargs)
+    elif db_type == "sqlite":
+        from . import sqlite_socket
+        return sqlite_socket.SQLiteSocket(uri, project=project_name, logger=logger, **kwargs)
     else:
         raise KeyError("DBType {} not understood".format(db_type))
@@ -2,11 +2,19 @@
 Contains a number of utility functions for storage sockets
 """
 
+import base64
+import binascii
+import collections
+import copy
 import json
 
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
 # Constants
 _get_metadata = json.dumps({"errors": [], "n_found": 0, "success": False, "missing": [],
-                            "error_description": False})
+                            "error_description": False, "next_cursor": None})
 
 _add_metadata = json.dumps({"errors": [], "n_inserted": 0, "success": False, "duplicates": [],
                             "error_description": False, "validation_errors": []})
@@ -48,6 +56,286 @@ def add_metadata():
     return json.loads(_add_metadata)
 
 
+def encode_cursor(last_id):
+    """
+    Builds the opaque continuation token of a paginated query which resumes after the document `last_id`
+    """
+    return base64.urlsafe_b64encode(str(last_id).encode("UTF-8")).decode("UTF-8")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the ObjectId a continuation token resumes after, raises a KeyError for malformed tokens
+    """
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor.encode("UTF-8")).decode("UTF-8"))
+    except (AttributeError, TypeError, ValueError, binascii.Error, InvalidId):
+        raise KeyError("Cursor '{}' not understood".format(cursor))
+
+
+def add_cursor_query(query, cursor):
+    """
+    Restricts a MongoDB style query to the documents after the continuation token
+    """
+    after = decode_cursor(cursor)
+    if isinstance(query.get("_id", None), dict):
+        query["_id"]["$gt"] = after
+    elif "_id" in query:
+        query["_id"] = {"$in": [query["_id"]], "$gt": after}
+    else:
+        query["_id"] = {"$gt": after}
+
+    return query
+
+
+_json_types = (str, int, float, bool, type(None))
+
+
+def bson_to_json(obj):
+    """
+    Converts the BSON types of a raw document to MongoDB extended JSON in a single pass, dictionaries
+    and lists are modified in place. This matches the output of `json.loads(bson.json_util.dumps(obj))`.
+    """
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if type(v) not in _json_types:
+                obj[k] = bson_to_json(v)
+        return obj
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            if type(v) not in _json_types:
+                obj[i] = bson_to_json(v)
+        return obj
+    elif isinstance(obj, tuple):
+        return [bson_to_json(v) for v in obj]
+    elif isinstance(obj, ObjectId):
+        return {"$oid": str(obj)}
+    elif isinstance(obj, _json_types):
+        return obj
+    else:
+        return bson_to_json(dict(json_util.default(obj)))
+
+
+def raw_to_json(doc, with_ids=True, id_fields=()):
+    """
+    Converts a raw document to JSON, renaming _id to id or removing it altogether.
+    The ObjectId's of the top-level `id_fields` become plain strings.
+    """
+    _id = doc.pop("_id", None)
+    for field in id_fields:
+        if isinstance(doc.get(field, None), ObjectId):
+            doc[field] = str(doc[field])
+
+    bson_to_json(doc)
+    if with_ids:
+        doc["id"] = str(_id)
+
+    return doc
+
+
+def _freeze(value):
+    """Makes a document value hashable so that it can be part of a unique key"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def unique_key_query(keys, ukeys):
+    """
+    Builds a single query which matches all of the unique key tuples. Tuples sharing their leading keys
+    are grouped into one $in query on the last key, several groups are combined with $or.
+    """
+    groups = collections.OrderedDict()
+    for ukey in ukeys:
+        lead = _freeze(ukey[:-1])
+        if lead not in groups:
+            groups[lead] = (ukey[:-1], [])
+        groups[lead][1].append(ukey[-1])
+
+    queries = []
+    for lead, last in groups.values():
+        query = dict(zip(keys[:-1], lead))
+        query[keys[-1]] = last[0] if len(last) == 1 else {"$in": last}
+        queries.append(query)
+
+    if len(queries) == 1:
+        return queries[0]
+
+    return {"$or": queries}
+
+
+def find_unique_keys(table, keys, query, projection=None, meta=None):
+    """
+    Finds the documents of a list of unique key tuples with a single query.
+
+    Parameters
+    ----------
+    table : Collection
+        The pymongo or socket table to search
+    keys : tuple of str
+        The unique index of the table
+    query : list of tuples
+        The unique key tuples to find
+    projection : list or dict, optional
+        The fields to return, the unique key fields are always fetched to map documents back to the query
+    meta : dict, optional
+        Get metadata, malformed and unmatched tuples are added to its "errors" and "missing" lists
+
+    Returns
+    -------
+    list of dict
+        The found documents in the order of the query
+    """
+
+    if meta is None:
+        meta = get_metadata()
+
+    ukeys = []
+    for q in query:
+        if isinstance(q, (list, tuple)) and (len(q) == len(keys)):
+            ukeys.append(tuple(q))
+        else:
+            meta["errors"].append({"query": q, "error": "Malformed query"})
+
+    if len(ukeys) == 0:
+        return []
+
+    # The unique key fields are needed to map documents back to their tuple
+    extra = []
+    if projection is not None:
+        if isinstance(projection, dict):
+            projection = dict(projection)
+        else:
+            projection = {k: True for k in projection}
+
+        if any(projection.values()):
+            extra = [k for k in keys if not projection.get(k, False)]
+            projection.update({k: True for k in extra})
+        else:
+            extra = [k for k in keys if k in projection]
+            for k in extra:
+                del projection[k]
+
+        if len(projection) == 0:
+            projection = None
+
+    found = {}
+    for doc in table.find(unique_key_query(keys, ukeys), projection=projection):
+        found.setdefault(_freeze(tuple(doc.get(k, None) for k in keys)), doc)
+
+    data = []
+    returned = set()
+    for ukey in ukeys:
+        doc = found.get(_freeze(ukey), None)
+        if doc is None:
+            meta["missing"].append(dict(zip(keys, ukey)))
+            continue
+
+        # Repeated tuples return separate copies
+        if id(doc) in returned:
+            doc = dict(doc)
+        returned.add(id(doc))
+        data.append(doc)
+
+    for doc in data:
+        for k in extra:
+            doc.pop(k, None)
+
+    return data
+
+
+def _is_path_key(key):
+    """Checks if a key can be part of a dotted update path"""
+    return isinstance(key, str) and (len(key) > 0) and ("." not in key) and not key.startswith("$")
+
+
+def _diff_documents(old, new, prefix, set_fields, unset_fields):
+    for key, value in new.items():
+        path = prefix + key
+        if key not in old:
+            set_fields[path] = value
+            continue
+
+        previous = old[key]
+        if previous == value:
+            continue
+
+        # Descend into embedded documents whose keys are valid path components
+        if isinstance(value, dict) and isinstance(previous, dict) and all(
+                _is_path_key(k) for k in value) and all(_is_path_key(k) for k in previous):
+            _diff_documents(previous, value, path + ".", set_fields, unset_fields)
+        else:
+            set_fields[path] = value
+
+    for key in old:
+        if key not in new:
+            unset_fields[prefix + key] = True
+
+
+def document_update(old, new, ignore=()):
+    """
+    Builds a MongoDB update which turns the document `old` into `new`. Only the changed
+    subtrees are written with dotted $set paths, removed fields are $unset.
+
+    Parameters
+    ----------
+    old : dict
+        The stored document
+    new : dict
+        The updated document
+    ignore : tuple of str, optional
+        Top level fields which are never written, such as fields owned by other writers
+
+    Returns
+    -------
+    dict
+        The update document, empty if nothing changed
+    """
+
+    set_fields = {}
+    unset_fields = {}
+    if ignore:
+        old = {k: v for k, v in old.items() if k not in ignore}
+        new = {k: v for k, v in new.items() if k not in ignore}
+    _diff_documents(old, new, "", set_fields, unset_fields)
+
+    update = {}
+    if set_fields:
+        update["$set"] = set_fields
+    if unset_fields:
+        update["$unset"] = unset_fields
+
+    return update
+
+
+def is_update_document(data):
+    """Checks if a document is a MongoDB update, i.e. all keys are operators such as $set"""
+    return isinstance(data, dict) and (len(data) > 0) and all(k.startswith("$") for k in data)
+
+
+def result_upsert(doc):
+    """Builds the upsert of a result, new results without a status start as INCOMPLETE"""
+
+    update = {"$set": doc}
+    if "status" not in doc:
+        update["$setOnInsert"] = {"status": "INCOMPLETE"}
+
+    return update
+
+
+def hooked_services(hooks):
+    """Lists the ids of the services which a list of task hooks update"""
+
+    ret = set()
+    for hook in hooks:
+        if isinstance(hook, dict) and (hook.get("document", [None])[0] == "service_queue"):
+            ret.add(hook["document"][1])
+
+    return list(ret)
+
+
 def mixed_molecule_get(socket, data):
     """
     Creates a mixed molecule getter so both molecule_id's and/or molecules can be supplied.
@@ -74,12 +362,18 @@ def mixed_molecule_get(socket, data):
     # Get molecules by index and translate back to dict
     tmp = socket.get_molecules(list(id_mols.values()))
     id_mols_list = tmp["data"]
-    meta["errors"].append(tmp["meta"]["errors"])
+    meta["errors"].extend(tmp["meta"]["errors"])
 
-    inv_id_mols = {v: k for k, v in id_mols.items()}
+    # Several keys may point to the same molecule
+    inv_id_mols = {}
+    for k, v in id_mols.items():
+        inv_id_mols.setdefault(v, []).append(k)
 
     for mol in id_mols_list:
-        ret_mols[inv_id_mols[mol["id"]]] = mol
+        keys = inv_id_mols[mol["id"]]
+        ret_mols[keys[0]] = mol
+        for k in keys[1:]:
+            ret_mols[k] = copy.deepcopy(mol)
 
     meta["success"] = True
     meta["n_found"] = len(ret_mols)
@@ -9,6 +9,7 @@ import signal
 import socket
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 from collections import Mapping
@@ -439,20 +440,27 @@ def fractal_compute_server(request):
         raise TypeError("fractal_compute_server: internal parametrize error")
 
 
-@pytest.fixture(scope="module", params=["mongoengine"])
+@pytest.fixture(scope="module", params=["mongoengine", "sqlite", "memory"])
 def storage_socket_fixture(request):
     print("")
 
-    # Check mongo
-    check_active_mongo_server()
     storage_name = "qcf_test_me"
+    tmpdir = tempfile.TemporaryDirectory()
 
     # IP/port/drop table is specific to build
     if request.param in ["pymongo", "mongoengine"]:
+        # Check mongo
+        check_active_mongo_server()
+
         storage = storage_socket_factory("mongodb://localhost", storage_name, db_type=request.param)
 
         # Clean and re-init the database
         storage._clear_db(storage_name)
+    elif request.param == "sqlite":
+        uri = "sqlite:///" + os.path.join(tmpdir.name, storage_name + ".sqlite")
+        storage = storage_socket_factory(uri, storage_name, db_type=request.param)
+    elif request.param == "memory":
+        storage = storage_socket_factory(None, storage_name, db_type=request.param)
     else:
         raise KeyError("Storage type {} not understood".format(request.param))
 
@@ -460,9 +468,13 @@ def storage_socket_fixture(request):
 
     if request.param in ["pymongo", "mongoengine"]:
         storage.client.drop_database(storage_name)
+    elif request.param in ["sqlite", "memory"]:
+        storage._clear_db(storage_name)
     else:
         raise KeyError("Storage type {} not understood".format(request.param))
 
+    tmpdir.cleanup()
+
 
 @pytest.fixture(scope="module")
 def mongoengine_socket_fixture(request):
@@ -0,0 +1,205 @@
+"""
+Tests the IndexManager and the index audit of the CLI against a mocked database
+"""
+
+import pymongo
+import pytest
+
+import qcfractal
+from qcfractal.cli import qcfractal_server
+from qcfractal.storage_sockets.indexes import IndexManager, hot_queries, index_keys, table_indexes
+
+
+class MockCursor:
+    def __init__(self, collection, query):
+        self._collection = collection
+        self._query = query
+
+    def sort(self, sort):
+        return self
+
+    def explain(self):
+        """Queries on the leading field of an index use the index, all others scan the table"""
+
+        for name, (key, unique) in self._collection.indexes.items():
+            if key[0][0] in self._query:
+                plan = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": name}}
+                break
+        else:
+            plan = {"stage": "COLLSCAN"}
+
+        return {"queryPlanner": {"winningPlan": plan}}
+
+
+class MockCollection:
+    def __init__(self):
+        self.indexes = {}
+        self.fail_unique = False
+        self.stats = True
+
+    def index_information(self):
+        ret = {"_id_": {"key": [("_id", 1)]}}
+        for name, (key, unique) in self.indexes.items():
+            ret[name] = {"key": key}
+            if unique:
+                ret[name]["unique"] = True
+        return ret
+
+    def create_index(self, keys, unique=False, background=False):
+        if unique and self.fail_unique:
+            raise pymongo.errors.OperationFailure("E11000 duplicate key error")
+
+        name = "_".join("{}_{}".format(k, v) for k, v in keys)
+        self.indexes[name] = (list(keys), unique)
+        return name
+
+    def find(self, query):
+        return MockCursor(self, query)
+
+    def aggregate(self, pipeline):
+        if not self.stats:
+            raise pymongo.errors.OperationFailure("$indexStats is not allowed")
+
+        # Only the first index of each table was used
+        return [{"name": name, "accesses": {"ops": int(num == 0)}} for num, name in enumerate(self.indexes)]
+
+
+class MockDatabase(dict):
+    def __missing__(self, table):
+        self[table] = MockCollection()
+        return self[table]
+
+
+def test_index_manager_build():
+
+    database = MockDatabase()
+    manager = IndexManager(database)
+
+    n_indexes = sum(len(x) for x in table_indexes.values())
+    assert len(manager.missing()) == n_indexes
+
+    created = manager.build()
+    assert sum(len(x) for x in created.values()) == n_indexes
+    assert manager.missing() == []
+    assert manager.build() == {}
+
+    # Descending fields keep their direction
+    assert ("priority", pymongo.DESCENDING) in index_keys(("status", "-priority"))
+    assert "status_1_priority_-1_created_on_1" in database["task_queue"].index_information()
+
+
+def test_index_manager_build_failure():
+
+    database = MockDatabase()
+    database["users"].fail_unique = True
+    indexes = {"users": [{"fields": ("username", ), "unique": True}, {"fields": ("tag", )}]}
+    manager = IndexManager(database, indexes=indexes)
+
+    # Unique indexes over duplicate data are skipped, the other indexes are built
+    assert manager.build() == {"users": ["tag_1"]}
+    assert manager.missing() == [("users", {"fields": ("username", ), "unique": True})]
+
+
+def test_index_manager_explain():
+
+    indexes = {"task_queue": [{"fields": ("status", )}]}
+    queries = [
+        ("by_status", "task_queue", {"status": "WAITING"}, [("priority", -1)]),
+        ("by_tag", "task_queue", {"tag": ""}, None),
+    ]
+    manager = IndexManager(MockDatabase(), indexes=indexes, queries=queries)
+
+    ret = {x["name"]: x for x in manager.explain()}
+    assert ret["by_status"]["collscan"] is True
+    assert ret["by_status"]["indexes"] == []
+
+    manager.build()
+    ret = {x["name"]: x for x in manager.explain()}
+    assert ret["by_status"]["collscan"] is False
+    assert ret["by_status"]["stages"] == ["FETCH", "IXSCAN"]
+    assert ret["by_status"]["indexes"] == ["status_1"]
+    assert ret["by_tag"]["collscan"] is True
+
+
+def test_index_manager_hot_queries():
+
+    manager = IndexManager(MockDatabase())
+    manager.build()
+
+    # Every hot query leads with an indexed field
+    ret = {x["name"]: x for x in manager.explain()}
+    assert len(ret) == len(hot_queries)
+    assert [x for x in ret.values() if x["collscan"]] == []
+
+    # The archive pass selects the finished tasks of the task queue
+    assert ret["queue_archive"]["table"] == "task_queue"
+    assert ret["get_queue_archive"]["table"] == "task_queue_archive"
+
+
+def test_index_manager_check():
+
+    database = MockDatabase()
+    indexes = {"task_queue": [{"fields": ("status", )}, {"fields": ("tag", )}]}
+    queries = [("by_status", "task_queue", {"status": "WAITING"}, None)]
+    manager = IndexManager(database, indexes=indexes, queries=queries)
+
+    report = manager.check()
+    assert report["missing"] == [("task_queue", ("status", )), ("task_queue", ("tag", ))]
+    assert report["unused"] == []
+    assert report["queries"][0]["collscan"] is True
+
+    manager.build()
+    report = manager.check()
+    assert report["missing"] == []
+    assert report["unused"] == [("task_queue", "tag_1")]
+    assert report["queries"][0]["collscan"] is False
+
+    # Servers without index statistics
+    database["task_queue"].stats = False
+    assert manager.check()["unused"] is None
+
+
+@pytest.fixture
+def index_cli(monkeypatch):
+    """Points the CLI to a mocked database, returns the IndexManager of the database"""
+
+    manager = IndexManager(MockDatabase())
+
+    class MockSocket:
+        def check_indexes(self):
+            return manager.check()
+
+    def socket_factory(uri, project_name, db_type=None, build_indexes=True):
+        assert build_indexes is False
+        return MockSocket()
+
+    monkeypatch.setattr(qcfractal, "storage_socket_factory", socket_factory)
+    return manager
+
+
+def test_cli_check_indexes(index_cli, capsys):
+
+    args = {"check_indexes": True, "database_type": "mongoengine", "database_uri": "mongodb://localhost", "name": "db"}
+
+    # Missing indexes fail the check
+    with pytest.raises(SystemExit) as err:
+        qcfractal_server.main(args)
+    assert err.value.code == 1
+
+    out = capsys.readouterr().out
+    assert "task_queue: status, tag, -priority, created_on" in out
+    assert "COLLSCAN" in out
+
+    index_cli.build()
+    assert qcfractal_server.main(args) is None
+
+    out = capsys.readouterr().out
+    assert "COLLSCAN" not in out
+    assert "queue_archive" in out
+
+
+def test_cli_check_indexes_memory(capsys):
+
+    args = {"check_indexes": True, "database_type": "memory", "database_uri": None, "name": "db"}
+    assert qcfractal_server.check_indexes(args) is False
+    assert "only available" in capsys.readouterr().out
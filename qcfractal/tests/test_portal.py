@@ -2,8 +2,11 @@
 Tests the interface portal adapter to the REST API
 """
 
+import pytest
+
 import qcfractal.interface as portal
-from qcfractal.testing import test_server
+from qcfractal import FractalServer
+from qcfractal.testing import test_server, pristine_loop, active_loop, find_open_port
 
 # All tests should import test_server, but not use it
 # Make PyTest aware that this module needs the server
@@ -56,3 +59,27 @@ def test_collection_portal(test_server):
     del get_db["data"][0]["id"]
 
     assert db == get_db["data"][0]
+
+
+def test_collection_portal_msgpack():
+    pytest.importorskip("msgpack")
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+
+        with active_loop(loop):
+            client = portal.FractalClient(server.get_address(""))
+
+            ds = portal.collections.Dataset("msgpack_test", client=client)
+            ds.save()
+
+            # The server answered with MessagePack, so the client now also sends it
+            assert client._content_type == "application/msgpack"
+
+            get_ds = client.get_collection("dataset", "msgpack_test")
+            assert isinstance(get_ds, portal.collections.Dataset)
+            assert get_ds.data.name == "msgpack_test"
+
+            assert client.get_collection("dataset", "not_a_collection") is None
+
+        server.stop()
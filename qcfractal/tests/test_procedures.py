@@ -2,12 +2,14 @@
 Tests the server compute capabilities.
 """
 
+import copy
+
 import pytest
 import requests
 
 import qcfractal.interface as portal
-from qcfractal import testing
-from qcfractal.testing import fractal_compute_server
+from qcfractal import procedures, testing
+from qcfractal.testing import fractal_compute_server, storage_socket_fixture
 
 
 ### Tests the compute queue stack
@@ -152,3 +154,110 @@ def test_procedure_task_error(fractal_compute_server):
     assert len(ret) == 1
     assert ret[0]["status"] == "ERROR"
     assert "run_rdkit" in ret[0]["error"]
+
+
+def test_optimization_input_parser_batch(storage_socket_fixture):
+
+    storage = storage_socket_fixture
+    hydrogen = portal.Molecule([[1, 0, 0, -0.5], [1, 0, 0, 0.5]], dtype="numpy", units="bohr").to_json()
+
+    meta = {
+        "procedure": "optimization",
+        "keywords": {"coordsys": "tric"},
+        "program": "geometric",
+        "qc_meta": {"driver": "gradient", "method": "HF", "basis": "sto-3g", "options": None, "program": "psi4"},
+    }
+    packet = {
+        "meta": meta,
+        "data": [hydrogen, hydrogen, hydrogen],
+        "keywords": [{"constraints": {"set": [x]}} for x in [1, 2, 1]]
+    }
+
+    # The same geometry with the same constraints shares a task
+    parser = procedures.get_procedure_input_parser("optimization")
+    tasks, duplicates, errors, hash_indices = parser(storage, copy.deepcopy(packet), return_hash_indices=True)
+    assert len(tasks) == 2
+    assert duplicates == []
+    assert hash_indices[0] == hash_indices[2] != hash_indices[1]
+    assert [x["hash_index"] for x in tasks] == hash_indices[:2]
+
+    for task, constraint in zip(tasks, [1, 2]):
+        packet_keywords = task["spec"]["args"][0]["keywords"]
+        assert packet_keywords["constraints"] == {"set": [constraint]}
+        assert packet_keywords["coordsys"] == "tric"
+        assert task["spec"]["args"][0]["qcfractal_tags"]["keywords"]["constraints"] == {"set": [constraint]}
+        assert task["base_result"][0] == "procedure"
+
+    # Stubs were inserted in order
+    found = storage.get_procedures({"id": [x["base_result"][1] for x in tasks]})["data"]
+    assert {x["id"]: x["hash_index"] for x in found} == {x["base_result"][1]: x["hash_index"] for x in tasks}
+
+    # Resubmission finds all duplicates
+    tasks, duplicates, errors = parser(storage, copy.deepcopy(packet))
+    assert tasks == []
+    assert set(duplicates) == set(hash_indices)
+
+
+def test_single_input_parser_batch(storage_socket_fixture):
+
+    storage = storage_socket_fixture
+    molecules = [portal.Molecule([[2, 0, 0, x]], dtype="numpy", units="bohr").to_json() for x in range(3)]
+
+    meta = {"procedure": "single", "driver": "energy", "method": "batch", "basis": "sto-3g", "options": None,
+            "program": "psi4"}
+    parser = procedures.get_procedure_input_parser("single")
+    tasks, completed, errors = parser(storage, {"meta": meta, "data": molecules})
+    assert len(tasks) == 3
+
+    # Every task points to its own stub
+    ids = [x["base_result"][1] for x in tasks]
+    found = storage.get_results_by_ids(ids)["data"]
+    assert {x["id"] for x in found} == set(ids)
+    assert all(x["status"] == "INCOMPLETE" for x in found)
+
+
+def test_optimization_output_parser_batch(storage_socket_fixture):
+
+    storage = storage_socket_fixture
+    molecules = [portal.Molecule([[1, 0, 0, -x], [1, 0, 0, x]], dtype="numpy", units="bohr").to_json() for x in [1, 2]]
+
+    meta = {
+        "procedure": "optimization",
+        "keywords": {"coordsys": "tric"},
+        "program": "geometric",
+        "qc_meta": {"driver": "gradient", "method": "batch", "basis": "sto-3g", "options": None, "program": "psi4"},
+    }
+    parser = procedures.get_procedure_input_parser("optimization")
+    tasks, duplicates, errors = parser(storage, {"meta": meta, "data": molecules})
+    assert len(tasks) == 2
+
+    # Fake the returned optimizations, the trajectory revisits the initial molecule
+    data = []
+    for num, task in enumerate(tasks):
+        result = copy.deepcopy(task["spec"]["args"][0])
+        spec = result["input_specification"]
+        result["queue_id"] = "queue" + str(num)
+        result["final_molecule"] = molecules[1 - num]
+        result["energies"] = [-1.0, -1.1]
+        result["trajectory"] = []
+        for mol, energy in zip([molecules[num], molecules[1 - num]], result["energies"]):
+            traj = copy.deepcopy(spec)
+            traj["molecule"] = mol
+            traj["return_result"] = energy
+            result["trajectory"].append(traj)
+        data.append((result, []))
+
+    completed, errors, hooks = procedures.get_procedure_output_parser("optimization")(storage, data)
+    assert completed == ["queue0", "queue1"]
+
+    found = storage.get_procedures({"hash_index": [x["hash_index"] for x in tasks]})["data"]
+    found = {x["queue_id"]: x for x in found}
+    assert found["queue0"]["initial_molecule"] == found["queue1"]["final_molecule"]
+    assert found["queue0"]["final_molecule"] == found["queue1"]["initial_molecule"]
+    assert found["queue0"]["keywords"] == meta["keywords"]
+
+    # Trajectory results are shared between both optimizations
+    assert found["queue0"]["trajectory"] == found["queue1"]["trajectory"][::-1]
+    trajectory = storage.get_results_by_ids(found["queue0"]["trajectory"])["data"]
+    molecule_ids = {found["queue0"]["initial_molecule"], found["queue0"]["final_molecule"]}
+    assert {x["molecule"] for x in trajectory} == molecule_ids
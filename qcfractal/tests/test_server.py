@@ -2,13 +2,23 @@
 Tests the DQM Server class
 """
 
+import asyncio
 import threading
+
 import pytest
 import requests
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.web
 
 import qcfractal.interface as portal
+import qcfractal.procedures
+import qcfractal.queue
+import qcfractal.server
+import qcfractal.services
 from qcfractal import FractalServer
-from qcfractal.testing import test_server, pristine_loop, find_open_port, check_active_mongo_server
+from qcfractal.testing import test_server, pristine_loop, active_loop, find_open_port, check_active_mongo_server
 
 meta_set = {'errors', 'n_inserted', 'success', 'duplicates', 'error_description', 'validation_errors'}
 
@@ -104,3 +114,355 @@ def test_storage_socket(test_server):
     pdata = r.json()
     del pdata["data"][0]["id"]
     assert pdata["data"][0] == storage
+
+
+@pytest.fixture
+def prefork(monkeypatch):
+    """Replaces the fork of the server workers, the server is built as the second worker"""
+
+    mongoengine_connection = pytest.importorskip("mongoengine.connection")
+
+    # Start without any IOLoop or database connection
+    monkeypatch.setattr(tornado.ioloop.IOLoop, "_ioloop_for_asyncio", {})
+    monkeypatch.setattr(mongoengine_connection, "_connections", {})
+
+    events = []
+
+    def fork_processes(n):
+        assert tornado.ioloop.IOLoop._ioloop_for_asyncio == {}
+        assert mongoengine_connection._connections == {}
+        events.append("fork")
+        return 1
+
+    factory = qcfractal.server.storage_sockets.storage_socket_factory
+
+    def storage_socket_factory(*args, **kwargs):
+        events.append("storage")
+        return factory(*args, **kwargs)
+
+    monkeypatch.setattr(tornado.netutil, "bind_sockets", lambda port: events.append("bind") or [])
+    monkeypatch.setattr(tornado.process, "fork_processes", fork_processes)
+    monkeypatch.setattr(qcfractal.server.storage_sockets, "storage_socket_factory", storage_socket_factory)
+
+    yield events
+
+    asyncio.set_event_loop(None)
+
+
+def test_server_workers(prefork, tmpdir):
+
+    parent_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(parent_loop)
+
+    uri = "sqlite:///" + str(tmpdir.join("workers.sqlite"))
+    server = FractalServer(
+        port=find_open_port(), workers=2, storage_uri=uri, storage_type="sqlite", ssl_options=False)
+
+    # The storage socket and the IOLoop are only built in the forked worker
+    assert prefork == ["bind", "fork", "storage"]
+    assert server.worker_id == 1
+    assert server.primary is False
+    assert server.loop.asyncio_loop is not parent_loop
+
+    server.stop()
+    parent_loop.close()
+
+
+def test_server_workers_prefork_guard(prefork, monkeypatch):
+
+    with pristine_loop():
+        with pytest.raises(RuntimeError) as err:
+            FractalServer(port=find_open_port(), workers=2, storage_type="sqlite", ssl_options=False)
+        assert "IOLoop" in str(err.value)
+
+    monkeypatch.setattr(pytest.importorskip("mongoengine.connection"), "_connections", {"default": None})
+    with pytest.raises(RuntimeError) as err:
+        FractalServer(port=find_open_port(), workers=2, storage_type="sqlite", ssl_options=False)
+    assert "MongoDB" in str(err.value)
+
+    assert prefork == []
+
+    with pytest.raises(ValueError):
+        FractalServer(port=find_open_port(), workers=2, storage_type="memory", ssl_options=False)
+
+
+def test_handlers_executor(monkeypatch):
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+
+        # Record the thread of every storage call of the handlers
+        threads = []
+
+        def on_executor(name, func):
+            def wrapper(*args, **kwargs):
+                threads.append((name, threading.current_thread()))
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        for name in ["verify_user", "add_molecules", "get_molecules", "get_queue"]:
+            monkeypatch.setattr(server.storage, name, on_executor(name, getattr(server.storage, name)))
+
+        with active_loop(loop):
+            water = portal.data.get_molecule("water_dimer_minima.psimol")
+            r = requests.post(server.get_address("molecule"), json={"meta": {}, "data": {"water": water.to_json()}})
+            assert r.status_code == 200
+
+            r = requests.get(server.get_address("molecule"), json={"meta": {}, "data": [r.json()["data"]["water"]]})
+            assert r.status_code == 200
+            assert water.compare(r.json()["data"][0])
+
+            r = requests.get(server.get_address("task_queue"), json={"meta": {}, "data": {"status": "WAITING"}})
+            assert r.status_code == 200
+            assert r.json()["data"] == []
+
+            # Storage runs on the server thread pool, never on the IOLoop
+            assert {x[0] for x in threads} == {"verify_user", "add_molecules", "get_molecules", "get_queue"}
+            assert all(x[1] in server.executor._threads for x in threads)
+
+            # Errors raised on the thread pool still reach the client
+            def bad_query(*args, **kwargs):
+                raise tornado.web.HTTPError(status_code=400, reason="Bad molecule query")
+
+            monkeypatch.setattr(server.storage, "get_molecules", bad_query)
+            r = requests.get(server.get_address("molecule"), json={"meta": {}, "data": ["bad"]})
+            assert r.status_code == 400
+            assert r.reason == "Bad molecule query"
+
+            monkeypatch.setattr(server.storage, "get_queue", lambda *args, **kwargs: 1 / 0)
+            r = requests.get(server.get_address("task_queue"), json={"meta": {}, "data": {}})
+            assert r.status_code == 500
+
+            monkeypatch.setattr(server.storage, "verify_user", lambda *args: (False, "Unknown user"))
+            r = requests.get(server.get_address("task_queue"), json={"meta": {}, "data": {}})
+            assert r.status_code == 401
+            assert r.reason == "Unknown user"
+
+        server.stop()
+
+
+def test_update_services_pool():
+
+    with pristine_loop() as loop:
+        server = FractalServer(
+            port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False, service_workers=2)
+
+        services = [{"service": "unknown", "hash_index": str(x), "status": "READY"} for x in range(4)]
+        server.storage.add_services(services)
+        ids = [x["id"] for x in server.storage.get_services({"status": "READY"})["data"]]
+
+        # A service owned by another pass is not iterated
+        server._claim_services([{"id": ids[0]}])
+        assert server.update_services() == 4
+
+        ret = {x["id"]: x for x in server.storage.get_services({"id": ids})["data"]}
+        assert ret[ids[0]]["status"] == "READY"
+        assert all(ret[x]["status"] == "ERROR" for x in ids[1:])
+        assert "Iterate Error" in ret[ids[1]]["error_message"]
+
+        # Errored services are not picked up again
+        server._release_services([{"id": ids[0]}])
+        assert server.update_services() == 1
+        assert server.storage.get_services({"id": ids[0]})["data"][0]["status"] == "ERROR"
+
+        server.stop()
+
+
+def test_update_services_wakeup():
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+
+        server.storage.add_services([{"service": "unknown", "hash_index": "sleep", "status": "RUNNING"}])
+        service_id = server.storage.get_services({"hash_index": "sleep"})["data"][0]["id"]
+        server.storage.update_services([(service_id, {"$set": {"remaining_tasks": 1}})])
+
+        # Sleeping services are counted but not iterated
+        assert server.update_services() == 1
+        assert server.storage.get_services({"id": service_id})["data"][0]["status"] == "RUNNING"
+
+        hook = {"document": ("service_queue", service_id), "updates": [["inc", "remaining_tasks", -1]]}
+        server.storage.handle_hooks([[hook]])
+        assert server.update_services() == 1
+        assert server.storage.get_services({"id": service_id})["data"][0]["status"] == "ERROR"
+
+        server.stop()
+
+
+def test_insert_complete_tasks_wakeup(monkeypatch):
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+        storage = server.storage
+
+        storage.add_services([{"service": "unknown", "hash_index": "wake", "status": "RUNNING"}])
+        service_id = storage.get_services({"hash_index": "wake"})["data"][0]["id"]
+        storage.update_services([(service_id, {"$set": {"remaining_tasks": 1}})])
+
+        hook = {"document": ("service_queue", service_id), "updates": [["inc", "remaining_tasks", -1]]}
+        task = {"spec": {}, "hooks": [hook], "tag": None, "base_result": ("results", "5c0000000000000000000001")}
+        queue_id = storage.queue_submit([task])["data"][0]
+        assert len(storage.queue_get_next(manager="manager")) == 1
+
+        def output_parser(storage_socket, data):
+            return [x["queue_id"] for x, hooks in data], [], [hooks for x, hooks in data]
+
+        monkeypatch.setattr(qcfractal.procedures, "get_procedure_output_parser", lambda name: output_parser)
+
+        # A service pass which runs as soon as the hooks fire sees the finished task
+        status = []
+        handle_hooks = storage.handle_hooks
+
+        def wake_service(hooks):
+            handle_hooks(hooks)
+            status.append(storage.get_queue({"id": queue_id})["data"][0]["status"])
+            server.update_services()
+
+        monkeypatch.setattr(storage, "handle_hooks", wake_service)
+
+        results = {queue_id: ({"success": True}, "single", [hook])}
+        ret = qcfractal.queue.QueueManagerHandler.insert_complete_tasks(storage, results, server.logger)
+        assert ret == (1, 0)
+        assert status == ["COMPLETE"]
+
+        server.stop()
+
+
+def test_archive_tasks_periodic(monkeypatch, caplog):
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+
+        calls = []
+
+        def queue_archive(max_batches=None):
+            calls.append((max_batches, threading.current_thread() is threading.main_thread()))
+            return 0
+
+        monkeypatch.setattr(server.storage, "queue_archive", queue_archive)
+
+        # Passes are bounded and run on the storage pool
+        loop.run_sync(lambda: server._run_periodic("archive_tasks", server.archive_tasks, 2))
+        assert calls == [(2, False)]
+
+        # Failed passes are logged
+        def archive_error(max_batches=None):
+            raise KeyError("archive failure")
+
+        monkeypatch.setattr(server.storage, "queue_archive", archive_error)
+        with pytest.raises(KeyError):
+            loop.run_sync(lambda: server._run_periodic("archive_tasks", server.archive_tasks, 2))
+        assert "Periodic job 'archive_tasks' failed" in caplog.text
+        assert "archive failure" in caplog.text
+
+        server.stop()
+
+
+def test_requeue_expired_tasks_periodic(monkeypatch):
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+
+        calls = []
+
+        def queue_requeue_expired(max_batches=None):
+            calls.append((max_batches, threading.current_thread() is threading.main_thread()))
+            return 0
+
+        monkeypatch.setattr(server.storage, "queue_requeue_expired", queue_requeue_expired)
+
+        # Passes are bounded and run on the storage pool
+        loop.run_sync(lambda: server._run_periodic("requeue_expired_tasks", server.requeue_expired_tasks, 2))
+        assert calls == [(2, False)]
+
+        server.stop()
+
+
+def test_update_services_periodic():
+
+    with pristine_loop() as loop:
+        server = FractalServer(
+            port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False, service_sweep_frequency=3600)
+
+        def run_pass():
+            server._update_services_periodic()
+            return server._services_pass
+
+        # The first pass sweeps all running services
+        loop.run_sync(run_pass)
+        assert server._last_service_sweep > 0
+
+        server.storage.add_services([{"service": "unknown", "hash_index": "sleep", "status": "RUNNING"}])
+        service_id = server.storage.get_services({"hash_index": "sleep"})["data"][0]["id"]
+        server.storage.update_services([(service_id, {"$set": {"remaining_tasks": 1}})])
+
+        # Sleeping services are left alone until the next sweep is due
+        loop.run_sync(run_pass)
+        assert server.storage.get_services({"id": service_id})["data"][0]["status"] == "RUNNING"
+
+        server._last_service_sweep = 0
+        loop.run_sync(run_pass)
+        assert server.storage.get_services({"id": service_id})["data"][0]["status"] == "ERROR"
+
+        server.stop()
+
+
+def test_update_services_periodic_error(monkeypatch, caplog):
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+
+        threads = []
+
+        def update_services(wake_all=False):
+            threads.append(threading.current_thread())
+            raise KeyError("services failure")
+
+        monkeypatch.setattr(server, "update_services", update_services)
+
+        # Failed passes run on the storage pool and are logged
+        server._update_services_periodic()
+        with pytest.raises(KeyError):
+            loop.run_sync(lambda: server._services_pass)
+
+        assert threads[0] is not threading.main_thread()
+        assert "Periodic job 'update_services' failed" in caplog.text
+        assert "services failure" in caplog.text
+
+        server.stop()
+
+
+def test_update_services_concurrent_hooks(monkeypatch):
+
+    class HookedService:
+        """Submits two tasks which both finish before the pass writes the service back"""
+
+        def __init__(self, storage, data):
+            self.storage = storage
+            self.data = data
+
+        def iterate(self):
+            self.storage.update_services([(self.data["id"], {"$set": {"remaining_tasks": 2, "awake": False}})])
+
+            hook = {"document": ("service_queue", self.data["id"]), "updates": [["inc", "remaining_tasks", -1]]}
+            self.storage.handle_hooks([[hook], [hook]])
+            return False
+
+        def get_json(self):
+            return self.data
+
+    monkeypatch.setattr(qcfractal.services, "build", lambda name, storage, data: HookedService(storage, data))
+
+    with pristine_loop() as loop:
+        server = FractalServer(port=find_open_port(), storage_type="memory", loop=loop, ssl_options=False)
+
+        server.storage.add_services([{"service": "hooked", "hash_index": "hooked", "status": "READY"}])
+        assert server.update_services() == 1
+
+        # The hooks which fired during the pass are kept
+        ret = server.storage.get_services({"hash_index": "hooked"})["data"][0]
+        assert ret["remaining_tasks"] == 0
+        assert ret["awake"] is True
+
+        server.stop()
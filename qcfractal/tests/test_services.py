@@ -124,4 +124,46 @@ def test_service_torsiondrive_compute_error(torsiondrive_fixture):
     assert len(status) == 1
 
     assert status[0]["status"] == "ERROR"
-    assert "All tasks" in status[0]["error_message"]
\ No newline at end of file
+    assert "All tasks" in status[0]["error_message"]
+
+def test_service_torsiondrive_missing_molecule(monkeypatch):
+
+    from qcfractal.services import torsiondrive_service
+    from qcfractal.storage_sockets import storage_socket_factory
+
+    storage = storage_socket_factory(None, "qcf_test_td_missing", db_type="memory")
+    storage.add_services([{"service": "torsiondrive", "hash_index": "td_missing", "status": "RUNNING"}])
+    service_id = storage.get_services({"hash_index": "td_missing"})["data"][0]["id"]
+
+    hydrogen = portal.Molecule([[1, 0, 0, -0.5], [1, 0, 0, 0.5]], dtype="numpy", units="bohr").to_json()
+
+    # The service is only used to submit tasks, TorsionDrive itself is not needed
+    service = torsiondrive_service.TorsionDriveService.__new__(torsiondrive_service.TorsionDriveService)
+    service.storage_socket = storage
+    service.data = {
+        "id": service_id,
+        "molecule_template": hydrogen,
+        "optimization_meta": {"coordsys": "tric"},
+        "optimization_program": "geometric",
+        "qc_meta": {"driver": "gradient", "method": "HF", "basis": "sto-3g", "options": None, "program": "psi4"},
+        "tag": None,
+        "torsiondrive_meta": {"dihedral_template": [{"type": "dihedral", "indices": [0, 1, 2, 3]}]},
+    }
+
+    # One of the constrained geometries points to a molecule which does not exist
+    parser = torsiondrive_service.procedures.get_procedure_input_parser("optimization")
+
+    def missing_parser(storage, packet, **kwargs):
+        packet["data"][1] = "000000000000000000000000"
+        return parser(storage, packet, **kwargs)
+
+    monkeypatch.setattr(torsiondrive_service.procedures, "get_procedure_input_parser", lambda name: missing_parser)
+
+    with pytest.raises(RuntimeError) as err:
+        service.submit_optimization_tasks({0: [hydrogen["geometry"]], 90: [hydrogen["geometry"]]})
+    assert "1 of 2 constrained geometries" in str(err.value)
+    assert "(1, 'Molecule not found')" in str(err.value)
+
+    # Nothing was queued and the service still waits for its first tasks
+    assert storage.get_queue({})["data"] == []
+    assert "remaining_tasks" not in storage.get_services({"id": service_id})["data"][0]
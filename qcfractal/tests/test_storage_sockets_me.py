@@ -4,10 +4,17 @@ Tests the database wrappers
 All tests should be atomic, that is create and cleanup their data
 """
 
+import copy
+import datetime
+import json
+
 import pytest
+from bson.objectid import ObjectId
 
 import qcfractal.interface as portal
-from qcfractal.testing import mongoengine_socket_fixture as storage_socket
+from qcfractal.storage_sockets import storage_utils
+from qcfractal.storage_sockets.sqlite_socket import SQLiteTable
+from qcfractal.testing import storage_socket_fixture as storage_socket
 
 
 def test_molecules_add(storage_socket):
@@ -91,6 +98,11 @@ def test_molecules_get(storage_socket):
     water2 = portal.Molecule.from_json(db_json)
     water2.compare(water)
 
+    # Only pull the geometry
+    db_json = storage_socket.get_molecules([water_id], index="id", projection=["geometry"])["data"][0]
+    assert db_json.keys() == {"id", "geometry"}
+    assert db_json["geometry"] == water.to_json()["geometry"]
+
     # Cleanup adds
     ret = storage_socket.del_molecules(water_id, index="id")
     assert ret == 1
@@ -135,6 +147,27 @@ def test_options_add(storage_socket):
     assert 1 == storage_socket.del_option(opts["program"], opts["name"])
 
 
+def test_options_get_tuples(storage_socket):
+
+    opts = [{"program": program, "name": name, "value": (program, name)}
+            for program in ["tp1", "tp2"] for name in ["a", "b", "c"]]
+    ret = storage_socket.add_options(opts)
+    assert ret["meta"]["n_inserted"] == 6
+
+    query = [("tp2", "c"), ("tp1", "a"), ("tp1", "missing"), ("tp2", "a"), ("tp1",), ("tp1", "a")]
+    ret = storage_socket.get_options(query, with_ids=False)
+    assert [tuple(x["value"]) for x in ret["data"]] == [("tp2", "c"), ("tp1", "a"), ("tp2", "a"), ("tp1", "a")]
+    assert ret["meta"]["missing"] == [{"program": "tp1", "name": "missing"}]
+    assert len(ret["meta"]["errors"]) == 1
+
+    # The unique key fields are only returned when projected
+    ret = storage_socket._get_generic([("tp1", "b")], "options", projection=["value"])
+    assert ret["data"][0].keys() == {"id", "value"}
+
+    for opt in opts:
+        assert 1 == storage_socket.del_option(opt["program"], opt["name"])
+
+
 def test_options_error(storage_socket):
     opts = portal.data.get_options("psi_default")
 
@@ -269,6 +302,67 @@ def test_results_add(storage_socket):
     assert ret == 2
 
 
+def test_results_add_bulk_order(storage_socket):
+
+    water = portal.data.get_molecule("water_dimer_minima.psimol")
+    mol_insert = storage_socket.add_molecules({"water1": water.to_json()})
+
+    def page(method, driver="energy"):
+        return {
+            "molecule": mol_insert["data"]["water1"],
+            "method": method,
+            "basis": "B1",
+            "options": "default",
+            "program": "P1",
+            "driver": driver,
+            "return_result": 5,
+        }
+
+    ret1 = storage_socket.add_results([page("M1"), page("M2")])
+    assert ret1["meta"]["n_inserted"] == 2
+
+    # Same method, different driver is not a duplicate
+    ret2 = storage_socket.add_results([page("M3"), page("M2"), page("M1", driver="gradient"), page("M1")])
+    assert ret2["meta"]["n_inserted"] == 2
+    assert len(ret2["meta"]["duplicates"]) == 2
+    assert ret2["data"][1] == ret1["data"][1]
+    assert ret2["data"][3] == ret1["data"][0]
+    assert len(set(ret2["data"])) == 4
+
+    # Updates return the existing ids in order
+    update = page("M2")
+    update["return_result"] = 10
+    ret3 = storage_socket.add_results([update, page("M1")], update_existing=True)
+    assert ret3["data"] == [ret1["data"][1], ret1["data"][0]]
+
+    assert ret3["meta"]["n_inserted"] == 0
+
+    ret = storage_socket.get_results_by_ids([ret1["data"][1]], projection=["return_result"])
+    assert ret["data"][0]["return_result"] == 10
+
+    # Invalid results are skipped and reported, the valid ones are still written
+    bad_status = page("M4")
+    bad_status["status"] = "NOT_A_STATUS"
+    no_method = page("M5")
+    del no_method["method"]
+    ret4 = storage_socket.add_results([bad_status, page("M6"), no_method])
+    assert ret4["meta"]["n_inserted"] == 1
+    assert len(ret4["meta"]["validation_errors"]) == 2
+    assert ret4["meta"]["success"] is False
+    assert ret4["data"][0] is None
+    assert ret4["data"][2] is None
+
+    ret5 = storage_socket.add_results([page("M7"), no_method], update_existing=True)
+    assert ret5["meta"]["n_inserted"] == 1
+    assert len(ret5["meta"]["validation_errors"]) == 1
+    assert ret5["data"][1] is None
+
+    ret = storage_socket.del_results(ret2["data"] + ret4["data"][1:2] + ret5["data"][:1])
+    assert ret == 6
+    ret = storage_socket.del_molecules(list(mol_insert["data"].values()), index="id")
+    assert ret == 1
+
+
 ### Build out a set of query tests
 
 
@@ -408,10 +502,159 @@ def test_results_query_project(storage_results):
     assert set(ret.keys()) == {"return_result"}
 
 
+def test_results_query_json(storage_results):
+
+    ret = storage_results.get_results(method="M2")["data"]
+    assert all(isinstance(x["molecule"], str) for x in ret)
+    assert json.loads(json.dumps(ret)) == ret
+
+    ret = storage_results.get_results_by_ids([x["id"] for x in ret])["data"]
+    assert all(isinstance(x["molecule"], str) for x in ret)
+    assert json.loads(json.dumps(ret)) == ret
+
+
+def test_results_search_qc_variable(storage_results):
+
+    waters = ["water_dimer_minima.psimol", "water_dimer_stretch.psimol"]
+    hashes = [portal.data.get_molecule(x).get_hash() for x in waters]
+
+    df = storage_results.search_qc_variable(hashes + ["missing_hash"], ["return_result", "driver", "not_a_field"])
+    assert list(df.columns) == ["return_result", "driver", "not_a_field"]
+    assert df.loc[hashes[0], "return_result"] == 5
+    assert df.loc[hashes[1], "return_result"] == 10
+    assert df.loc[hashes[0], "driver"] == "energy"
+    assert df.loc["missing_hash"].isnull().all()
+    assert df["not_a_field"].isnull().all()
+
+    df = storage_results.search_qc_variable(hashes, "return_result")
+    assert df.shape == (2, 1)
+
+
 def test_results_query_driver(storage_results):
     ret = storage_results.get_results(driver="energy")
     assert ret["meta"]["n_found"] == 2
 
+
+def test_results_iter(storage_results):
+
+    max_limit = storage_results._max_limit
+    storage_results._max_limit = 2
+    try:
+        assert len(storage_results.get_results()["data"]) == 2
+
+        # Iteration is not capped by the max_limit
+        ret = list(storage_results.iter_results(batch_size=2))
+        assert len(ret) == 5
+        assert isinstance(ret[0]["molecule"], str)
+
+        ret = list(storage_results.iter_results(method="M2", program="P2", projection={"return_result"}))
+        assert len(ret) == 1
+        assert set(ret[0].keys()) == {"id", "return_result"}
+
+        ids = [x["id"] for x in storage_results.iter_results()]
+        ret = list(storage_results.iter_results(id=ids[:3]))
+        assert {x["id"] for x in ret} == set(ids[:3])
+    finally:
+        storage_results._max_limit = max_limit
+
+def test_results_paginate(storage_results):
+
+    ids = []
+    cursor = None
+    for page in range(3):
+        ret = storage_results.get_results(limit=2, cursor=cursor)
+        assert ret["meta"]["n_found"] == min(2, 5 - 2 * page)
+
+        ids.extend(x["id"] for x in ret["data"])
+        cursor = ret["meta"]["next_cursor"]
+
+    assert cursor is None
+    assert ids == sorted(ids)
+    assert set(ids) == {x["id"] for x in storage_results.get_results()["data"]}
+
+    # A page which ends on the last result has no continuation
+    ret = storage_results.get_results(limit=5)
+    assert len(ret["data"]) == 5
+    assert ret["meta"]["next_cursor"] is None
+
+    ret = storage_results.get_results(limit=2, cursor="bad")
+    assert ret["meta"]["success"] is False
+    assert ret["meta"]["error_description"]
+
+
+def test_procedures_iter(storage_socket):
+
+    procedures = [{"procedure": "iterate", "hash_index": "iterate_" + str(x)} for x in range(5)]
+    storage_socket.add_procedures(procedures)
+
+    ret = storage_socket.iter_procedures({"procedure": "iterate"}, batch_size=2)
+    first = next(ret)
+    assert first["hash_index"] == "iterate_0"
+
+    # Tables in the server process are read one batch at a time
+    if not hasattr(storage_socket, "check_indexes"):
+        storage_socket._tables["procedures"].delete_many({"hash_index": {"$in": ["iterate_3", "iterate_4"]}})
+        assert [x["hash_index"] for x in ret] == ["iterate_1", "iterate_2"]
+    else:
+        assert [x["hash_index"] for x in ret] == ["iterate_" + str(x) for x in range(1, 5)]
+
+    storage_socket._tables["procedures"].delete_many({"procedure": "iterate"})
+
+
+def test_storage_large_or(storage_socket):
+
+    table = storage_socket._tables["options"]
+    options = [{"program": "large_or", "name": "option_" + str(x)} for x in range(300)]
+    ids = [table.insert_one(dict(x)) for x in options]
+    if not isinstance(ids[0], ObjectId):
+        ids = [x.inserted_id for x in ids]
+
+    # Unique key lookups of many documents hold more branches than SQLite takes variables
+    query = {"$or": options[::-1] + options[:10] + [{"program": "large_or", "name": "missing"}]}
+    if isinstance(table, SQLiteTable):
+        assert len(table._split_or(query)) == 2
+
+    found = list(table.find(query))
+    assert [x["_id"] for x in found] == ids
+
+    found = list(table.find(query, sort=[("name", -1)], limit=3))
+    assert [x["name"] for x in found] == ["option_99", "option_98", "option_97"]
+
+    # Tables in the server process are read one batch at a time
+    if not hasattr(storage_socket, "check_indexes"):
+        assert [x["_id"] for x in table.iter_find(query, batch_size=50)] == ids
+
+    table.delete_many({"program": "large_or"})
+
+
+def test_procedures_paginate(storage_socket):
+
+    procedures = [{"procedure": "paginate", "hash_index": "paginate_" + str(x)} for x in range(5)]
+    storage_socket.add_procedures(procedures)
+
+    ret = storage_socket.get_procedures({"procedure": "paginate"}, limit=3)
+    assert len(ret["data"]) == 3
+    assert ret["meta"]["next_cursor"]
+
+    ret2 = storage_socket.get_procedures({"procedure": "paginate"}, limit=3, cursor=ret["meta"]["next_cursor"])
+    assert len(ret2["data"]) == 2
+    assert ret2["meta"]["next_cursor"] is None
+
+    hashes = [x["hash_index"] for x in ret["data"] + ret2["data"]]
+    assert hashes == ["paginate_" + str(x) for x in range(5)]
+
+    # A page which ends on the last procedure has no continuation
+    ret = storage_socket.get_procedures({"procedure": "paginate"}, limit=5)
+    assert len(ret["data"]) == 5
+    assert ret["meta"]["next_cursor"] is None
+
+    ret = storage_socket.get_procedures({"procedure": "paginate"}, limit=3, cursor="bad")
+    assert ret["meta"]["success"] is False
+    assert len(ret["data"]) == 0
+
+    storage_socket._tables["procedures"].delete_many({"procedure": "paginate"})
+
+
 # ------ New Task Queue tests ------
 # No hash index, tasks are unique by their base_result
 
@@ -446,6 +689,40 @@ def test_queue_submit(storage_results):
     assert ret['meta']['n_inserted'] == 0
     assert len(ret["meta"]['duplicates']) == 1
 
+
+def test_queue_submit_batch(storage_results):
+
+    results = storage_results.get_results()['data']
+
+    def task(result, hook):
+        return {
+            "spec": {},
+            "hooks": [("service", hook)],
+            "tag": None,
+            "base_result": ('results', result['id'])
+        }
+
+    # Duplicates inside of a single batch map back to the same task
+    ret = storage_results.queue_submit([task(results[3], "a"), task(results[4], "b"), task(results[3], "c")])
+    assert ret["meta"]["n_inserted"] == 2
+    assert len(ret["meta"]["duplicates"]) == 1
+    assert ret["data"][0] == ret["data"][2]
+    assert ret["data"][0] != ret["data"][1]
+    first_ids = ret["data"]
+
+    # Errors keep their position in the returned list
+    ret = storage_results.queue_submit([task(results[4], "d"), {"base_result": "bad"}, task(results[3], "e")])
+    assert ret["meta"]["n_inserted"] == 0
+    assert len(ret["meta"]["errors"]) == 1
+    assert ret["data"] == [first_ids[1], None, first_ids[0]]
+
+    # All hooks were merged
+    hooks = storage_results.queue_get_by_id([first_ids[0]])[0]["hooks"]
+    assert {"a", "c", "e"} == {x[1] for x in hooks}
+
+    r = storage_results.queue_mark_complete(first_ids[:2])
+    assert r == 2
+
 # ----------------------------------------------------------
 
 # Builds tests for the queue - Changed design
@@ -526,6 +803,184 @@ def test_storage_queue_duplicate(storage_results):
     assert r == 1
 
 
+def test_queue_get_next_claims(storage_results):
+
+    results = storage_results.get_results()['data']
+    tasks = [{"spec": {}, "hooks": [], "tag": None, "base_result": ('results', x['id'])} for x in results[:3]]
+
+    # Remove tasks from previous tests
+    storage_results._tables["task_queue"].delete_many({})
+    queue_ids = storage_results.queue_submit(tasks)["data"]
+
+    # Each manager only receives the tasks it claimed
+    r1 = storage_results.queue_get_next(manager="manager1", limit=2)
+    r2 = storage_results.queue_get_next(manager="manager2", limit=2)
+    assert len(r1) == 2
+    assert len(r2) == 1
+    assert {x["id"] for x in r1}.isdisjoint({x["id"] for x in r2})
+    assert {x["manager"] for x in r1} == {"manager1"}
+    assert r2[0]["manager"] == "manager2"
+
+    # Nothing left to claim
+    assert len(storage_results.queue_get_next(manager="manager3")) == 0
+
+    r = storage_results.queue_mark_complete(queue_ids)
+    assert r == 3
+
+
+def test_queue_get_next_priority(storage_results):
+
+    results = storage_results.get_results()['data']
+    start = datetime.datetime.now()
+    tasks = []
+    for num, result in enumerate(results[:4]):
+        tasks.append({
+            "spec": {},
+            "hooks": [],
+            "tag": None,
+            "base_result": ('results', result['id']),
+            "created_on": start + datetime.timedelta(seconds=num)
+        })
+    tasks[2]["priority"] = 2
+    tasks[3]["priority"] = 1
+
+    # Remove tasks from previous tests so that the creation order is known
+    storage_results._tables["task_queue"].delete_many({})
+    queue_ids = storage_results.queue_submit(tasks)["data"]
+
+    # Highest priority first, then oldest first
+    r = storage_results.queue_get_next(limit=3)
+    assert [x["id"] for x in r] == [queue_ids[2], queue_ids[3], queue_ids[0]]
+
+    r = storage_results.queue_get_next()
+    assert [x["id"] for x in r] == [queue_ids[1]]
+
+    r = storage_results.queue_mark_complete(queue_ids)
+    assert r == 4
+
+
+def test_queue_archive(storage_results):
+
+    results = storage_results.get_results()['data']
+    tasks = [{"spec": {}, "hooks": [], "tag": None, "base_result": ('results', x['id'])} for x in results[:3]]
+
+    # Archive finished tasks from previous tests
+    storage_results.queue_archive()
+
+    queue_ids = storage_results.queue_submit(tasks)["data"]
+    assert len(set(queue_ids)) == 3
+    storage_results.queue_mark_complete(queue_ids[:1])
+    storage_results.queue_mark_error([(queue_ids[1], "Bad task")])
+
+    # Bounded passes leave the remaining tasks for the next pass
+    assert storage_results.queue_archive(batch_size=1, max_batches=1) == 1
+    assert storage_results.queue_archive() == 1
+    assert storage_results.queue_archive() == 0
+
+    # Archived tasks are still found by id and status
+    ret = storage_results.get_queue({"id": queue_ids})
+    assert ret["meta"]["n_found"] == 3
+    found = {x["id"]: x for x in ret["data"]}
+    assert found[queue_ids[0]]["status"] == "COMPLETE"
+    assert found[queue_ids[0]]["base_result"]["_ref"].id == ObjectId(results[0]["id"])
+    assert found[queue_ids[1]]["error"] == "Bad task"
+    assert "spec" not in found[queue_ids[0]]
+    assert "spec" in found[queue_ids[2]]
+
+    # Pages merge the task queue and the archive
+    ret = storage_results.get_queue({"id": queue_ids}, limit=2)
+    assert [x["id"] for x in ret["data"]] == sorted(queue_ids)[:2]
+
+    ret = storage_results.get_queue({"id": queue_ids}, limit=2, cursor=ret["meta"]["next_cursor"])
+    assert [x["id"] for x in ret["data"]] == sorted(queue_ids)[2:]
+    assert ret["meta"]["next_cursor"] is None
+
+    ret = storage_results.get_queue({"id": queue_ids}, limit=3)
+    assert len(ret["data"]) == 3
+    assert ret["meta"]["next_cursor"] is None
+
+    ret = storage_results.get_queue({"status": "ERROR"})
+    assert [x["id"] for x in ret["data"]] == [queue_ids[1]]
+
+    ret = storage_results.get_queue({"status": "WAITING"})
+    assert [x["id"] for x in ret["data"]] == [queue_ids[2]]
+
+    r = storage_results.queue_mark_complete(queue_ids[2:])
+    assert r == 1
+
+
+def test_queue_leases(storage_results):
+
+    results = storage_results.get_results()['data']
+    tasks = [{"spec": {}, "hooks": [], "tag": None, "base_result": ('results', x['id'])} for x in results[:3]]
+
+    # Remove tasks from previous tests
+    storage_results._tables["task_queue"].delete_many({})
+    queue_ids = storage_results.queue_submit(tasks)["data"]
+
+    alive = storage_results.queue_get_next(manager="alive", limit=1)
+    dead = storage_results.queue_get_next(manager="dead", limit=2)
+    assert alive[0]["manager"] == "alive"
+    assert "lease_expiry" in alive[0]
+
+    # Expire every lease, then renew the tasks the live manager still holds
+    storage_results._tables["task_queue"].update_many({}, {"$set": {"lease_expiry": datetime.datetime(2000, 1, 1)}})
+    assert storage_results.queue_renew_leases("alive", [alive[0]["id"]]) == 1
+    assert storage_results.queue_renew_leases("alive", [dead[0]["id"]]) == 0
+
+    # Bounded passes leave the remaining tasks for the next pass
+    assert storage_results.queue_requeue_expired(batch_size=1, max_batches=1) == 1
+    assert storage_results.queue_requeue_expired() == 1
+    assert storage_results.queue_requeue_expired() == 0
+
+    ret = storage_results.get_queue({"id": queue_ids})["data"]
+    status = {x["id"]: x["status"] for x in ret}
+    assert status[alive[0]["id"]] == "RUNNING"
+    assert [status[x["id"]] for x in dead] == ["WAITING", "WAITING"]
+
+    # Expired tasks are recorded in the manager logs
+    manager = storage_results.get_managers({"name": "dead"})["data"][0]
+    assert manager["expired"] == 2
+
+    r = storage_results.queue_mark_complete(queue_ids)
+    assert r == 3
+
+
+def test_queue_reset_status(storage_results):
+
+    results = storage_results.get_results()['data']
+    tasks = [{"spec": {}, "hooks": [], "tag": None, "base_result": ('results', x['id'])} for x in results[:3]]
+
+    # Remove tasks from previous tests
+    storage_results._tables["task_queue"].delete_many({})
+    queue_ids = storage_results.queue_submit(tasks)["data"]
+
+    first = storage_results.queue_get_next(manager="first", limit=3)
+    assert len(first) == 3
+
+    # The leases of the first manager run out and a second manager claims two of the tasks
+    storage_results._tables["task_queue"].update_many({}, {"$set": {"lease_expiry": datetime.datetime(2000, 1, 1)}})
+    assert storage_results.queue_requeue_expired() == 3
+    second = storage_results.queue_get_next(manager="second", limit=2)
+    assert len(second) == 2
+
+    # The first manager shuts down, only the task nobody holds stays in the queue
+    assert storage_results.queue_reset_status(queue_ids, "first") == 0
+    assert storage_results.queue_reset_status([], "first") == 0
+
+    ret = storage_results.get_queue({"id": queue_ids})["data"]
+    status = {x["id"]: (x["status"], x["manager"]) for x in ret}
+    assert [status[x["id"]] for x in second] == [("RUNNING", "second"), ("RUNNING", "second")]
+
+    # The second manager returns its own tasks
+    assert storage_results.queue_reset_status(queue_ids, "second") == 2
+    ret = storage_results.get_queue({"id": queue_ids})["data"]
+    assert {(x["status"], x["manager"]) for x in ret} == {("WAITING", None)}
+
+    r = storage_results.queue_mark_complete(queue_ids)
+    assert r == 3
+
+
 # User testing
 
 
@@ -573,3 +1028,96 @@ def test_user_permissions_admin(storage_socket):
 
 def test_project_name(storage_socket):
     assert 'test' in storage_socket.get_project_name()
+
+
+def test_storage_indexes(storage_socket):
+    if not hasattr(storage_socket, "check_indexes"):
+        pytest.skip("Index audits are only available for MongoDB")
+
+    storage_socket.init_database(wait=True)
+    report = storage_socket.check_indexes()
+    assert report["missing"] == []
+
+    queries = {x["name"]: x for x in report["queries"]}
+    assert queries["get_procedures"]["collscan"] is False
+    assert queries["queue_get_next"]["collscan"] is False
+
+
+def test_services_update(storage_socket):
+
+    services = [{
+        "hash_index": "service_update" + str(i),
+        "status": "READY",
+        "tag": None,
+        "state": {
+            "grid": {
+                "-90": [],
+                "90": []
+            },
+            "done": False
+        },
+        "extra": i
+    } for i in range(2)]
+    storage_socket.add_services(services)
+    found = storage_socket.get_services({"hash_index": ["service_update0", "service_update1"]})["data"]
+    found.sort(key=lambda x: x["hash_index"])
+    first, second = found
+
+    # Partial update of a subtree and a full replacement in the same batch
+    new_first = copy.deepcopy(first)
+    new_first["status"] = "RUNNING"
+    new_first["state"]["grid"]["90"] = [1, 2]
+    del new_first["extra"]
+    update = storage_utils.document_update(first, new_first)
+    assert update == {"$set": {"status": "RUNNING", "state.grid.90": [1, 2]}, "$unset": {"extra": True}}
+
+    second["status"] = "ERROR"
+    ret = storage_socket.update_services([(first["id"], update), (second["id"], second), (second["id"], {})])
+    assert ret == (2, 2)
+
+    found = storage_socket.get_services({"id": [first["id"], second["id"]]})["data"]
+    found = {x["hash_index"]: x for x in found}
+    assert found["service_update0"]["status"] == "RUNNING"
+    assert found["service_update0"]["state"] == {"grid": {"-90": [], "90": [1, 2]}, "done": False}
+    assert "extra" not in found["service_update0"]
+    assert found["service_update1"]["status"] == "ERROR"
+
+    assert 2 == storage_socket.del_services([first["id"], second["id"]])
+
+
+def test_services_wakeup(storage_results):
+
+    services = [{"hash_index": "service_wakeup" + str(i), "status": "RUNNING", "tag": None} for i in range(2)]
+    storage_results.add_services(services)
+    found = storage_results.get_services({"hash_index": ["service_wakeup0", "service_wakeup1"]})["data"]
+    found.sort(key=lambda x: x["hash_index"])
+    first, second = [x["id"] for x in found]
+    storage_results.update_services([(x, {"$set": {"remaining_tasks": 2}}) for x in [first, second]])
+
+    def hook(service_id):
+        return {"document": ("service_queue", service_id), "updates": [["inc", "remaining_tasks", -1]]}
+
+    def awake():
+        ret = storage_results.get_services({"id": [first, second]}, projection={"awake": True})["data"]
+        return {x["id"] for x in ret if x.get("awake", False)}
+
+    # Services wake once all of their tasks are complete
+    storage_results.handle_hooks([[hook(first)], [hook(second)]])
+    assert awake() == set()
+
+    storage_results.handle_hooks([[hook(first)]])
+    assert awake() == {first}
+
+    # A failed task wakes its service right away
+    result = storage_results.get_results()['data'][0]
+    result = {k: v for k, v in result.items() if k != "id"}
+    result.update({"method": "wakeup", "hash_index": "wakeup", "status": "INCOMPLETE"})
+    result_id = storage_results.add_results([result])["data"][0]
+    task = {"spec": {}, "hooks": [hook(second)], "tag": None, "base_result": ('results', result_id)}
+    queue_id = storage_results.queue_submit([task])["data"][0]
+    storage_results.queue_mark_error([(queue_id, "Failed")])
+    assert awake() == {first, second}
+
+    assert storage_results.queue_get_by_id([queue_id])[0]["status"] == "ERROR"
+    assert 2 == storage_results.del_services([first, second])
+    assert 1 == storage_results.del_results([result_id])
@@ -1,29 +1,124 @@
 """
 Web handlers for the FractalServer
 """
+import functools
+import itertools
 import json
 
+import tornado.ioloop
 import tornado.web
 
+from .interface import codec
+
+
+def _encode_ndjson_chunk(iterator, chunk_size):
+    items = list(itertools.islice(iterator, chunk_size))
+    return len(items), "".join(codec.json_dumps(x) + "\n" for x in items)
+
 
 class APIHandler(tornado.web.RequestHandler):
     """
     A requests handler for API calls, build
+
+    Storage calls are blocking, handlers run them with `run_in_executor` on the
+    server's bounded thread pool so that the IOLoop keeps serving other clients.
     """
 
+    # Request bodies larger than this (in bytes) are decoded on the thread pool
+    _executor_decode_size = 2**16
+
     def initialize(self, **objects):
         """
         Initializes the request to JSON, adds objects, and logging.
         """
 
-        self.set_header("Content-Type", "application/json")
+        self.set_header("Content-Type", codec.JSON_CONTENT_TYPE)
         self.objects = objects
         self.logger = objects["logger"]
+        self.json = None
+
+        # Responses are MessagePack if the client accepts it, JSON otherwise
+        self.content_type = codec.JSON_CONTENT_TYPE
+        if codec.has_msgpack() and codec.is_msgpack(self.request.headers.get("Accept", None)):
+            self.content_type = codec.MSGPACK_CONTENT_TYPE
+            self.set_header("Content-Type", codec.MSGPACK_CONTENT_TYPE)
+
+    async def prepare(self):
+        """
+        Decodes the JSON or MessagePack body of the request.
+        """
+
+        content_type = self.request.headers.get("Content-Type", None)
+        if codec.is_msgpack(content_type) and not codec.has_msgpack():
+            raise tornado.web.HTTPError(status_code=415, reason="MessagePack is not available on this server.")
+
+        body = self.request.body
+        if len(body) > self._executor_decode_size:
+            self.json = await self.run_in_executor(codec.decode, body, content_type)
+        else:
+            self.json = codec.decode(body, content_type)
+
+    def write(self, chunk):
+        """Writes a chunk to the output buffer, dictionaries are encoded in the negotiated format."""
+
+        if isinstance(chunk, dict):
+            chunk = codec.encode(chunk, self.content_type)
+
+        super().write(chunk)
 
-        #print(self.request.headers["Content-Type"])
-        self.json = json.loads(self.request.body.decode("UTF-8"))
+    def run_in_executor(self, func, *args, **kwargs):
+        """Runs a blocking function on the server thread pool
 
-    def authenticate(self, permission):
+        Parameters
+        ----------
+        func : callable
+            The function to call
+        *args
+            Arguments to call the function with
+        **kwargs
+            Keyword arguments to call the function with
+
+        Returns
+        -------
+        Future
+            An awaitable for the result of the function
+        """
+        executor = self.objects.get("executor", None)
+        return tornado.ioloop.IOLoop.current().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    async def write_stream(self, iterable, chunk_size=500):
+        """Streams the items of an iterable as newline-delimited JSON. Items are pulled
+        and encoded on the thread pool and flushed to the client `chunk_size` at a time.
+
+        Parameters
+        ----------
+        iterable : iterable of dict
+            The items to stream
+        chunk_size : int, optional
+            The number of items per flushed chunk
+
+        Returns
+        -------
+        int
+            The number of streamed items
+        """
+
+        self.set_header("Content-Type", codec.NDJSON_CONTENT_TYPE)
+
+        iterator = iter(iterable)
+        n_items = 0
+        while True:
+            n_chunk, chunk = await self.run_in_executor(_encode_ndjson_chunk, iterator, chunk_size)
+            if n_chunk == 0:
+                break
+
+            super().write(chunk)
+            await self.flush()
+            n_items += n_chunk
+
+        return n_items
+
+    async def authenticate(self, permission):
         """Authenticates request with a given permission setting
 
         Parameters
@@ -41,7 +136,8 @@ class APIHandler(tornado.web.RequestHandler):
             username = None
             password = None
 
-        verified, msg = self.objects["storage_socket"].verify_user(username, password, permission)
+        verified, msg = await self.run_in_executor(self.objects["storage_socket"].verify_user, username, password,
+                                                   permission)
         if verified is False:
             raise tornado.web.HTTPError(status_code=401, reason=msg)
 
@@ -51,7 +147,7 @@ class MoleculeHandler(APIHandler):
     A handler to push and get molecules.
     """
 
-    def get(self):
+    async def get(self):
         """
 
         Experimental documentation, need to find a decent format.
@@ -71,7 +167,7 @@ class MoleculeHandler(APIHandler):
             "data" - A dictionary of {key : molecule JSON} results
 
         """
-        self.authenticate("read")
+        await self.authenticate("read")
 
         storage = self.objects["storage_socket"]
 
@@ -79,12 +175,12 @@ class MoleculeHandler(APIHandler):
         if "index" in self.json["meta"]:
             kwargs["index"] = self.json["meta"]["index"]
 
-        ret = storage.get_molecules(self.json["data"], **kwargs)
+        ret = await self.run_in_executor(storage.get_molecules, self.json["data"], **kwargs)
         self.logger.info("GET: Molecule - {} pulls.".format(len(ret["data"])))
 
         self.write(ret)
 
-    def post(self):
+    async def post(self):
         """
             Experimental documentation, need to find a decent format.
 
@@ -103,11 +199,11 @@ class MoleculeHandler(APIHandler):
             "data" - A dictionary of {key : id} results
         """
 
-        self.authenticate("write")
+        await self.authenticate("write")
 
         storage = self.objects["storage_socket"]
 
-        ret = storage.add_molecules(self.json["data"])
+        ret = await self.run_in_executor(storage.add_molecules, self.json["data"])
         self.logger.info("POST: Molecule - {} inserted.".format(ret["meta"]["n_inserted"]))
         self.write(ret)
 
@@ -117,22 +213,22 @@ class OptionHandler(APIHandler):
     A handler to push and get molecules.
     """
 
-    def get(self):
-        self.authenticate("read")
+    async def get(self):
+        await self.authenticate("read")
 
         storage = self.objects["storage_socket"]
 
-        ret = storage.get_options(**self.json["data"], with_ids=False)
+        ret = await self.run_in_executor(storage.get_options, **self.json["data"], with_ids=False)
         self.logger.info("GET: Options - {} pulls.".format(len(ret["data"])))
 
         self.write(ret)
 
-    def post(self):
-        self.authenticate("write")
+    async def post(self):
+        await self.authenticate("write")
 
         storage = self.objects["storage_socket"]
 
-        ret = storage.add_options(self.json["data"])
+        ret = await self.run_in_executor(storage.add_options, self.json["data"])
         self.logger.info("POST: Options - {} inserted.".format(ret["meta"]["n_inserted"]))
 
         self.write(ret)
@@ -143,18 +239,18 @@ class CollectionHandler(APIHandler):
     A handler to push and get molecules.
     """
 
-    def get(self):
-        self.authenticate("read")
+    async def get(self):
+        await self.authenticate("read")
 
         storage = self.objects["storage_socket"]
 
-        ret = storage.get_collections(**self.json["data"])
+        ret = await self.run_in_executor(storage.get_collections, **self.json["data"])
         self.logger.info("GET: Collections - {} pulls.".format(len(ret["data"])))
 
         self.write(ret)
 
-    def post(self):
-        self.authenticate("write")
+    async def post(self):
+        await self.authenticate("write")
 
         storage = self.objects["storage_socket"]
 
@@ -163,7 +259,8 @@ class CollectionHandler(APIHandler):
         collection = self.json["data"].pop("collection")
         name = self.json["data"].pop("name")
 
-        ret = storage.add_collection(collection, name, self.json["data"], overwrite=overwrite)
+        ret = await self.run_in_executor(
+            storage.add_collection, collection, name, self.json["data"], overwrite=overwrite)
         self.logger.info("POST: Collections - {} inserted.".format(ret["meta"]["n_inserted"]))
 
         self.write(ret)
@@ -174,26 +271,33 @@ class ResultHandler(APIHandler):
     A handler to push and get molecules.
     """
 
-    def get(self):
-        self.authenticate("read")
+    async def get(self):
+        await self.authenticate("read")
 
         storage = self.objects["storage_socket"]
         proj = self.json["meta"].get("projection", None)
 
+        # Stream all matching results as newline-delimited JSON without the max_limit cap
+        if self.json["meta"].get("stream", False):
+            n_results = await self.write_stream(storage.iter_results(**self.json["data"], projection=proj))
+            self.logger.info("GET: Results - {} streamed.".format(n_results))
+            return
+
         if "id" in self.json["data"]:
-            ret = storage.get_results_by_ids(self.json["data"]["id"], projection=proj)
+            ret = await self.run_in_executor(storage.get_results_by_ids, self.json["data"]["id"], projection=proj)
         else:
-            ret = storage.get_results(**self.json["data"], projection=proj)
+            page = {k: self.json["meta"][k] for k in ["limit", "cursor"] if k in self.json["meta"]}
+            ret = await self.run_in_executor(storage.get_results, **self.json["data"], projection=proj, **page)
         self.logger.info("GET: Results - {} pulls.".format(len(ret["data"])))
 
         self.write(ret)
 
-    def post(self):
-        self.authenticate("write")
+    async def post(self):
+        await self.authenticate("write")
 
         storage = self.objects["storage_socket"]
 
-        ret = storage.add_results(self.json["data"])
+        ret = await self.run_in_executor(storage.add_results, self.json["data"])
         self.logger.info("POST: Results - {} inserted.".format(ret["meta"]["n_inserted"]))
 
         self.write(ret)
@@ -204,12 +308,22 @@ class ProcedureHandler(APIHandler):
     A handler to push and get molecules.
     """
 
-    def get(self):
-        self.authenticate("read")
+    async def get(self):
+        await self.authenticate("read")
 
         storage = self.objects["storage_socket"]
 
-        ret = storage.get_procedures(self.json["data"])
+        # Stream all matching procedures as newline-delimited JSON without the max_limit cap
+        if self.json["meta"].get("stream", False):
+            n_procedures = await self.write_stream(storage.iter_procedures(self.json["data"]))
+            self.logger.info("GET: Procedures - {} streamed.".format(n_procedures))
+            return
+
+        ret = await self.run_in_executor(
+            storage.get_procedures,
+            self.json["data"],
+            limit=self.json["meta"].get("limit", 0),
+            cursor=self.json["meta"].get("cursor", None))
         self.logger.info("GET: Procedures - {} pulls.".format(len(ret["data"])))
 
         self.write(ret)